@@ -0,0 +1,94 @@
+"""
+Compares the serving engines (see rsproxy/engine.py) on the same workload:
+a backend-like stream of DataRow messages sent over a local TCP connection
+to a MessageProtocol, which forwards DataRows as raw data and parses the
+other messages, as the proxy does.
+
+    python bench_engine.py [megabytes] [row size]
+
+Each engine runs in its own process, because a reactor cannot be
+restarted.
+"""
+import os
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+sys.path.append(os.path.dirname(__file__))
+
+from twisted.internet import protocol, reactor
+
+from rsproxy import engine
+from rsproxy.parser import BackendParser
+from rsproxy.protocol import MessageProtocol
+
+
+def payload(megabytes, rowSize):
+    value = 'x' * rowSize
+    row = 'D' + struct.pack('!IHI', 10 + rowSize, 1, rowSize) + value
+    rows = max(1, megabytes * 1024 * 1024 / len(row))
+    complete = 'C' + struct.pack('!I', 13) + 'SELECT 1\x00'
+    return row * rows + complete + 'Z\x00\x00\x00\x05I'
+
+
+class Sink(MessageProtocol):
+    messageType = BackendParser
+
+    def __init__(self):
+        MessageProtocol.__init__(self)
+        self.bytes = 0
+        self.messages = 0
+
+    def passThrough(self, msgtype):
+        return msgtype == 'D'
+
+    def rawDataReceived(self, data):
+        self.bytes += len(data)
+
+    def messageReceived(self, message):
+        self.messages += 1
+
+    def connectionLost(self, reason):
+        self.factory.done = time.time()
+        reactor.stop()
+
+
+def send(port, data):
+    s = socket.create_connection(('127.0.0.1', port))
+    s.sendall(data)
+    s.close()
+
+
+def run(name, megabytes, rowSize):
+    engine.select(name)
+    data = payload(megabytes, rowSize)
+    factory = protocol.ServerFactory()
+    factory.protocol = Sink
+    factory.noisy = False
+    port = engine.listen(0, factory)
+    started = time.time()
+    sender = threading.Thread(target=send,
+                              args=(port.getHost().port, data))
+    sender.start()
+    reactor.run()
+    sender.join()
+    elapsed = factory.done - started
+    print '%-10s %8.1f MB/s  (%d bytes in %.3fs)' % (
+        name, len(data) / elapsed / 1024 / 1024, len(data), elapsed)
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] in engine.ENGINES:
+        run(sys.argv[1], int(sys.argv[2]), int(sys.argv[3]))
+        return
+    megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+    rowSize = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    for name in engine.ENGINES:
+        subprocess.check_call([sys.executable, __file__, name,
+                               str(megabytes), str(rowSize)])
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,19 @@
 import os
+import signal
 from twisted.internet import reactor
 from twisted.application import service
-from twisted.python import log
 import sys
+import engine
 from server import PGProxyServerFactory
+import filterpool
+import filters
+import logger
+import metrics
+import policy
+import queryfilter
+import querystats
+import setting
+import supervisor
 sys.path.append(os.path.dirname(__file__))
 
 __all__ = ['__version__', 'proxy', 'application']
@@ -19,9 +29,46 @@ class RSProxy(service.Service):
 
     def __init__(self):
         self.config = dict()
+    def configure(self):
+        """
+        Applies the values in setting to module level objects such as caches.
+        """
+        queryfilter.verdict_cache.resize(setting.verdict_cache_entries,
+                                         setting.verdict_cache_bytes)
+        queryfilter.template_cache.resize(setting.template_cache_entries,
+                                          setting.template_cache_bytes)
+        filters.result_cache.resize(setting.result_cache_entries,
+                                    setting.result_cache_bytes,
+                                    setting.result_cache_ttl)
+        querystats.query_stats.resize(setting.query_stats_entries,
+                                      setting.query_stats_users,
+                                      setting.query_stats_template_bytes)
+        logger.configure(setting.log_level, setting.log_sampling)
+        engine.select(self.config.get('engine', engine.TWISTED))
+        filterpool.configure(setting.filter_pool, setting.filter_pool_size)
+        policy.registry.load(setting.policy_file)
+        for user, shard in setting.tenant_shards.items():
+            if shard not in setting.shards:
+                raise ValueError('unknown shard %r for user %r' % (shard, user))
+        signal.signal(signal.SIGHUP, self._sighup)
+    def _sighup(self, signum, frame):
+        reactor.callFromThread(policy.registry.reload)
     def startService(self):
-        log.startLogging(sys.stdout)
-        self._port = reactor.listenTCP(self.config['listen-port'], PGProxyServerFactory(self))
+        logger.start(sys.stdout, setting.log_queue_size)
+        fd = supervisor.workerPipe()
+        if fd is not None:
+            supervisor.runWorker(self, fd)
+            return
+        if setting.workers > 1:
+            if setting.result_cache:
+                raise ValueError('result_cache cannot be used with workers > 1: '
+                                 'writes do not invalidate other workers\' caches')
+            supervisor.Supervisor(setting.workers).run()
+            return
+        self.configure()
+        self._port = engine.listen(self.config['listen-port'], PGProxyServerFactory(self))
+        if setting.metrics_port:
+            metrics.listen(setting.metrics_port, setting.metrics_interface)
         reactor.run()
 
     run = startService
@@ -0,0 +1,218 @@
+# coding:utf-8
+u"""
+管理用の仮想データベース(setting.admin_database)
+
+このデータベースに接続したクライアントのクエリはバックエンドに送らず、
+プロキシが答える。setting.admin_usersのユーザーだけが接続できる。
+
+    psql -h proxy -p 5433 -U admin rsproxy
+    rsproxy=# SHOW POOLS;
+
+コマンドはSHOW HELPで一覧できる(descriptionsを参照)。大文字小文字は区別せず、
+最後の;は省ける。拡張問い合わせプロトコルには答えない
+
+ワーカーが複数あるときは、接続したワーカーのプロセスのことだけを返す
+"""
+import filters
+import policy
+import queryfilter
+from filters import (createCommandCompleteMessage, createDataRowMessage,
+                     createErrorMessage, createParameterStatusMessage,
+                     createRowDescriptionMessage)
+from querystats import query_stats
+
+# SHOW QUERIESで返すテンプレートの数
+max_queries = 20
+
+def parameters():
+    u"""
+    認証したクライアントに送るParameterStatus
+    """
+    return [createParameterStatusMessage(name, value) for name, value in [
+            ('server_version', '9.2'),
+            ('server_encoding', 'UTF8'),
+            ('client_encoding', 'UTF8'),
+            ('DateStyle', 'ISO'),
+            ('integer_datetimes', 'on'),
+            ('application_name', ''),
+            ]]
+
+def execute(factory, query):
+    u"""
+    queryを実行し、ReadyForQueryの前に返すメッセージのリストを返す
+    """
+    words = query.strip().rstrip(';').upper().split()
+    handler = None
+    if len(words) == 2 and words[0] == 'SHOW':
+        handler = shows.get(words[1])
+    elif len(words) == 1:
+        handler = commands.get(words[0])
+    if handler is None:
+        return [error('unknown command: %s' % query.strip(), '42601')]
+    return handler(factory)
+
+def error(message, code):
+    return createErrorMessage(message, __file__, 0, 'execute', 'ERROR', code)
+
+def result(names, rows, tag='SHOW'):
+    return ([createRowDescriptionMessage(names)] +
+            [createDataRowMessage(row) for row in rows] +
+            [createCommandCompleteMessage(tag)])
+
+descriptions = [
+    ('SHOW HELP', u'コマンドの一覧'),
+    ('SHOW CLIENTS', u'クライアントの接続'),
+    ('SHOW SERVERS', u'バックエンドの接続'),
+    ('SHOW POOLS', u'プールごとのバックエンドの数と待っているクライアントの数'),
+    ('SHOW STATS', u'ユーザーごとのクエリの数、時間、行数とバックエンドの待ち時間'),
+    ('SHOW CACHE', u'キャッシュの統計'),
+    ('SHOW QUERIES', u'時間のかかったクエリのテンプレート(querystats)'),
+    ('PAUSE', u'バックエンドを持っていないクライアントのメッセージを止める'),
+    ('RESUME', u'止めたメッセージを送る'),
+    ('RELOAD', u'ポリシーファイルを読み直す'),
+    ]
+
+def show_help(factory):
+    return result(['command', 'description'], descriptions)
+
+def _address(transport):
+    if transport is None:
+        return None
+    peer = transport.getPeer()
+    return '%s:%s' % (getattr(peer, 'host', peer), getattr(peer, 'port', ''))
+
+def client_state(factory, client):
+    backend = client.postgresProtocol
+    if client in factory.pausedClients:
+        return 'paused'
+    if client._acquiring is not None:
+        return 'waiting'
+    if backend is not None:
+        return 'active' if backend.client is client else 'shared'
+    return 'idle'
+
+def show_clients(factory):
+    rows = []
+    for key, client in sorted(factory.cancelKeys.items()):
+        f = client.filter
+        backend = client.postgresProtocol
+        rows.append([key[0],
+                     f.userAuth.user if f.userAuth else None,
+                     f.database,
+                     _address(client.transport),
+                     client_state(factory, client),
+                     f.transactionStatus,
+                     backend.backendKey[0] if backend and backend.backendKey
+                     else None])
+    return result(['id', 'user', 'database', 'address', 'state',
+                   'transaction', 'server'], rows)
+
+def server_state(pool, backend):
+    if not backend.authenticationComplete:
+        return 'connecting'
+    if backend.client is not None:
+        return 'active'
+    if backend in pool.idle:
+        return 'idle' if not backend.inflight else 'shared'
+    return 'used'
+
+def show_servers(factory):
+    rows = []
+    for name, pool in sorted(factory.allPools()):
+        for backend in pool.backends:
+            client = backend.client
+            rows.append([name,
+                         backend.backendKey[0] if backend.backendKey else None,
+                         server_state(pool, backend),
+                         client.cancelKey[0] if client is not None else None,
+                         len(backend.inflight),
+                         backend.transactionStatus])
+    return result(['pool', 'pid', 'state', 'client', 'in_flight',
+                   'transaction'], rows)
+
+def show_pools(factory):
+    rows = []
+    states = factory.backendStates()
+    waiting = factory.waitingClients()
+    for name, pool in sorted(factory.allPools()):
+        rows.append([name, '%s:%s' % (pool.host, pool.port),
+                     'replica' if pool.replica else pool.mode,
+                     len(pool), states[(name, 'connecting')],
+                     states[(name, 'idle')], states[(name, 'attached')],
+                     waiting[(name,)], pool.lag])
+    return result(['pool', 'server', 'mode', 'backends', 'connecting', 'idle',
+                   'attached', 'waiting', 'lag'], rows)
+
+def show_stats(factory):
+    users = {}
+    def user_row(user):
+        row = users.get(user)
+        if row is None:
+            row = users[user] = [user] + [0] * 5 + [0, 0, 0, 0.0, 0.0]
+        return row
+    for stat in query_stats.entries.values():
+        for user, s in stat.users.items():
+            row = user_row(user if user is not None else '(other)')
+            row[1] += s.calls
+            row[2] += s.rejected
+            row[3] += s.total_time
+            row[4] += s.rows
+            row[5] += s.bytes
+    for (database, shard), pool in factory.pools.items():
+        for user, s in pool.scheduler.stats.items():
+            row = user_row(user)
+            row[6] += s.served
+            row[7] += s.rejected
+            row[8] += s.timeouts
+            row[9] += s.waitTotal
+            row[10] = max(row[10], s.waitMax)
+    return result(['user', 'queries', 'rejected', 'query_time', 'rows',
+                   'bytes', 'backends_served', 'backends_rejected',
+                   'backend_timeouts', 'wait_total', 'wait_max'],
+                  [users[user] for user in sorted(users)])
+
+def show_cache(factory):
+    caches = [('result', filters.result_cache.stats()),
+              ('verdict', queryfilter.verdict_cache.stats()),
+              ('template', queryfilter.template_cache.stats()),
+              ('query_stats', query_stats.templates.stats())]
+    names = sorted(set(sum([stats.keys() for name, stats in caches], [])))
+    return result(['cache'] + names,
+                  [[name] + [stats.get(n) for n in names]
+                   for name, stats in caches])
+
+def show_queries(factory):
+    columns = ['query', 'calls', 'rejected', 'total_time', 'mean_time',
+               'p99_time', 'rows', 'bytes']
+    return result(columns, [[stat[c] for c in columns]
+                            for stat in query_stats.top(max_queries)])
+
+def pause(factory):
+    factory.pause()
+    return [createCommandCompleteMessage('PAUSE')]
+
+def resume(factory):
+    factory.resume()
+    return [createCommandCompleteMessage('RESUME')]
+
+def reload(factory):
+    if not policy.registry.reload():
+        return [error('failed to reload policy %s' % policy.registry.path,
+                      '58000')]
+    return [createCommandCompleteMessage('RELOAD')]
+
+shows = {
+    'HELP': show_help,
+    'CLIENTS': show_clients,
+    'SERVERS': show_servers,
+    'POOLS': show_pools,
+    'STATS': show_stats,
+    'CACHE': show_cache,
+    'QUERIES': show_queries,
+    }
+
+commands = {
+    'PAUSE': pause,
+    'RESUME': resume,
+    'RELOAD': reload,
+    }
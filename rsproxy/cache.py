@@ -0,0 +1,179 @@
+# coding:utf-8
+u"""
+プロキシ内で使うキャッシュ
+"""
+from collections import OrderedDict
+import threading
+import time
+
+class LRUCache(object):
+    u"""
+    エントリ数とバイト数の上限を持つLRUキャッシュ
+
+    Usage:
+    cache = LRUCache(max_entries=1024, max_bytes=1024 * 1024)
+    cache.put(key, value, size)
+    value = cache.get(key)
+
+    sizeはエントリのおおよそのバイト数で、max_bytesとの比較に使う。
+    上限を超えると古いものから捨てる。
+    threadsafeなら、get/put/discard/resize/clearをロックの中で行なう。
+    """
+    def __init__(self, max_entries=1024, max_bytes=None, threadsafe=False):
+        self.lock = threading.Lock() if threadsafe else _NoLock()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value, size = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.entries[key] = (value, size)
+            self.hits += 1
+            return value
+    def put(self, key, value, size=0):
+        if self.max_bytes is not None and size > self.max_bytes:
+            return False
+        with self.lock:
+            self._discard(key)
+            self.entries[key] = (value, size)
+            self.bytes += size
+            self.evict()
+        return True
+    def discard(self, key):
+        with self.lock:
+            return self._discard(key)
+    def _discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[1]
+        return entry is not None
+    def evict(self):
+        entries = self.entries
+        while entries and (len(entries) > self.max_entries or
+                           (self.max_bytes is not None and
+                            self.bytes > self.max_bytes)):
+            key, (value, size) = entries.popitem(last=False)
+            self.bytes -= size
+            self.evictions += 1
+    def resize(self, max_entries=None, max_bytes=None):
+        if max_entries is not None:
+            self.max_entries = max_entries
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+        with self.lock:
+            self.evict()
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+    def __len__(self):
+        return len(self.entries)
+    def __contains__(self, key):
+        return key in self.entries
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'bytes': self.bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            }
+
+class ResultCache(object):
+    u"""
+    SELECTの応答(RowDescriptionからCommandCompleteまでのバイト列)のキャッシュ
+
+    Usage:
+    cache = ResultCache(max_entries=1024, max_bytes=1024 * 1024, ttl=60)
+    ticket = cache.reserve(key, 'dau')   # クエリを送る前
+    cache.store(ticket, data)            # 応答が揃ったら
+    data = cache.get(key)
+    cache.invalidate(['dau'])            # dauへの書き込みがあったら
+
+    reserveからstoreまでの間に同じテーブルがinvalidateされたら、書き込み
+    前の結果かもしれないのでstoreしない。tablesがNoneのinvalidateは
+    すべてのテーブルが対象
+    """
+    def __init__(self, max_entries=1024, max_bytes=None, ttl=60, clock=time.time):
+        self.entries = LRUCache(max_entries, max_bytes)
+        self.ttl = ttl
+        self.clock = clock
+        # テーブルごとのキャッシュのキー。追い出されたキーも残るので、
+        # 多くなりすぎたら作り直す
+        self.keys = {}
+        self.indexed = 0
+        # テーブルごとと全体の、invalidateの回数
+        self.generations = {}
+        self.generation = 0
+        self.invalidations = 0
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        data, table, expires = entry
+        if expires <= self.clock():
+            self.entries.discard(key)
+            return None
+        return data
+    def reserve(self, key, table):
+        return (key, table, self.generation, self.generations.get(table, 0))
+    def valid(self, ticket):
+        u"""
+        reserveしてから、そのテーブルがinvalidateされていなければTrue
+        """
+        key, table, generation, table_generation = ticket
+        return (generation == self.generation and
+                table_generation == self.generations.get(table, 0))
+    def store(self, ticket, data):
+        if not self.valid(ticket):
+            return False
+        key, table = ticket[:2]
+        if not self.entries.put(key, (data, table, self.clock() + self.ttl),
+                                len(data)):
+            return False
+        self.keys.setdefault(table, set()).add(key)
+        self.indexed += 1
+        if self.indexed > 2 * self.entries.max_entries:
+            self.reindex()
+        return True
+    def reindex(self):
+        self.keys = {}
+        for key, ((data, table, expires), size) in self.entries.entries.items():
+            self.keys.setdefault(table, set()).add(key)
+        self.indexed = len(self.entries)
+    def invalidate(self, tables=None):
+        self.invalidations += 1
+        if tables is None:
+            self.generation += 1
+            self.entries.clear()
+            self.keys = {}
+            self.indexed = 0
+            return
+        for table in tables:
+            self.generations[table] = self.generations.get(table, 0) + 1
+            for key in self.keys.pop(table, ()):
+                self.entries.discard(key)
+    def resize(self, max_entries=None, max_bytes=None, ttl=None):
+        self.entries.resize(max_entries, max_bytes)
+        if ttl is not None:
+            self.ttl = ttl
+    def __len__(self):
+        return len(self.entries)
+    def stats(self):
+        stats = self.entries.stats()
+        stats['invalidations'] = self.invalidations
+        return stats
+
+class _NoLock(object):
+    def __enter__(self):
+        pass
+    def __exit__(self, *exc):
+        return False
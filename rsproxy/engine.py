@@ -0,0 +1,169 @@
+"""
+How the proxy's sockets are read. The engine is chosen with the 'engine'
+key of RSProxy.config and applies to client and backend connections:
+
+    twisted   - Twisted's own TCP transports. Every read recv()s a new
+                string, which dataReceived then copies into the protocol's
+                receive buffer.
+
+    recv_into - Transports that recv_into() the receive buffer (a
+                parser.Framer) of a protocol.MessageProtocol directly, so
+                that received data is not copied before it is framed.
+                Connections of other protocols, and connections that have
+                started TLS, are read as with 'twisted'.
+
+Both engines run on the same reactor, protocols and filters, so they can
+be compared on identical workloads (see bench_engine.py).
+
+"""
+import socket
+import sys
+from errno import EWOULDBLOCK
+
+from twisted.internet import defer, main, protocol, reactor, tcp
+
+TWISTED = 'twisted'
+RECV_INTO = 'recv_into'
+ENGINES = (TWISTED, RECV_INTO)
+
+current = TWISTED
+
+if hasattr(socket, 'SO_REUSEPORT'):
+    SO_REUSEPORT = socket.SO_REUSEPORT
+elif sys.platform.startswith('linux'):
+    SO_REUSEPORT = 15
+else:
+    SO_REUSEPORT = None
+
+
+
+def select(name):
+    """
+    Makes name the engine of the connections opened from now on.
+    """
+    global current
+    if name not in ENGINES:
+        raise ValueError('unknown engine: %r' % (name,))
+    current = name
+
+
+
+class _RecvIntoMixin:
+    """
+    doRead for tcp.Connection subclasses.
+
+    The receive buffer is kept for the life of the connection. Reads start
+    at readSize and double, up to bufferSize, each time they fill the space
+    given, so that only connections with a lot to read get a large buffer.
+    """
+    bufferSize = 256 * 1024
+    readSize = 4096
+
+    def doRead(self):
+        recvInto = getattr(self.protocol, 'recvInto', None)
+        if recvInto is None:
+            return tcp.Connection.doRead(self)
+        size = self.readSize
+        try:
+            received = recvInto(self.socket, size)
+        except socket.error, se:
+            if se.args[0] == EWOULDBLOCK:
+                return
+            return main.CONNECTION_LOST
+        if not received:
+            return main.CONNECTION_DONE
+        if received == size and size < self.bufferSize:
+            self.readSize = size * 2
+        return self.protocol.framesReceived()
+
+
+
+class Server(_RecvIntoMixin, tcp.Server):
+    pass
+
+
+
+class Client(_RecvIntoMixin, tcp.Client):
+    pass
+
+
+
+class Port(tcp.Port):
+    """
+    A listening port whose connections are read by the given engine,
+    optionally with SO_REUSEPORT set, so that several processes can
+    listen on the same port.
+    """
+
+    def __init__(self, port, factory, engine=TWISTED, reusePort=False,
+                 interface=''):
+        tcp.Port.__init__(self, port, factory, interface=interface,
+                          reactor=reactor)
+        if engine == RECV_INTO:
+            self.transport = Server
+        self.reusePort = reusePort
+
+
+    def createInternetSocket(self):
+        s = tcp.Port.createInternetSocket(self)
+        if self.reusePort:
+            if SO_REUSEPORT is None:
+                raise RuntimeError('SO_REUSEPORT is not supported on %s' %
+                                   sys.platform)
+            s.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        return s
+
+
+
+class Connector(tcp.Connector):
+
+    def _makeTransport(self):
+        return Client(self.host, self.port, self.bindAddress, self,
+                      self.reactor)
+
+
+
+class _InstanceFactory(protocol.ClientFactory):
+    """
+    Connects an existing protocol instance, like ClientCreator.
+    """
+    noisy = False
+
+    def __init__(self, instance, deferred):
+        self.instance = instance
+        self.deferred = deferred
+
+
+    def buildProtocol(self, addr):
+        # Fired after connectionMade, as with ClientCreator.
+        reactor.callLater(0, self.deferred.callback, self.instance)
+        return self.instance
+
+
+    def clientConnectionFailed(self, connector, reason):
+        self.deferred.errback(reason)
+
+
+
+def listen(port, factory, reusePort=False, interface=''):
+    """
+    Listens on port with the current engine. Returns the Port.
+    """
+    p = Port(port, factory, current, reusePort, interface)
+    p.startListening()
+    return p
+
+
+def connect(host, port, instance, timeout=30):
+    """
+    Connects the protocol instance to host:port with the current engine.
+    Returns a Deferred that fires with the instance once connected.
+    """
+    if current == TWISTED:
+        cc = protocol.ClientCreator(reactor, lambda: instance)
+        return cc.connectTCP(host, port, timeout)
+    d = defer.Deferred()
+    c = Connector(host, port, _InstanceFactory(instance, d), timeout, None,
+                  reactor)
+    c.connect()
+    return d
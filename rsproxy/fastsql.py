@@ -0,0 +1,195 @@
+# coding:utf-8
+u"""
+よくある形のクエリをsqlparseを使わずに解析する。
+
+QueryFilterが許可するのは、単一テーブルに対して最上位のANDで条件を並べた
+SELECT文だけなので、その形とSELECT以外の文だけを手書きのlexerで解析する。
+結果はqueryfilter.analyze_statementと同じ形で、少しでも判断が分かれそうな
+クエリはNoneを返してsqlparseに任せる。
+
+* SELECT <列 or *>, ... FROM <テーブル> [WHERE <列><比較演算子><リテラル> [AND ...]]
+  [GROUP BY|ORDER BY <列> [ASC|DESC], ...] [LIMIT <整数>]
+* 先頭がSELECT以外のキーワードの、;を含まない文
+"""
+import re
+
+from sqlparse import tokens
+from sqlparse.keywords import KEYWORDS, KEYWORDS_COMMON
+
+_token_re = re.compile(r"""
+    (\s+)                                  # 空白
+  | ('[^'\r\n]*')                          # 文字列
+  | ((?<![\w.])\d+(?:\.\d+)?(?![\w.]))     # 数値
+  | ([A-Za-z]\w*)                          # 単語
+  | ([<>=~!]+)                             # 比較演算子
+  | ([,*])                                 # , *
+""", re.X)
+
+WS, STRING, NUMBER, WORD, OP, PUNCT = range(1, 7)
+
+COMPARISONS = frozenset(['=', '<>', '!=', '<', '>', '<=', '>='])
+
+# 列名に使われていても構わないキーワード以外で、文の構造に関わるもの
+STRUCTURAL = frozenset([
+        'ALL', 'AND', 'ANY', 'AS', 'ASC', 'BEGIN', 'BETWEEN', 'BY', 'CASE',
+        'CREATE', 'CROSS', 'DESC', 'DISTINCT', 'ELSE', 'END', 'EXISTS', 'FOR',
+        'FROM', 'FULL', 'GROUP', 'HAVING', 'IF', 'IN', 'INNER', 'INTO', 'IS',
+        'JOIN', 'LEFT', 'LIKE', 'LIMIT', 'LOOP', 'NATURAL', 'NOT', 'NULL',
+        'OFFSET', 'ON', 'OR', 'ORDER', 'OUTER', 'OVER', 'RIGHT', 'SELECT',
+        'SET', 'STRAIGHT', 'THEN', 'UNION', 'USING', 'VALUES', 'WHEN',
+        'WHERE', 'WITH',
+        ])
+
+def word_type(word):
+    u"""
+    sqlparseのlexerが単語につけるトークンの種類
+    """
+    upper = word.upper()
+    return KEYWORDS_COMMON.get(upper, KEYWORDS.get(upper, tokens.Name))
+
+def is_column(word):
+    upper = word.upper()
+    if upper in STRUCTURAL or upper.startswith('VALUES'):
+        return False
+    ttype = word_type(word)
+    return ttype in (tokens.Name, tokens.Name.Builtin) or ttype is tokens.Keyword
+
+def is_table(word):
+    return (word_type(word) is tokens.Name and
+            not word.upper().startswith('VALUES'))
+
+def tokenize(string):
+    u"""
+    (種類, 文字列, 直前が空白か)のリスト。解析できない文字があればNone
+    """
+    result = []
+    pos = 0
+    end = len(string)
+    space = False
+    match = _token_re.match
+    while pos < end:
+        m = match(string, pos)
+        if m is None:
+            return None
+        kind = m.lastindex
+        if kind == WS:
+            space = True
+        else:
+            result.append((kind, m.group(kind), space))
+            space = False
+        pos = m.end()
+    return result
+
+def analyze(string):
+    u"""
+    queryfilter.analyze_query_stringと同じ結果を返す。解析できなければNone
+    """
+    if isinstance(string, str):
+        try:
+            string = string.decode('ascii')
+        except UnicodeDecodeError:
+            return None
+
+    head = string.lstrip()
+    m = _token_re.match(head)
+    if m is None or m.lastindex != WORD:
+        return None
+    first = m.group(WORD)
+    if first.upper() != 'SELECT':
+        return analyze_other(first, head[m.end():])
+
+    toks = tokenize(head)
+    if toks is None:
+        return None
+    analysis = analyze_select(toks)
+    if analysis is None:
+        return None
+    return [analysis]
+
+def analyze_other(first, rest):
+    u"""
+    SELECT以外の文は先頭のキーワードだけで決まる
+    """
+    if ';' in rest or (rest and not rest[0].isspace()):
+        return None
+    upper = first.upper()
+    if upper == 'CREATE':
+        return None
+    ttype = word_type(first)
+    if ttype in (tokens.Keyword.DML, tokens.Keyword.DDL):
+        statement_type = upper
+    else:
+        statement_type = 'UNKNOWN'
+    return [('verdict', (True, ValueError('statement type: %s' % statement_type)))]
+
+def analyze_select(toks):
+    n = len(toks)
+    i = 1
+
+    # SELECT節
+    while True:
+        if i >= n:
+            return None
+        kind, text, space = toks[i]
+        if not (text == '*' or (kind == WORD and is_column(text))):
+            return None
+        i += 1
+        if i < n and toks[i][1] == ',':
+            i += 1
+            continue
+        break
+
+    # FROM節
+    if i + 1 >= n or not is_word(toks[i], 'FROM'):
+        return None
+    kind, tablename, space = toks[i + 1]
+    if kind != WORD or not is_table(tablename):
+        return None
+    i += 2
+
+    # WHERE節
+    if i < n and is_word(toks[i], 'WHERE'):
+        i += 1
+        conditions = set()
+        while True:
+            if i + 3 > n:
+                return None
+            (kind0, column, space0), (kind1, op, space1), (kind2, literal, space2) = toks[i:i + 3]
+            if (kind0 != WORD or not is_column(column) or
+                kind1 != OP or op not in COMPARISONS or space1 or
+                kind2 not in (STRING, NUMBER) or space2):
+                return None
+            conditions.add(column + op + literal)
+            i += 3
+            if i < n and is_word(toks[i], 'AND'):
+                i += 1
+                continue
+            break
+    else:
+        conditions = None
+
+    # ORDER BY, GROUP BY, LIMIT
+    while i < n:
+        if (is_word(toks[i], 'ORDER') or is_word(toks[i], 'GROUP')) and i + 1 < n and is_word(toks[i + 1], 'BY'):
+            i += 2
+            while True:
+                if i >= n or toks[i][0] != WORD or not is_column(toks[i][1]):
+                    return None
+                i += 1
+                if i < n and (is_word(toks[i], 'ASC') or is_word(toks[i], 'DESC')):
+                    i += 1
+                if i < n and toks[i][1] == ',':
+                    i += 1
+                    continue
+                break
+        elif is_word(toks[i], 'LIMIT') and i + 1 < n and toks[i + 1][0] == NUMBER and '.' not in toks[i + 1][1]:
+            i += 2
+        else:
+            return None
+
+    if conditions is None:
+        return ('verdict', (False, ValueError('no where clause')))
+    return ('select', tablename, None, frozenset(conditions))
+
+def is_word(token, word):
+    return token[0] == WORD and token[1].upper() == word
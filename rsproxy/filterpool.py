@@ -0,0 +1,138 @@
+# coding:utf-8
+u"""
+SQLのフィルタリングをreactorのスレッドの外で実行するためのプール。
+
+Usage:
+filterpool.configure('thread', 4)
+d = filterpool.run(func, *args)   # funcの結果でcallbackされるDeferred
+
+kindは'thread'(twistedのThreadPool)か'process'(multiprocessing.Pool)。
+'process'の場合、funcと引数はpickleできなければならない。できなければ
+runのDeferredがerrbackされる。setting.filter_pool_timeout秒たっても結果が
+返らなければ(ワーカーが死んだときなど)defer.TimeoutErrorでerrbackされる。
+configureしていなければ、runはその場でfuncを実行する。
+"""
+import cPickle as pickle
+
+from twisted.internet import defer, reactor, threads
+from twisted.python.threadpool import ThreadPool
+
+import logger
+import setting
+
+class ThreadFilterPool(object):
+    def __init__(self, size):
+        self.threadpool = ThreadPool(0, size, 'rsproxy-filter')
+    def start(self):
+        self.threadpool.start()
+    def stop(self):
+        self.threadpool.stop()
+    def run(self, func, *args):
+        return threads.deferToThreadPool(reactor, self.threadpool, func, *args)
+
+def _call(data):
+    u"""
+    プロセスプール内で実行する。dataはpickleした(func, args)。
+    例外も結果として、pickleした(ok, value)を返す
+
+    multiprocessing.Poolはpickleの失敗をcallbackに知らせない
+    (Python 2.7のapply_asyncにはerror_callbackがない)ので、
+    pickleは両側ともこことProcessFilterPool.runで行なう
+    """
+    try:
+        func, args = pickle.loads(data)
+        return pickle.dumps((True, func(*args)), pickle.HIGHEST_PROTOCOL)
+    except Exception, e:
+        try:
+            return pickle.dumps((False, e), pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            return pickle.dumps((False, RuntimeError(repr(e))),
+                                pickle.HIGHEST_PROTOCOL)
+
+def _initWorker():
+    u"""
+    reactorのシグナルハンドラを引き継いでいるので元に戻す。
+    そのままだとterminate()で終了しない
+    """
+    import signal
+    for sig in (signal.SIGINT, signal.SIGTERM, signal.SIGCHLD):
+        signal.signal(sig, signal.SIG_DFL)
+
+class ProcessFilterPool(object):
+    def __init__(self, size):
+        self.size = size
+        self.pool = None
+    def start(self):
+        import multiprocessing
+        self.pool = multiprocessing.Pool(self.size, _initWorker)
+    def stop(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+    def run(self, func, *args):
+        try:
+            data = pickle.dumps((func, args), pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            return defer.fail()
+        d = defer.Deferred()
+        def done(result):
+            reactor.callFromThread(fire, result)
+        def fire(result):
+            if d.called:
+                return
+            timeout.cancel()
+            try:
+                ok, value = pickle.loads(result)
+            except Exception:
+                d.errback()
+                return
+            if ok:
+                d.callback(value)
+            else:
+                d.errback(value)
+        def expire():
+            d.errback(defer.TimeoutError('filter pool did not answer in %s '
+                                         'seconds' % setting.filter_pool_timeout))
+        timeout = reactor.callLater(setting.filter_pool_timeout, expire)
+        try:
+            self.pool.apply_async(_call, (data,), callback=done)
+        except Exception:
+            timeout.cancel()
+            d.errback()
+        return d
+
+pool = None
+_shutdownTrigger = None
+
+def configure(kind, size):
+    u"""
+    プールを作り直す。kindがNoneならプールを使わない
+    """
+    global pool, _shutdownTrigger
+    if pool is not None:
+        reactor.removeSystemEventTrigger(_shutdownTrigger)
+        pool.stop()
+        pool = None
+    if kind is None:
+        return
+    if kind == 'thread':
+        pool = ThreadFilterPool(size)
+    elif kind == 'process':
+        pool = ProcessFilterPool(size)
+    else:
+        raise ValueError('unknown filter pool: %r' % (kind,))
+    pool.start()
+    logger.info('filter', 'Filter pool: %s x %d', kind, size)
+    _shutdownTrigger = reactor.addSystemEventTrigger('during', 'shutdown',
+                                                     pool.stop)
+
+def offloads(query):
+    u"""
+    queryのフィルタリングをプールで実行するならTrue
+    """
+    return pool is not None and len(query) >= setting.filter_pool_min_length
+
+def run(func, *args):
+    if pool is None:
+        return defer.maybeDeferred(func, *args)
+    return pool.run(func, *args)
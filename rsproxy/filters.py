@@ -2,15 +2,23 @@
 import base64
 import hashlib
 import hmac
+import os
 import struct
 
-from twisted.internet import reactor
+from twisted.internet import defer
 from twisted.python import log
 
+import filterpool
 import inspect
+import logger
+import metrics
 import parser
+import policy
 import queryfilter
 import setting
+import time
+from cache import ResultCache
+from querystats import query_stats
 
 class UserAuth(object):
     def __init__(self, user):
@@ -22,7 +30,7 @@ class UserAuth(object):
         pw   = crypt_md5(salt, expected_password, self.user)
         result = password == pw
         if result:
-            log.msg('auth ok')
+            logger.info('auth', 'auth ok')
             self.authenticationComplete = True
 
         return result
@@ -33,9 +41,10 @@ def createZMessage(status='E'):
     m.consume(text)
     return m
 
-def createErrorMessage(message, path, line, funcname):
+def createErrorMessage(message, path, line, funcname, severity='FATAL',
+                       code='28000'):
     head = 'E'
-    params = ['S''FATAL', 'C''28000', 
+    params = ['S'+severity, 'C'+code, 
               'M'+message,
               'F'+path,
               'L'+str(line), 
@@ -47,6 +56,70 @@ def createErrorMessage(message, path, line, funcname):
     m.consume(text)
     return m
 
+def _text(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+def createParameterStatusMessage(name, value):
+    body = name + '\x00' + value + '\x00'
+    m = parser.BackendParser()
+    m.consume('S' + struct.pack("!I", len(body) + 4) + body)
+    return m
+
+def createRowDescriptionMessage(names):
+    u"""
+    namesの列のRowDescription。列の型はすべてtext
+    """
+    fields = [_text(name) + '\x00' + struct.pack("!IhIhih", 0, 0, 25, -1, -1, 0)
+              for name in names]
+    body = struct.pack("!h", len(fields)) + ''.join(fields)
+    m = parser.BackendParser()
+    m.consume('T' + struct.pack("!I", len(body) + 4) + body)
+    return m
+
+def createDataRowMessage(values):
+    u"""
+    valuesを文字列にしたDataRow。NoneはNULL
+    """
+    columns = []
+    for value in values:
+        if value is None:
+            columns.append(struct.pack("!i", -1))
+        else:
+            value = _text(value)
+            columns.append(struct.pack("!i", len(value)) + value)
+    body = struct.pack("!h", len(columns)) + ''.join(columns)
+    m = parser.BackendParser()
+    m.consume('D' + struct.pack("!I", len(body) + 4) + body)
+    return m
+
+def createCommandCompleteMessage(tag):
+    m = parser.BackendParser()
+    m.consume('C' + struct.pack("!I", len(tag) + 5) + tag + '\x00')
+    return m
+
+def createAuthenticationMessage(status, extra=''):
+    body = struct.pack("!I", status) + extra
+    m = parser.BackendParser()
+    m.consume('R' + struct.pack("!I", len(body) + 4) + body)
+    return m
+
+def createBackendKeyMessage(pid, key):
+    m = parser.BackendParser()
+    m.consume('K' + struct.pack("!III", 12, pid, key))
+    return m
+
+def createQueryMessage(query):
+    m = parser.FrontendParser()
+    m.consume('Q' + struct.pack("!I", len(query) + 5) + query + '\x00')
+    return m
+
+def createCancelMessage(pid, key):
+    m = parser.FrontendParser()
+    m.consume(struct.pack("!IIII", 16, parser.FrontendParser.Cancel, pid, key))
+    return m
+
 def createStartupMessage(user, database):
     params = ['user', user, 'database', database, '']
     body   =  '\x00'.join(params) + '\x00'
@@ -76,6 +149,29 @@ def createPasswordMessage(password, dbuser, response):
         m.consume(binary)
         return m
 
+# 許可したSELECTの応答のキャッシュ。setting.result_cacheがTrueのときだけ使う。
+# setting.coalesce_queriesがTrueなら、書き込みの追跡(reserve/invalidate)にも使う
+result_cache = ResultCache(setting.result_cache_entries,
+                           setting.result_cache_bytes,
+                           setting.result_cache_ttl)
+
+# 応答待ちのSELECTの(クエリ, ポリシー)と、その応答を待つSharedQuery
+shared_queries = {}
+
+def tracking_results():
+    u"""
+    SELECTの応答を再利用するので、書き込みを追跡するならTrue
+    """
+    return setting.result_cache or setting.coalesce_queries
+
+class SharedQuery(object):
+    u"""
+    応答待ちのSELECTと、同じ応答を待つ他のクライアント(FrontendFilter)
+    """
+    def __init__(self, ticket):
+        self.ticket = ticket
+        self.followers = []
+
 class Filter(object):
     """
     Base class for filters. By default, messages are not altered. To implement
@@ -90,8 +186,16 @@ class Filter(object):
         self.translate(*messages) - In place of msg, return one or more messages
                                     in its place. 
 
+    or a Deferred that fires with one of the above. The protocol holds the
+    messages received after msg until the Deferred has fired, and stops 
+    reading from its transport meanwhile. 
+
     The filter can also call self.spoof(messages) to send replies back to its
-    protocol. These replies are deferred. 
+    protocol. These replies are written when the protocol flushes the
+    output of the current batch. 
+
+    Message types without a filter_<type> method are not parsed at all; 
+    the protocol forwards their raw data to the peer (see passThrough). 
 
     Each protocol (which corresponds to one socket) has one filter associated 
     with it. The protocol using the filter is available via the self.protocol
@@ -102,6 +206,28 @@ class Filter(object):
         self.dropMessages = ''
 
 
+    @classmethod
+    def filteredTypes(cls):
+        """
+        Returns the set of message types that have a filter_<type> method.
+        """
+        types = cls.__dict__.get('_filteredTypes')
+        if types is None:
+            types = frozenset([name[len('filter_'):] for name in dir(cls)
+                               if name.startswith('filter_')])
+            cls._filteredTypes = types
+        return types
+
+
+    def passThrough(self, msgtype):
+        """
+        Returns True if messages of the given type would be transmitted
+        unchanged, so that the protocol can forward their raw data without
+        parsing them.
+        """
+        return not self.dropMessages and msgtype not in self.filteredTypes()
+
+
     def ignoreMessages(self, messageTypes):
         """
         Given a string in which the characters are the sequence of
@@ -141,20 +267,31 @@ class Filter(object):
         """
         Returns a value that will result in the current message being dropped.
         """
-        l = 'Dropping message: %s' % msg
         if why:
-            l += ' because: %s' % why
-        log.msg(l)
+            logger.debug('drop', 'Dropping message: %s because: %s', msg, why)
+        else:
+            logger.debug('drop', 'Dropping message: %s', msg)
         return None, None
 
 
+    def failed(self, msg):
+        """
+        Called when the Deferred returned for msg fails. Returns the value
+        to write in its place; by default the message is dropped.
+        """
+        return self.drop(msg)
+
+
     def spoof(self, messages):
         """
         Sends the provided list of messages back to the protocol's transport. 
+        The messages are written together with the rest of the output of
+        the batch being handled, in the order they were spoofed. 
         """
-        log.msg('Spoofing data: %s' % ''.join(map(str, messages)))
-        data = ''.join([m.serialize() for m in messages])
-        reactor.callLater(0, lambda: self.protocol.transport.write(data))
+        logger.debug('spoof', 'Spoofing data: %s', logger.Joined(messages))
+        transport = self.protocol.transport
+        for m in messages:
+            self.protocol.bufferedWrite(transport, m.serialize())
 
 class FrontendFilter(Filter):
     """
@@ -167,32 +304,56 @@ class FrontendFilter(Filter):
     this work into manageable pieces. 
     
     """
-    # Cache some stock replies for messages that we'll be dropping or 
-    # translating. 
+    # 認証前やバックエンドなしで扱うメッセージ
+    localTypes = frozenset(['Startup', 'SSLRequest', 'Cancel', 'p', 'X'])
+    # 次のSyncのReadyForQueryまでバックエンドを手放せない拡張問い合わせ。
+    # ExecuteとFlushはフィルタを通らないが、トランザクションの外では
+    # 同じSyncの前にBindがある
+    extendedTypes = frozenset(['P', 'B', 'D', 'C', 'E', 'H'])
+
     def __init__(self, protocol):
         Filter.__init__(self, protocol)
+        self.userAuth = None
+        self.database = None
+        # 管理用の仮想データベース(admin)に接続したらTrue
+        self.admin = False
+        # パスワードの確認が済んだらTrue
+        self.authenticated = False
+        # 許可したプリペアドステートメントの名前とSQL
+        self.statements = {}
+        # Parseを拒否してから次のSyncまでTrue
+        self.skipping = False
+        # 最後に受け取ったReadyForQueryのトランザクションの状態
+        self.transactionStatus = 'idle'
+        # プリペアドステートメントの名前と、書き込むテーブル(written_tables)
+        self.statementWrites = {}
+        # トランザクションが終わったらもう一度invalidateするテーブル
+        self.pendingWrites = []
+        # 他のクライアントのSELECTの応答を待っているときは、その結果。
+        # 失敗したらNone
+        self.sharedResult = None
+        # filterpoolの判定を待っている間はTrue。その間はバックエンドを
+        # 手放さない(PostgresClientProtocol.releaseIfIdle)
+        self.checking = False
+        # 拡張問い合わせのメッセージを送ってからSyncを送るまでTrue。
+        # その間もバックエンドを手放さない
+        self.unsynced = False
 
     def filter_Startup(self, msg):
         """
         スタートアップコマンド。
+
+        クライアントの認証はプロキシで行なう。バックエンドはプールにある
+        認証済みのものを使う
         """
         params = msg.parseDict()
         self.userAuth = UserAuth(params['user'])
-        pg = self.protocol.postgresProtocol
-
-        #クエリフィルターの作成
-        cond = "app='%s'" % params['user']
-        self.queryfilter = queryfilter.QueryFilter([cond], ['dau', 'sales_log', 'sales_person', 'person_app_data', 'logintime'])
-        #バックエンドの認証が終わっていれば、バックエンドには何も送らない
-        if pg.authenticationComplete:
-            self.spoof(pg.authenticationResponse[0:1])
-            return self.drop(msg)
-
-        #バックエンドの認証開始
-        nmsg = createStartupMessage(setting.dbuser,
-                                    params['database'])
-
-        return self.transmit(nmsg)
+        self.database = params.get('database', params['user'])
+        self.admin = (setting.admin_database is not None and
+                      self.database == setting.admin_database)
+        self.authRequest = createAuthenticationMessage(5, os.urandom(4))
+        self.spoof([self.authRequest])
+        return self.drop(msg)
 
     def filter_SSLRequest(self, msg):
         #SSLモードは無しにする
@@ -205,27 +366,98 @@ class FrontendFilter(Filter):
         u"""
         PasswordMessage
         """
-        pg = self.protocol.postgresProtocol
-        if self.userAuth:
-            password = msg.password
-            authmsg = pg.authenticationResponse[0]
-            # frontend user authentication
-            if not self.userAuth.auth(password, authmsg):
-                # Frontend認証失敗。エラーメッセージを返して切断
-                user = self.userAuth.user
-                errorMsg = createErrorMessage('password authentication failed for user "%s"' % user,
-                                              __file__,
-                                              inspect.currentframe().f_lineno,
-                                              'filter_p'
-                                              )
-                self.spoof([errorMsg])
-                return self.drop(msg)
-            else:
-                # Frontend認証成功。認証メッセージをすべて送る
-                self.spoof(pg.authenticationResponse[1:])
+        if self.userAuth and self.userAuth.auth(msg.password, self.authRequest):
+            if self.admin:
+                return self._adminAuthenticated(msg)
+            # Frontend認証成功。バックエンドのパラメータを送る
+            pool = self.protocol.pool()
+            if pool.parameterStatus is not None:
+                return self._authenticated(pool.parameterStatus, msg)
+            d = pool.parameters()
+            return d.addCallbacks(self._authenticated, self._noParameters,
+                                  callbackArgs=(msg,), errbackArgs=(msg,))
+
+        # Frontend認証失敗。エラーメッセージを返して切断
+        user = self.userAuth.user if self.userAuth else ''
+        errorMsg = createErrorMessage('password authentication failed for user "%s"' % user,
+                                      __file__,
+                                      inspect.currentframe().f_lineno,
+                                      'filter_p'
+                                      )
+        self.spoof([errorMsg])
+        self.disconnect()
+        return self.drop(msg)
 
+    def _authenticated(self, parameters, msg):
+        self.authenticated = True
+        self.spoof([createAuthenticationMessage(0)] + list(parameters) +
+                   [createBackendKeyMessage(*self.protocol.cancelKey),
+                    createZMessage('I')])
         return self.drop(msg)
 
+    def _adminAuthenticated(self, msg):
+        import admin
+        if self.userAuth.user in setting.admin_users:
+            return self._authenticated(admin.parameters(), msg)
+        errorMsg = createErrorMessage('permission denied for database "%s"' % self.database,
+                                      __file__,
+                                      inspect.currentframe().f_lineno,
+                                      'filter_p'
+                                      )
+        self.spoof([errorMsg])
+        self.disconnect()
+        return self.drop(msg)
+
+    def filterAdmin(self, msg):
+        u"""
+        管理用の仮想データベースへのメッセージ。単純問い合わせにだけ答え、
+        拡張問い合わせはエラーにしてSyncまで捨てる
+        """
+        import admin
+        if msg.type == 'Q':
+            self.spoof(admin.execute(self.protocol.factory, msg.data[:-1]) +
+                       [createZMessage('I')])
+        elif msg.type == 'S':
+            self.spoof([createZMessage('I')])
+        else:
+            self.spoof([admin.error('the admin console only answers simple queries',
+                                    '0A000')])
+            self.skipping = True
+        return self.drop(msg)
+
+    def _noParameters(self, failure, msg):
+        log.err(failure, 'No backend for %s' % self.database)
+        errorMsg = createErrorMessage('could not connect to the server',
+                                      __file__,
+                                      inspect.currentframe().f_lineno,
+                                      'filter_p'
+                                      )
+        self.spoof([errorMsg])
+        self.disconnect()
+        return self.drop(msg)
+
+    def filter_Cancel(self, msg):
+        u"""
+        CancelRequest。キーに対応するクライアントのバックエンドに送る
+        """
+        self.protocol.factory.cancel(msg.pid, msg.key)
+        self.disconnect()
+        return self.drop(msg)
+
+    def needsBackend(self, msgtype):
+        u"""
+        msgtypeのメッセージをバックエンドに送るならTrue
+        """
+        return (self.authenticated and not self.admin and
+                msgtype not in self.localTypes)
+
+    def disconnect(self):
+        u"""
+        それまでに返したメッセージを送ってから切断する
+        """
+        self.protocol.flush()
+        self.protocol.transport.loseConnection()
+
     def _ignoreBackendMessages(self, messageTypes):
         """
         Tells the backend to ignore the given set of message replies. 
@@ -249,48 +481,384 @@ class FrontendFilter(Filter):
 
     def filter_P(self, msg):
         u"""
-        プリペアドステートメントは許可しない
+        Parse。SQLはステートメント名ごとに一度だけフィルタリングする
+
+        許可したステートメントはself.statementsに記録する。Bind/Execute等は
+        フィルタリングせずにそのまま送る
         """
-        user = self.userAuth.user
-        zMsg     = createZMessage()
-        errorMsg = createErrorMessage('query authentication failed for user "%s"' % user,
-                                      __file__,
-                                      inspect.currentframe().f_lineno,
-                                      'filter_P'
-                                      )
-        self.spoof([zMsg, errorMsg])
+        if self.statements.get(msg.name) == msg.query:
+            return self.transmit(msg)
+        self.statements.pop(msg.name, None)
+        results = self.checkQuery(msg.query)
+        if isinstance(results, defer.Deferred):
+            self.checking = True
+            return results.addCallback(self._parseFiltered, msg)
+        return self._parseFiltered(results, msg)
+
+    def _parseFiltered(self, results, msg):
+        self.checking = False
+        if allowed(results):
+            metrics.filteredQueries.inc(('P', 'accepted'))
+            self.statements[msg.name] = msg.query
+            if tracking_results():
+                self.statementWrites[msg.name] = \
+                    queryfilter.written_tables(msg.query)
+            return self.transmit(msg)
+        # バックエンドと同じく、エラーの後はSyncまでのメッセージを捨てる。
+        # Syncはバックエンドに送り、ReadyForQueryはバックエンドが返す
+        metrics.filteredQueries.inc(('P', 'rejected'))
+        self.skipping = True
+        self.rejectQuery('filter_P')
         return self.drop(msg)
 
+    def filter_C(self, msg):
+        u"""
+        Close。閉じたステートメントを忘れる
+        """
+        if msg.kind == 'prepared':
+            self.statements.pop(msg.name, None)
+            self.statementWrites.pop(msg.name, None)
+        return self.transmit(msg)
+
+    def forgetStatement(self, name):
+        self.statements.pop(name, None)
+        self.statementWrites.pop(name, None)
+
+    def filter_B(self, msg):
+        u"""
+        Bind。このクライアントが許可を得ていないステートメントは拒否する。
+        他のクライアントがバックエンドに残したステートメントも使わせない
+        """
+        if msg.name in self.statements:
+            return self.transmit(msg)
+        return self.rejectStatement(msg, 'filter_B')
+
+    def filter_D(self, msg):
+        u"""
+        Describe。ステートメントはBindと同じく確かめる
+        """
+        if msg.kind != 'prepared' or msg.name in self.statements:
+            return self.transmit(msg)
+        return self.rejectStatement(msg, 'filter_D')
+
+    def rejectStatement(self, msg, funcname):
+        u"""
+        _parseFilteredの拒否と同じく、エラーを返してSyncまで捨てる
+        """
+        self.skipping = True
+        self.rejectQuery(funcname)
+        return self.drop(msg, 'unknown statement')
+
+    def filter(self, msg):
+        if not self.authenticated and msg.type not in self.localTypes:
+            self.spoof([createErrorMessage('not authenticated', __file__,
+                                           inspect.currentframe().f_lineno,
+                                           'filter')])
+            self.disconnect()
+            return self.drop(msg, 'not authenticated')
+        if self.skipping:
+            if msg.type != 'S':
+                return self.drop(msg, 'skipping until Sync')
+            self.skipping = False
+        if self.admin and msg.type not in self.localTypes:
+            return self.filterAdmin(msg)
+        if msg.type in self.extendedTypes:
+            self.unsynced = True
+        return Filter.filter(self, msg)
+
+    def passThrough(self, msgtype):
+        return (self.authenticated and not self.skipping and
+                not self.admin and Filter.passThrough(self, msgtype))
+
+    def filter_S(self, msg):
+        u"""
+        Sync。ReadyForQueryが返るまでバックエンドをプールに返さない
+
+        どのステートメントを実行したかはわからないので、書き込む
+        ステートメントがあれば、そのテーブルの結果のキャッシュを捨てる
+        """
+        self.unsynced = False
+        entry = self.protocol.postgresProtocol.expectReady(self.protocol)
+        entry.completed.append(self._readyForQuery)
+        for tables in self.statementWrites.values():
+            if tables is None or tables:
+                self.invalidate(tables)
+        return self.transmit(msg)
+
     def filter_Q(self, msg):
         u"""
         SQLのフィルタリング
         """
-        query = msg.data[:-1]
-        result, = self.queryfilter.filter_query_string(query)
-        if result[0]:
+        # 単純問い合わせは名前のないステートメントを破棄する
+        self.statements.pop('', None)
+        self.statementWrites.pop('', None)
+        results = self.checkQuery(msg.data[:-1])
+        if isinstance(results, defer.Deferred):
+            self.checking = True
+            return results.addCallback(self._queryFiltered, msg)
+        return self._queryFiltered(results, msg)
+
+    def _queryFiltered(self, results, msg):
+        u"""
+        すべての文が許可されていればmsgを送る。そうでなければエラーを返す
+        """
+        self.checking = False
+        if self.protocol.postgresProtocol is None:
+            # 判定を待つ間にバックエンドが切れた(クライアントも切断する)
+            return self.failed(msg)
+        if allowed(results):
+            metrics.filteredQueries.inc(('Q', 'accepted'))
+            entry = self.protocol.postgresProtocol.expectReady(self.protocol)
+            entry.completed.append(self._readyForQuery)
+            if tracking_results():
+                self.watchQuery(entry, msg.data[:-1])
+            if setting.query_stats or setting.slow_query_threshold is not None:
+                self.recordQuery(entry, msg.data[:-1])
             return self.transmit(msg)
         else:
-            user = self.userAuth.user
-            zMsg     = createZMessage()
-            errorMsg = createErrorMessage('query authentication failed for user "%s"' % user,
-                                          __file__,
-                                          inspect.currentframe().f_lineno,
-                                          'filter_Q'
-                                          )
-            self.spoof([zMsg, errorMsg])
+            metrics.filteredQueries.inc(('Q', 'rejected'))
+            if setting.query_stats:
+                query_stats.reject(query_stats.template(msg.data[:-1]),
+                                   self.userAuth.user)
+            self.rejectQuery('filter_Q', createZMessage())
+            self.protocol.postgresProtocol.releaseIfIdle(self.protocol)
             return self.drop(msg)
 
+    def recordQuery(self, entry, query):
+        u"""
+        entryの応答が終わったら、かかった時間と行数をquery_statsに記録し、
+        slow_query_threshold秒以上かかっていればログに書く
+        """
+        user = self.userAuth.user
+        def completed(status, data):
+            if status is None:
+                # バックエンドが切れた
+                return
+            elapsed = time.time() - entry.sent
+            if setting.query_stats:
+                query_stats.record(query_stats.template(query), user,
+                                   elapsed, entry.rows, entry.bytes)
+            threshold = setting.slow_query_threshold
+            if threshold is not None and elapsed >= threshold:
+                logger.warning('slow', 'slow query: %.3fs %d rows user=%s %s',
+                               elapsed, entry.rows, user, query)
+        entry.completed.append(completed)
+
+    def failed(self, msg):
+        u"""
+        判定に失敗したメッセージは拒否する。Queryにはエラーと
+        ReadyForQueryを返し、拡張問い合わせはSyncまで捨てる
+        """
+        self.checking = False
+        if msg.type == 'Q':
+            self.rejectQuery('failed', createZMessage())
+            pg = self.protocol.postgresProtocol
+            if pg is not None:
+                pg.releaseIfIdle(self.protocol)
+        elif msg.type in ('P', 'B', 'D'):
+            self.skipping = True
+            self.rejectQuery('failed')
+        return self.drop(msg)
+
+    def _readyForQuery(self, status, data):
+        self.transactionStatus = status
+        if status == 'idle' and self.pendingWrites:
+            # コミットより前に読んだ結果がキャッシュされているかもしれない
+            for tables in self.pendingWrites:
+                result_cache.invalidate(tables)
+            self.pendingWrites = []
+
+    def invalidate(self, tables):
+        u"""
+        tablesの結果のキャッシュを捨てる。トランザクションが終わったら
+        もう一度捨てる。tablesがNoneならすべて
+        """
+        result_cache.invalidate(tables)
+        self.pendingWrites.append(tables)
+
+    def watchQuery(self, entry, query):
+        u"""
+        書き込むクエリならキャッシュを捨てる。トランザクションの外の
+        SELECTなら、応答をキャッシュし、同じSELECTを送ってきた他の
+        クライアントにも返す
+        """
+        tables = queryfilter.written_tables(query)
+        if tables is None or tables:
+            self.invalidate(tables)
+            return
+        if (self.transactionStatus != 'idle' or
+            not queryfilter.is_single_select(query)):
+            return
+        table = queryfilter.select_table(query)
+        key = self.resultKey(query)
+        if table is None or key is None:
+            return
+        ticket = result_cache.reserve(key, table)
+        shared = None
+        if setting.coalesce_queries:
+            shared = shared_queries[key] = SharedQuery(ticket)
+        def completed(status, data):
+            if status == 'idle' and data is not None:
+                data = ''.join(data)
+                if setting.result_cache:
+                    result_cache.store(ticket, data)
+            else:
+                data = None
+            if shared is not None:
+                if shared_queries.get(key) is shared:
+                    del shared_queries[key]
+                for follower in shared.followers:
+                    follower.sharedQueryCompleted(data)
+        entry.capture = []
+        entry.completed.append(completed)
+
+    def resultKey(self, query):
+        u"""
+        queryの応答のキャッシュ(と共有)のキー。同じ応答になるのは、同じ
+        データベースとサーバー(シャード)への、同じポリシーで許可したクエリ
+        """
+        qf = policy.registry.lookup(self.userAuth.user)
+        if qf is None:
+            return None
+        return (query, self.database, self.protocol.shard(), qf.identity)
+
+    def canReuseResult(self):
+        u"""
+        他のクエリの応答を返してよければTrue。応答待ちのクエリがあるときは、
+        トランザクションの状態がわからないので使わない
+        """
+        if not (self.authenticated and not self.skipping and
+                not self.admin and self.transactionStatus == 'idle'):
+            return False
+        pg = self.protocol.postgresProtocol
+        return pg is None or not pg.inflightOf(self.protocol)
+
+    def answerFromCache(self, msg):
+        u"""
+        単純問い合わせの結果がキャッシュにあれば、それを返してTrue
+        """
+        if not (setting.result_cache and self.canReuseResult()):
+            return False
+        key = self.resultKey(msg.data[:-1])
+        data = key and result_cache.get(key)
+        if data is None:
+            return False
+        logger.debug('cache', 'Answering from the result cache: %s', msg)
+        self.replyWithResult(data)
+        return True
+
+    def replyWithResult(self, data):
+        self.statements.pop('', None)
+        self.statementWrites.pop('', None)
+        self.protocol.bufferedWrite(self.protocol.transport,
+                                    data + createZMessage('I').serialize())
+
+    def joinSharedQuery(self, msg):
+        u"""
+        同じSELECTの応答を待っていれば、その応答を待ってTrue。
+        それまでに受け取ったメッセージはその後に扱う
+
+        同じテーブルへの書き込みの後に送られたSELECTでなければ待たない
+        """
+        if not (setting.coalesce_queries and self.canReuseResult()):
+            return False
+        key = self.resultKey(msg.data[:-1])
+        shared = key and shared_queries.get(key)
+        if shared is None or not result_cache.valid(shared.ticket):
+            return False
+        logger.debug('cache', 'Waiting for the same query of another client: %s',
+                     msg)
+        shared.followers.append(self)
+        self.protocol.holdMessages('shared query',
+                                   (self._sharedQueryReply, msg))
+        return True
+
+    def sharedQueryCompleted(self, data):
+        self.sharedResult = data
+        self.protocol.releaseMessages('shared query')
+
+    def _sharedQueryReply(self, msg):
+        data, self.sharedResult = self.sharedResult, None
+        if not self.protocol.connected:
+            return None
+        if data is None:
+            # 失敗したので、このクライアントのクエリとして送り直す
+            return self.protocol.messageReceived(msg)
+        self.replyWithResult(data)
+
+    def checkQuery(self, query):
+        u"""
+        queryの各文の判定結果のリストを返す
+
+        ポリシー(policy.registry)はクエリごとに引くので、再読み込みすると
+        次のクエリから新しいポリシーになる。
+        判定結果がキャッシュになく、長いクエリはfilterpoolで判定し、
+        判定結果のリストでcallbackされるDeferredを返す
+        """
+        qf = policy.registry.lookup(self.userAuth.user)
+        if qf is None:
+            return []
+        results = qf.cached_verdicts(query)
+        if results is None:
+            if filterpool.offloads(query):
+                d = filterpool.run(queryfilter.check_query_string, query,
+                                   qf.expected_conditions, qf.tables)
+                d.addCallback(self._storeVerdicts, qf, query)
+                d.addErrback(self._queryCheckFailed)
+                return d
+            results = qf.filter_query_string(query)
+        return results
+
+    def _storeVerdicts(self, results, qf, query):
+        qf.store_verdicts(query, results)
+        return results
+
+    def _queryCheckFailed(self, failure):
+        log.err(failure, 'Query check failed')
+        return []
+
+    def rejectQuery(self, funcname, *messages):
+        u"""
+        クエリを拒否したエラーをクライアントに返す。messagesはその後に返す
+
+        先に送ったクエリの応答がまだなら、その後に返す
+        """
+        user = self.userAuth.user
+        errorMsg = createErrorMessage('query authentication failed for user "%s"' % user,
+                                      __file__,
+                                      inspect.currentframe().f_back.f_lineno,
+                                      funcname
+                                      )
+        messages = [errorMsg] + list(messages)
+        pg = self.protocol.postgresProtocol
+        if pg is not None and pg.inflight:
+            logger.debug('spoof', 'Spoofing data after replies in flight: %s',
+                         logger.Joined(messages))
+            pg.replyAfter(self.protocol,
+                          ''.join([m.serialize() for m in messages]))
+        else:
+            self.spoof(messages)
+
+def allowed(results):
+    u"""
+    checkQueryの結果で、すべての文が許可されていればTrue
+    """
+    return bool(results) and all(result[0] for result in results)
+
 class BackendFilter(Filter):
     """
     Filters the messages coming from the PG server to the client. 
     """    
     def saveAuth(self, msg):
         """
-        Saves authentication response messages from the backend. These will be
-        sent to new frontends without actually re-authenticating. 
+        Saves authentication response messages from the backend. Clients
+        authenticate with the proxy, which sends them the saved 
+        ParameterStatus messages instead. 
         """
+        if self.protocol.authenticationComplete:
+            return self.transmit(msg)
         self.protocol.saveAuthMessage(msg)
-        return self.transmit(msg)
+        return None, None
 
     def filter_R(self, msg):
         # バックエンドの認証を行なう部分
@@ -298,13 +866,22 @@ class BackendFilter(Filter):
         if msg.status==5:
             pg = self.protocol
             nmsg = createPasswordMessage(setting.dbpassword, setting.dbuser, [msg])
-            log.msg('send %s' % nmsg)
+            logger.debug('auth', 'send %s', nmsg)
             self.spoof([nmsg])
 
         return self.saveAuth(msg)
 
     filter_S = saveAuth
-    filter_K = saveAuth
+
+    def filter_K(self, msg):
+        self.protocol.backendKey = (msg.pid, msg.key)
+        return self.saveAuth(msg)
+
+    def filter_E(self, msg):
+        if not self.protocol.authenticationComplete:
+            self.protocol.authenticationFailed(msg)
+            return self.drop(msg)
+        return self.transmit(msg)
 
     def filter_Z(self, msg):
         """
@@ -313,5 +890,6 @@ class BackendFilter(Filter):
         self.protocol.setTransactionStatus(msg.transaction_status)
         if not self.protocol.authenticationComplete:
             self.protocol.saveAuthMessage(msg)
+            self.protocol.authenticated()
+            return None, None
         return self.transmit(msg)
-
@@ -0,0 +1,189 @@
+"""
+Leveled, sampled logging with lazy formatting, on top of twisted.python.log.
+
+    logger.debug('recv', 'recv %s', Joined(messages))
+
+logs only if DEBUG is at or above the configured level and the 'recv'
+category is not sampled out. The text is formatted from the format and
+arguments only when the event is written, so a disabled call costs a
+comparison, and an enabled one little more than log.msg with a constant.
+Arguments are formatted later, so they should not be changed after the
+call.
+
+The levels are DEBUG, INFO and WARNING; errors are still logged with
+log.err. setting.log_sampling maps categories to the fraction of their
+messages to keep.
+
+start() writes the log from a background thread, so that file I/O, for
+log.msg and log.err as well, does not run on the reactor thread, and
+neither does the formatting of the messages of this module. At most setting.log_queue_size events wait to be written; events
+beyond that are counted and dropped rather than blocking the caller.
+
+"""
+import atexit
+import random
+import threading
+import Queue
+
+from twisted.python import log
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+
+LEVELS = {'DEBUG': DEBUG, 'INFO': INFO, 'WARNING': WARNING}
+
+threshold = INFO
+sampling = {}
+
+
+
+def configure(level, rates):
+    """
+    Sets the level (a name in LEVELS) below which messages are dropped,
+    and the sampling rate of each category.
+    """
+    global threshold, sampling
+    if level not in LEVELS:
+        raise ValueError('unknown log level: %r' % (level,))
+    threshold = LEVELS[level]
+    sampling = dict(rates)
+
+
+def enabled(level, category):
+    """
+    Returns True if a message of level and category would be logged now.
+    """
+    if level < threshold:
+        return False
+    rate = sampling.get(category)
+    return rate is None or random.random() < rate
+
+
+def debug(category, format, *args):
+    if DEBUG >= threshold:
+        _emit(DEBUG, category, format, args)
+
+
+def info(category, format, *args):
+    if INFO >= threshold:
+        _emit(INFO, category, format, args)
+
+
+def warning(category, format, *args):
+    if WARNING >= threshold:
+        _emit(WARNING, category, format, args)
+
+
+def _emit(level, category, format, args):
+    rate = sampling.get(category)
+    if rate is not None and random.random() >= rate:
+        return
+    message = Message(format, args)
+    # Given a log_format, twisted.logger leaves the formatting to the
+    # observers instead of doing it as the event is published. The levels
+    # are those of the logging module.
+    log.msg(message, log_format=u'{log_message}', log_message=message,
+            logLevel=level, category=category)
+
+
+
+class Message(object):
+    """
+    A log message formatted when it is written.
+    """
+    __slots__ = ['format', 'args']
+
+    def __init__(self, format, args):
+        self.format = format
+        self.args = args
+
+
+    def __str__(self):
+        if self.args:
+            return self.format % self.args
+        return self.format
+
+
+
+class Joined(object):
+    """
+    Formats as the concatenation of the str of each item.
+    """
+    __slots__ = ['items']
+
+    def __init__(self, items):
+        self.items = items
+
+
+    def __str__(self):
+        return ''.join(map(str, self.items))
+
+
+
+class ThreadedLogObserver(log.FileLogObserver):
+    """
+    A FileLogObserver that writes from a background thread. The file is
+    flushed whenever the thread has caught up.
+    """
+
+    def __init__(self, f, queueSize=0):
+        log.FileLogObserver.__init__(self, f)
+        self._flushFile = self.flush
+        self.flush = lambda: None
+        self.queue = Queue.Queue(queueSize)
+        self.dropped = 0
+        self.thread = threading.Thread(target=self._run,
+                                       name='rsproxy log writer')
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def emit(self, eventDict):
+        try:
+            self.queue.put_nowait(eventDict)
+        except Queue.Full:
+            self.dropped += 1
+
+
+    def stop(self):
+        """
+        Writes out the queued events and stops the thread.
+        """
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+
+    def _run(self):
+        write = log.FileLogObserver.emit
+        while True:
+            eventDict = self.queue.get()
+            if eventDict is None:
+                self._flushFile()
+                return
+            if self.dropped:
+                dropped, self.dropped = self.dropped, 0
+                write(self, {'message': ('%d log events dropped.' % dropped,),
+                             'isError': 0, 'system': '-',
+                             'time': eventDict['time']})
+            try:
+                write(self, eventDict)
+            except:
+                # An event that cannot be formatted must not stop the
+                # writer.
+                pass
+            if self.queue.empty():
+                self._flushFile()
+
+
+
+def start(f, queueSize=0):
+    """
+    Starts logging to the file f from a background thread. Returns the
+    observer.
+    """
+    observer = ThreadedLogObserver(f, queueSize)
+    log.startLoggingWithObserver(observer.emit)
+    atexit.register(observer.stop)
+    return observer
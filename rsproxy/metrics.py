@@ -0,0 +1,267 @@
+"""
+In-process metrics, served in the Prometheus text format.
+
+Metrics are kept in plain dictionaries keyed by the tuple of their label
+values. They are only updated from the reactor thread, so they need no
+locks, and the labels are only turned into text when the metrics are
+scraped. Gauges whose values are elsewhere (pools, caches) are computed
+at scrape time by a callback.
+
+    messages, messageBytes - protocol messages received, by sender
+                             ('client' or 'backend') and message type.
+                             Pieces of streamed messages count as bytes
+                             of type 'partial'.
+
+    queryDuration          - seconds from sending a Query or Sync to a
+                             backend to its ReadyForQuery, by database.
+
+    filteredQueries        - queries checked by the filter, by message
+                             type ('Q' or 'P') and result.
+
+If setting.metrics_port is set, the metrics are served at /metrics on that
+port of setting.metrics_interface, and the statistics of querystats at
+/queries.
+
+"""
+from bisect import bisect_left
+
+from twisted.web import resource, server
+
+import engine
+from querystats import QueryStatsResource
+
+
+
+def _escape(value):
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def _format(name, labels, key, value, extra=None):
+    pairs = ['%s="%s"' % (label, _escape(v)) for label, v in zip(labels, key)]
+    if extra is not None:
+        pairs.append('%s="%s"' % extra)
+    if pairs:
+        name = '%s{%s}' % (name, ','.join(pairs))
+    return '%s %s' % (name, _number(value))
+
+
+def _number(value):
+    if isinstance(value, float):
+        if value == float('inf'):
+            return '+Inf'
+        return repr(value)
+    return str(value)
+
+
+
+class Metric(object):
+    """
+    Base class of the metrics. values maps tuples of label values, in the
+    order of labels, to the metric's value.
+    """
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+
+
+    def lines(self):
+        """
+        Returns the lines of the text format for this metric.
+        """
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s %s' % (self.name, self.type)]
+        for key, value in sorted(self.collect().items()):
+            lines.extend(self.sampleLines(key, value))
+        return lines
+
+
+    def collect(self):
+        return self.values
+
+
+    def sampleLines(self, key, value):
+        return [_format(self.name, self.labels, key, value)]
+
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, key=(), amount=1):
+        values = self.values
+        values[key] = values.get(key, 0) + amount
+
+
+
+class Gauge(Metric):
+    """
+    A gauge set with set, or computed by callback, which returns the
+    values dictionary, at each scrape.
+    """
+    type = 'gauge'
+
+    def __init__(self, name, help, labels=(), callback=None):
+        Metric.__init__(self, name, help, labels)
+        self.callback = callback
+
+
+    def set(self, key, value):
+        self.values[key] = value
+
+
+    def collect(self):
+        if self.callback is not None:
+            return self.callback()
+        return self.values
+
+
+
+class Histogram(Metric):
+    """
+    Counts observations in buckets with the given upper bounds. The value
+    of each key is [count per bucket, sum, count].
+    """
+    type = 'histogram'
+    defaultBuckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                      0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self, name, help, labels=(), buckets=None):
+        Metric.__init__(self, name, help, labels)
+        self.buckets = tuple(buckets or self.defaultBuckets)
+
+
+    def observe(self, key, value):
+        entry = self.values.get(key)
+        if entry is None:
+            entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+
+    def sampleLines(self, key, value):
+        counts, total, count = value
+        lines = []
+        cumulative = 0
+        for bound, n in zip(self.buckets + (float('inf'),), counts):
+            cumulative += n
+            lines.append(_format(self.name + '_bucket', self.labels, key,
+                                 cumulative, ('le', _number(float(bound)))))
+        lines.append(_format(self.name + '_sum', self.labels, key, total))
+        lines.append(_format(self.name + '_count', self.labels, key, count))
+        return lines
+
+
+
+class Registry(object):
+    """
+    The metrics to serve, in order of registration.
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+
+    def gauge(self, name, help, labels=(), callback=None):
+        return self.register(Gauge(name, help, labels, callback))
+
+
+    def histogram(self, name, help, labels=(), buckets=None):
+        return self.register(Histogram(name, help, labels, buckets))
+
+
+    def exposition(self):
+        """
+        Returns all metrics in the Prometheus text format.
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.lines())
+        return '\n'.join(lines) + '\n'
+
+
+
+registry = Registry()
+
+messages = registry.counter(
+    'rsproxy_messages_total',
+    'Protocol messages received, by sender and message type.',
+    ('sender', 'type'))
+messageBytes = registry.counter(
+    'rsproxy_message_bytes_total',
+    'Bytes of protocol messages received, by sender and message type.',
+    ('sender', 'type'))
+queryDuration = registry.histogram(
+    'rsproxy_query_duration_seconds',
+    'Time from sending a query to a backend to its ReadyForQuery.',
+    ('database',))
+filteredQueries = registry.counter(
+    'rsproxy_filtered_queries_total',
+    'Queries checked by the query filter, by message type and result.',
+    ('type', 'result'))
+clients = registry.gauge(
+    'rsproxy_clients',
+    'Client connections.')
+backends = registry.gauge(
+    'rsproxy_backends',
+    'Backend connections, by database and state.',
+    ('database', 'state'))
+waiting = registry.gauge(
+    'rsproxy_waiting_clients',
+    'Clients waiting for a backend, by database.',
+    ('database',))
+
+
+def countMessages(sender, msgtype, count, size):
+    """
+    Adds count messages of msgtype, of size bytes in total, received from
+    sender. A msgtype of None stands for pieces of streamed messages.
+    """
+    if msgtype is None:
+        messageBytes.inc((sender, 'partial'), size)
+        return
+    key = (sender, msgtype)
+    messages.inc(key, count)
+    messageBytes.inc(key, size)
+
+
+
+class MetricsResource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, registry):
+        resource.Resource.__init__(self)
+        self.registry = registry
+
+
+    def render_GET(self, request):
+        request.setHeader('Content-Type', 'text/plain; version=0.0.4')
+        return self.registry.exposition()
+
+
+
+def listen(port, interface='127.0.0.1', reusePort=False):
+    """
+    Serves registry at /metrics, and the query statistics at /queries, on
+    port. Returns the listening port.
+    """
+    root = resource.Resource()
+    root.putChild('metrics', MetricsResource(registry))
+    root.putChild('queries', QueryStatsResource())
+    site = server.Site(root)
+    site.noisy = False
+    return engine.listen(port, site, reusePort, interface)
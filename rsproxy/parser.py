@@ -17,7 +17,10 @@ class Buffer(object):
         self.buf = '' if data is None else data
         self.pos = 0
     def append(self, data):
-        self.buf += data
+        if self.buf:
+            self.buf += data
+        else:
+            self.buf = data
     def reset(self):
         self.pos = 0
     def get_char(self):
@@ -53,6 +56,28 @@ class Parser(object):
         self.parsed_header = False
         self.type = ''
         self.length = -1
+    @classmethod
+    def frame_header(cls, buf, pos, end):
+        u"""
+        buf[pos:end]の先頭にあるメッセージの(type, length)を返す。
+        ヘッダが揃っていなければNone
+        """
+        if end - pos < 5:
+            return None
+        t = buf[pos]
+        if t:
+            return chr(t), unpack_int32_from(buf, pos + 1)[0] + 1
+        return cls.special_frame_header(buf, pos, end)
+    @classmethod
+    def special_frame_header(cls, buf, pos, end):
+        u"""
+        Frontend/Backendで実装
+        """
+        cls.raise_unknown_frame(buf, pos)
+    @classmethod
+    def raise_unknown_frame(cls, buf, pos):
+        raise ValueError(
+            'Unknown %s packet: %r' % (cls.__name__, str(buf[pos:pos + 200])))
     def consume(self, data):
         self.buffer.append(data)
 
@@ -107,6 +132,21 @@ class Parser(object):
 class FrontendParser(Parser):
     Cancel = 80877102
     SSLRequest = 80877103
+    @classmethod
+    def special_frame_header(cls, buf, pos, end):
+        if end - pos < 8:
+            return None
+        length = unpack_int16_from(buf, pos + 2)[0]
+        code = unpack_int32_from(buf, pos + 4)[0]
+        if length < 8:
+            cls.raise_unknown_frame(buf, pos)
+        elif code == FrontendParser.Cancel:
+            return 'Cancel', length
+        elif code == FrontendParser.SSLRequest:
+            return 'SSLRequest', length
+        elif (code >> 16) == 3 and (code & 0xffff) < 2:
+            return 'Startup', length
+        cls.raise_unknown_frame(buf, pos)
     def parse_Startup(self):
         self.parameters = self.parseDict()
     def parse_Cancel(self):
@@ -114,6 +154,12 @@ class FrontendParser(Parser):
         self.key = self.buffer.get_int32()
     def parse_C(self):
         self.kind = 'prepared' if self.buffer.get_char() == 'S' else 'portal'
+        self.name = self.buffer.remainder()[:-1]
+    def parse_P(self):
+        self.name, self.query = self.data.split('\x00', 2)[:2]
+    def parse_B(self):
+        self.portal, self.name = self.data.split('\x00', 2)[:2]
+    parse_D = parse_C
     def parse_p(self):
         self.password = self.buffer.remainder()[:-1]
     def parse_special_header(self):
@@ -139,6 +185,8 @@ class FrontendParser(Parser):
         return (code >> 16) == 3 and (code & 0xffff) < 2
     def str_Q(self):
         return 'Q %s' % self.data[:-1]
+    def str_P(self):
+        return 'P[%s] %s' % (self.name, self.query)
 
 class BackendParser(Parser):
     def parse_R(self):
@@ -152,6 +200,19 @@ class BackendParser(Parser):
             }.get(self.buffer.get_char())
     def parse_S(self):
         self.name, self.value = self.data.split('\x00')[:2]
+    def parse_K(self):
+        self.pid = self.buffer.get_int32()
+        self.key = self.buffer.get_int32()
+    def parse_D(self):
+        self.values = []
+        for i in range(self.buffer.get_int16()):
+            length = self.buffer.get_int32()
+            if length == 0xffffffff:
+                self.values.append(None)
+                continue
+            pos = self.buffer.pos
+            self.values.append(self.buffer.buf[pos:pos + length])
+            self.buffer.pos = pos + length
     def parse_E(self):
         code = ord(self.buffer.get_char())
         self.fields = []
@@ -167,6 +228,121 @@ class BackendParser(Parser):
     def str_E(self):
         return 'E - %r' % self.fields
 
+class Framer(object):
+    u"""
+    受信データをメッセージ単位に切り出す。
+
+    受信データはひとつのbytearrayに追記していき、読み終わった位置(pos)だけを
+    進める。読み終わった部分が半分を超えたら先頭に詰めるので、コピーは
+    受信バイト数に比例する。bufのend以降は空き領域で、recv_into()は
+    ソケットからそこへ直接受信する。
+
+    Usage:
+    framer = Framer(BackendParser)
+    framer.feed(data)           # または framer.recv_into(sock, 65536)
+    for msgtype, frame in framer:
+        ...
+
+    frameはbytearrayに対するmemoryviewで、次のfeed()までしか有効でない。
+    保持する場合はframe.tobytes()でコピーすること。
+
+    chunk_sizeより長いメッセージは、frames()にpassThroughを渡すと
+    全体が届くのを待たずに届いた分ずつ返す(ストリーミング)。
+    """
+    def __init__(self, messageType, chunk_size=None):
+        self.messageType = messageType
+        self.chunk_size = chunk_size
+        self.buf = bytearray()
+        self.pos = 0
+        # 受信したデータの終わり
+        self.end = 0
+        # ストリーミング中のメッセージの残りバイト数
+        self.streaming = 0
+    def reserve(self, size):
+        u"""
+        endの後ろにsizeバイト以上の空きを作る
+        """
+        buf = self.buf
+        pos, end = self.pos, self.end
+        if pos and (pos * 2 >= end or len(buf) - end < size):
+            # 同じ長さの代入なのでbufのサイズは変わらない
+            buf[:end - pos] = buf[pos:end]
+            self.pos = 0
+            self.end = end = end - pos
+        missing = size - (len(buf) - end)
+        if missing > 0:
+            try:
+                buf.extend(bytearray(missing))
+            except BufferError:
+                # 前回のframeがまだ参照されているのでサイズを変えられない
+                self.buf = buf[:end] + bytearray(size)
+    def feed(self, data):
+        n = len(data)
+        self.reserve(n)
+        end = self.end
+        self.buf[end:end + n] = data
+        self.end = end + n
+    def recv_into(self, sock, size):
+        u"""
+        sockから最大sizeバイトをbufに直接受信し、受信したバイト数を返す
+        """
+        self.reserve(size)
+        n = sock.recv_into(memoryview(self.buf)[self.end:], size)
+        self.end += n
+        return n
+    def clear(self):
+        self.buf = bytearray()
+        self.pos = 0
+        self.end = 0
+        self.streaming = 0
+    def pending(self):
+        u"""
+        途中まで受信したメッセージがあればTrue
+        """
+        return bool(self.streaming) or len(self) > 0
+    def __len__(self):
+        return self.end - self.pos
+    def frames(self, passThrough=None):
+        u"""
+        完成したメッセージごとに(type, start, end)を返す。
+        start, endはself.bufの中の位置で、次のfeed()までしか有効でない
+
+        chunk_sizeより長く、passThrough(type)がTrueのメッセージは、
+        届いた分ずつtypeをNoneにして返す
+        """
+        buf = self.buf
+        frame_header = self.messageType.frame_header
+        while True:
+            end = self.end
+            start = self.pos
+            if self.streaming:
+                n = min(self.streaming, end - start)
+                if not n:
+                    return
+                self.streaming -= n
+                self.pos = start + n
+                yield None, start, self.pos
+                continue
+
+            header = frame_header(buf, start, end)
+            if header is None:
+                return
+            msgtype, length = header
+            if start + length > end:
+                if (self.chunk_size and length > self.chunk_size and
+                    passThrough is not None and passThrough(msgtype)):
+                    self.streaming = start + length - end
+                    self.pos = end
+                    yield None, start, end
+                return
+            self.pos = start + length
+            yield msgtype, start, self.pos
+    def view(self, start, end):
+        return memoryview(self.buf)[start:end]
+    def __iter__(self):
+        for msgtype, start, end in self.frames():
+            yield msgtype, self.view(start, end)
+
 def terminate():
     """
     Constructs a new Terminate message. 
@@ -0,0 +1,125 @@
+# coding:utf-8
+u"""
+ユーザーごとのクエリフィルタのポリシー。
+
+ポリシーファイル(JSON)の例:
+{
+    "default": {
+        "conditions": ["app='%(user)s'"],
+        "tables": ["dau", "sales_log"]
+    },
+    "users": {
+        "game13": {"tables": ["dau"]}
+    }
+}
+
+conditionsの%(user)sはユーザー名に置き換える。usersにないユーザーと、
+usersで省略した項目にはdefaultを使う。defaultもなければそのユーザーの
+クエリはすべて拒否する。conditionsが空(または省略)なら条件を求めず、
+tablesが空(または省略)ならどのテーブルのSELECTも拒否する。
+
+ファイルを読み込んだ結果(PolicySet)は変更しない。再読み込みでは新しい
+PolicySetを作ってregistry.currentを入れ替えるので、接続中のクライアントは
+次のクエリから新しいポリシーを使う。
+"""
+import json
+
+from twisted.python import log
+
+import logger
+from queryfilter import QueryFilter
+
+# ファイルを指定しないときのポリシー
+DEFAULT_POLICY = {
+    'default': {
+        'conditions': ["app='%(user)s'"],
+        'tables': ['dau', 'sales_log', 'sales_person', 'person_app_data',
+                   'logintime'],
+        },
+    }
+
+class PolicySet(object):
+    u"""
+    ポリシーファイルひとつ分のQueryFilter
+    """
+    def __init__(self, config):
+        default = config.get('default')
+        self.default = None if default is None else compile_rule(default)
+        self.users = {}
+        for user, rule in config.get('users', {}).items():
+            self.users[user] = compile_rule(rule, self.default)
+        # defaultから作ったユーザーごとのQueryFilter
+        self.derived = {}
+
+    def lookup(self, user):
+        u"""
+        userのQueryFilterを返す。ポリシーがなければNone
+        """
+        qf = self.derived.get(user)
+        if qf is None:
+            rule = self.users.get(user, self.default)
+            if rule is None:
+                return None
+            conditions, tables = rule
+            qf = QueryFilter([c % {'user': user} for c in conditions], tables)
+            self.derived[user] = qf
+        return qf
+
+def compile_rule(rule, default=None):
+    u"""
+    ポリシーファイルの1ユーザー分を(conditions, tables)にする
+    """
+    if not isinstance(rule, dict):
+        raise ValueError('policy must be an object: %r' % (rule,))
+    unknown = set(rule) - set(['conditions', 'tables'])
+    if unknown:
+        raise ValueError('unknown policy keys: %s' % ', '.join(sorted(unknown)))
+    conditions, tables = default or ((), ())
+    if 'conditions' in rule:
+        conditions = tuple(rule['conditions'] or ())
+    if 'tables' in rule:
+        tables = tuple(rule['tables'] or ())
+    for c in conditions:
+        # 書式の誤りは読み込み時に見つける
+        c % {'user': ''}
+    return conditions, tables
+
+class PolicyRegistry(object):
+    u"""
+    Usage:
+    registry = PolicyRegistry()
+    registry.load('policy.json')
+    qf = registry.lookup('game13')
+    registry.reload()
+    """
+    def __init__(self, config=DEFAULT_POLICY):
+        self.path = None
+        self.current = PolicySet(config)
+
+    def load(self, path):
+        u"""
+        pathのポリシーを読み込む。pathがNoneなら既定のポリシーに戻す
+        """
+        if path is None:
+            self.current = PolicySet(DEFAULT_POLICY)
+        else:
+            with open(path) as f:
+                self.current = PolicySet(json.load(f))
+        self.path = path
+
+    def reload(self):
+        u"""
+        ポリシーファイルを読み直す。失敗したら今のポリシーのまま
+        """
+        try:
+            self.load(self.path)
+        except Exception:
+            log.err(None, 'Failed to reload policy %s' % self.path)
+            return False
+        logger.info('policy', 'Reloaded policy %s', self.path)
+        return True
+
+    def lookup(self, user):
+        return self.current.lookup(user)
+
+registry = PolicyRegistry()
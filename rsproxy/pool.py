@@ -0,0 +1,388 @@
+"""
+Pool of authenticated connections to the postgres backend.
+
+There is one BackendPool per database. Client protocols acquire a
+PostgresClientProtocol from the pool of their database when they first
+need to talk to the backend, and release it again:
+
+    session mode     - when the client disconnects.
+
+    transaction mode - whenever the backend is idle (ReadyForQuery with
+                       status 'I') and has no replies outstanding, unless
+                       the client holds named prepared statements.
+
+In transaction mode, simple SELECT queries of clients without a backend
+may also be pipelined, up to pool_pipeline_depth at a time, on a backend
+that is not attached to any client (see acquireShared).
+
+Clients that find no idle backend wait in a scheduler.FairScheduler,
+which serves the users in turn rather than in order of arrival.
+
+A backend that comes back from a disconnected client is reset before
+another client gets it: an open transaction is rolled back and the
+pool_reset_query from the settings is run.
+
+A pool created with replica=True is a read replica: it is only used for
+pipelined simple SELECTs, and its health checks also measure how far it
+lags behind the primary.
+
+The pool opens minSize backends as soon as it is created, so that clients
+do not wait for the backend handshake. If a health check interval is given,
+idle backends are checked with pool_health_check_query at that interval,
+and backends lost or failed to connect are replaced up to minSize.
+
+"""
+from twisted.internet import defer, reactor, task
+from twisted.python import failure, log
+
+import engine
+import logger
+import setting
+from scheduler import FairScheduler
+
+
+
+class BackendPool(object):
+    """
+    The connections to one database. Backends in self.idle are
+    authenticated and not attached to any client, though they may have
+    shared queries in flight. Clients waiting for a backend are queued in
+    self.scheduler.
+    """
+
+    def __init__(self, host, port, database, minSize=0, maxSize=10,
+                 mode='session', scheduler=None, healthCheckInterval=0,
+                 replica=False, pipeline=None):
+        if mode not in ('session', 'transaction'):
+            raise ValueError('unknown pool mode: %r' % (mode,))
+        self.host = host
+        self.port = port
+        self.database = database
+        self.minSize = minSize
+        self.maxSize = maxSize
+        self.mode = mode
+        self.replica = replica
+        self.pipeline = pipeline
+
+        # Seconds behind the primary at the last health check, if this is
+        # a replica and the lag has been measured.
+        self.lag = None
+
+        # Every open backend, including the ones still authenticating.
+        self.backends = []
+        self.idle = []
+        if scheduler is None:
+            scheduler = FairScheduler()
+        self.scheduler = scheduler
+        self.connecting = 0
+
+        # The ParameterStatus messages of the first backend to
+        # authenticate, which are sent to clients as they authenticate.
+        self.parameterStatus = None
+        self._parameterWaiters = []
+
+        self.fill()
+
+        self._healthCheck = None
+        if healthCheckInterval:
+            self._healthCheck = task.LoopingCall(self.checkHealth)
+            self._healthCheck.start(healthCheckInterval, now=False)
+
+
+    def __len__(self):
+        return len(self.backends)
+
+
+    def connectBackend(self):
+        """
+        Opens a new backend connection. Returns a Deferred that fires with
+        the PostgresClientProtocol once the TCP connection is made.
+        """
+        from server import PostgresClientProtocol
+        return engine.connect(self.host, self.port, PostgresClientProtocol(self))
+
+
+    def connect(self):
+        """
+        Opens a backend and puts it in the pool once it has authenticated.
+        """
+        logger.info('pool', 'Connecting backend %d of %s.', len(self) + 1,
+                    self.database)
+        self.connecting += 1
+        d = self.connectBackend()
+        d.addCallback(self._connected)
+        d.addCallbacks(self._ready, self._connectFailed)
+
+
+    def _connected(self, backend):
+        self.backends.append(backend)
+        return backend.ready
+
+
+    def _ready(self, backend):
+        self.connecting -= 1
+        if self.parameterStatus is None:
+            self.parameterStatus = [m for m in backend.authenticationResponse
+                                    if m.type == 'S']
+            waiters, self._parameterWaiters = self._parameterWaiters, []
+            for d in waiters:
+                d.callback(self.parameterStatus)
+        if self.replica and self.lag is None:
+            self.measureLag(backend)
+        self.checkin(backend)
+
+
+    def _connectFailed(self, failure):
+        self.connecting -= 1
+        log.err(failure, 'Backend connection to %s failed' % self.database)
+
+        # One waiting client is told for each failed connection, so that
+        # they do not wait forever while the backend is unavailable.
+        self.scheduler.fail(failure)
+        if self.parameterStatus is None and not self.backends:
+            waiters, self._parameterWaiters = self._parameterWaiters, []
+            for d in waiters:
+                d.errback(failure)
+
+
+    def parameters(self):
+        """
+        Returns a Deferred that fires with the list of ParameterStatus
+        messages to send to clients of this database.
+        """
+        if self.parameterStatus is not None:
+            return defer.succeed(self.parameterStatus)
+        d = defer.Deferred()
+        self._parameterWaiters.append(d)
+        if not self.backends and not self.connecting:
+            self.connect()
+        return d
+
+
+    def acquire(self, user=None):
+        """
+        Returns a Deferred that fires with an idle backend, or fails with
+        scheduler.QueueFull or QueueTimeout if user has to wait too long
+        for one. Cancelling the Deferred gives up the place in the queue.
+        """
+        if self.idle:
+            backend = self._leastBusy(self.idle)
+            self.idle.remove(backend)
+            backend.cancelIdleTimeout()
+            self.scheduler.statsFor(user).record(0)
+            return defer.succeed(backend)
+        d = self.scheduler.enqueue(user)
+        self._grow()
+        return d
+
+
+    def pipelineDepth(self):
+        """
+        Returns how many simple queries may be in flight on a shared
+        backend, or 0 if backends are not shared.
+        """
+        if self.pipeline is not None:
+            return self.pipeline
+        if self.mode != 'transaction':
+            return 0
+        return setting.pool_pipeline_depth
+
+
+    def sharedCandidate(self):
+        """
+        Returns the idle backend with the fewest queries in flight, if it
+        can take another simple query without being attached to the
+        client, or None.
+        """
+        depth = self.pipelineDepth()
+        candidates = [b for b in self.idle
+                      if len(b.inflight) < depth and
+                      b.transactionStatus == 'idle']
+        if not candidates:
+            return None
+        return self._leastBusy(candidates)
+
+
+    def acquireShared(self, backend=None):
+        """
+        Returns the sharedCandidate, or the given one, to send a simple
+        query on. The idle timeout is restarted by touch once nothing is
+        in flight there.
+        """
+        if backend is None:
+            backend = self.sharedCandidate()
+        if backend is not None:
+            backend.cancelIdleTimeout()
+        return backend
+
+
+    def _leastBusy(self, backends):
+        best = backends[-1]
+        for backend in backends:
+            if len(backend.inflight) < len(best.inflight):
+                best = backend
+        return best
+
+
+    def fill(self):
+        """
+        Opens backends until there are at least minSize.
+        """
+        while len(self) + self.connecting < self.minSize:
+            self.connect()
+
+
+    def checkHealth(self):
+        """
+        Sends pool_health_check_query on every idle backend that has
+        nothing in flight, closing the ones that fail or do not answer
+        within pool_health_check_timeout seconds. Then replaces the
+        backends that were lost.
+        """
+        if self.replica:
+            for backend in self.idle:
+                if not backend.inflight:
+                    self.measureLag(backend)
+                    break
+        for backend in list(self.idle):
+            if backend.inflight:
+                continue
+            d = backend.runQuery(setting.pool_health_check_query)
+            timeout = reactor.callLater(setting.pool_health_check_timeout,
+                                        d.cancel)
+            d.addBoth(self._checked, backend, timeout)
+        self.fill()
+
+
+    def _checked(self, result, backend, timeout):
+        if timeout.active():
+            timeout.cancel()
+        if isinstance(result, failure.Failure):
+            log.err(result, 'Health check of a backend of %s failed' %
+                    self.database)
+            if not backend.dead:
+                backend.transport.loseConnection()
+
+
+    def measureLag(self, backend):
+        """
+        Sets self.lag from the result of replica_lag_query on backend.
+        """
+        d = backend.runQuery(setting.replica_lag_query)
+        d.addCallbacks(self._lagMeasured, self._lagFailed)
+
+
+    def _lagMeasured(self, replies):
+        for m in replies:
+            if m.type == 'D' and m.values and m.values[0] is not None:
+                self.lag = float(m.values[0])
+                return
+        self.lag = None
+
+
+    def _lagFailed(self, failure):
+        log.err(failure, 'Measuring the lag of %s:%s failed' %
+                (self.host, self.port))
+        self.lag = None
+
+
+    def _grow(self):
+        while (len(self.scheduler) > self.connecting and
+               len(self) + self.connecting < self.maxSize):
+            self.connect()
+
+
+    def release(self, backend, reset=False):
+        """
+        Detaches the backend from its client and returns it to the pool.
+        If reset is true, the backend's session is reset first.
+        """
+        client = backend.client
+        if client is not None:
+            client.detachBackend()
+        backend.client = None
+        if backend.dead:
+            return
+
+        if not reset:
+            return self.checkin(backend)
+
+        # Replies may still be on their way; they are dropped, and the
+        # session is reset once they are all in.
+        d = backend.whenDrained()
+        d.addCallback(self._reset)
+        d.addCallbacks(lambda _: self.checkin(backend),
+                       lambda f: self._resetFailed(f, backend))
+
+
+    def _reset(self, backend):
+        queries = []
+        if backend.transactionStatus != 'idle':
+            queries.append('ROLLBACK')
+        if setting.pool_reset_query:
+            queries.append(setting.pool_reset_query)
+        d = defer.succeed(None)
+        for query in queries:
+            d.addCallback(lambda _, query=query: backend.runQuery(query))
+        return d
+
+
+    def _resetFailed(self, failure, backend):
+        log.err(failure, 'Backend reset failed, closing it')
+        if not backend.dead:
+            backend.transport.loseConnection()
+
+
+    def checkin(self, backend):
+        """
+        Hands the backend to the next waiting client, or makes it idle.
+        """
+        if backend.dead:
+            return
+        if self.scheduler.serve(backend):
+            return
+        if backend not in self.idle:
+            self.idle.append(backend)
+        self.touch(backend)
+
+
+    def touch(self, backend):
+        """
+        Restarts the idle timeout of a backend in self.idle.
+        """
+        if (backend in self.idle and len(self) > self.minSize and
+            setting.pool_idle_timeout):
+            backend.setIdleTimeout(setting.pool_idle_timeout, self._expire)
+
+
+    def _expire(self, backend):
+        if (backend in self.idle and not backend.inflight and
+            len(self) > self.minSize):
+            logger.info('pool', 'Closing idle backend of %s.', self.database)
+            self.idle.remove(backend)
+            backend.terminate()
+
+
+    def backendLost(self, backend):
+        """
+        Called by a backend when its connection is lost.
+        """
+        if backend in self.backends:
+            self.backends.remove(backend)
+        if backend in self.idle:
+            self.idle.remove(backend)
+        self._grow()
+        if backend.authenticationComplete:
+            # Backends that never got through authentication are replaced
+            # by the next health check, not in a loop.
+            self.fill()
+
+
+    def close(self):
+        """
+        Terminates every backend.
+        """
+        if self._healthCheck is not None and self._healthCheck.running:
+            self._healthCheck.stop()
+        for backend in list(self.backends):
+            backend.terminate()
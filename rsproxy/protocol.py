@@ -10,11 +10,22 @@ They are:
                         FilterProtocols define a filter type, which can
                         manipulate messages as they are received. 
 
+    WriteThrottle     - Producer registered with each FilteringProtocol's
+                        transport, which stops the protocols writing to it
+                        from reading while its send buffer is full. 
+
 """
 from __future__ import with_statement
-from twisted.internet import protocol
-from twisted.internet.defer import DeferredList
+from twisted.internet import protocol, reactor
+from twisted.internet.defer import Deferred, DeferredList
+from twisted.internet.interfaces import IPushProducer
 from twisted.python import log
+from zope.interface import implementer
+
+import logger
+import setting
+from metrics import countMessages
+from parser import Framer
 
 
 
@@ -26,24 +37,31 @@ class MessageProtocol(protocol.Protocol):
 
     Requires the use of a message class that understands the termination
     conditions of the messages on the wire. The messageType attribute 
-    should be set to a class that provides a consume method--this method
-    accepts the raw data and returns a tuple. 
-
-    The first element in the returned tuple should be True if the
-    message has finished parsing, otherwise False. The second element 
-    should be any data left unconsumed, or an empty string. 
+    should be set to a class that provides a frame_header classmethod and
+    a consume method. 
+
+    frame_header(buf, pos, end) returns the (type, length) of the message
+    starting at buf[pos], or None if the header is not complete yet. It is
+    used by a parser.Framer to cut complete messages out of the receive
+    buffer without copying the data that follows them. 
+
+    consume accepts the raw data of one message and returns a tuple. The
+    first element in the returned tuple should be True if the message has
+    finished parsing, otherwise False. The second element should be any
+    data left unconsumed, or an empty string. 
     """
 
-    # Should be defined to be a message class that defines a consume 
-    # method, outlined above. 
+    # Should be defined to be a message class that defines frame_header 
+    # and consume, outlined above. 
     messageType = None
 
+    # The sender label of the messages received, in metrics.messages. 
+    sender = 'unknown'
+
 
     def __init__(self):
-        # This field stores an incomplete message while it is being
-        # constructed.
-        self._message = None
-        self._queue = []
+        # Raw data received but not yet handed out as complete messages. 
+        self._framer = Framer(self.messageType, setting.stream_chunk_size)
 
 
     def dataReceived(self, data):
@@ -51,48 +69,108 @@ class MessageProtocol(protocol.Protocol):
         Parses as many messages as possible with the given data, resuming
         the previous message if there was one.
         """
-        while 1:
-            m = self._message or self.messageType()
-            done, extra = m.consume(data)
-
-            if done:
-                # Discard the previous message, if there was one. This 
-                # prevents an infinite loop. 
-                self._message = None
-
-                # Entire message was contained in the data, raise
-                # the notification. 
-                self._queue.append(m)
-                if extra:
-                    data = extra
-                else:
-                    break
-            else:
-                # More data is necessary to complete this message.
-                self._message = m
-                break
-        return self._receive()
+        self._framer.feed(data)
+        return self.framesReceived()
+
+
+    def recvInto(self, sock, size):
+        """
+        Receives up to size bytes from sock straight into the receive
+        buffer. Returns the number of bytes received; the caller hands
+        them on with framesReceived. Used by the transports of
+        engine.RECV_INTO instead of dataReceived.
+        """
+        return self._framer.recv_into(sock, size)
 
 
-    def _receive(self):
+    def messagesCounted(self, msgtype, count, size):
         """
-        Processes all of the messages currently in the receive queue. 
+        Called with each run of count messages of msgtype, of size bytes
+        in total, in the received data, once they have been handled.
+        A msgtype of None stands for pieces of streamed messages.
         """
-        log.msg('recv %s' % ''.join(map(str, self._queue)))
+        countMessages(self.sender, msgtype, count, size)
+
+
+    def framesReceived(self):
+        """
+        Handles the complete messages in the receive buffer.
+        """
+        framer = self._framer
+        passThrough = self.passThrough
+        received = []
         ds = []
-        try:
-            for x in self._queue:
-                ds.append(self.messageReceived(x))
 
-            # Only return deferred if necessary. If we return deferred
-            # from, for example, a Startup message, the client will disconnect
-            # as it expects us to read its entire message. 
-            ds = [d for d in ds if d]
-            if ds:
-                return DeferredList(ds)
+        # Consecutive pass-through messages are contiguous in the receive
+        # buffer, so they are handed on as a single raw string. The check
+        # is made as each message is reached, because handling the
+        # previous message may have changed the filter's state. Pieces of
+        # a pass-through message larger than the framer's chunk size come
+        # with a type of None and are handed on as they arrive. 
+        rawStart = rawEnd = None
+
+        # Messages are counted in the metrics per run of the same type,
+        # whose bytes are contiguous. 
+        countType = None
+        count = countStart = end = 0
+        for msgtype, start, end in framer.frames(passThrough):
+            if msgtype != countType:
+                if count:
+                    self.messagesCounted(countType, count,
+                                         start - countStart)
+                countType = msgtype
+                count = 0
+                countStart = start
+            count += 1
+
+            if msgtype is None or passThrough(msgtype):
+                if rawEnd != start:
+                    if rawStart is not None:
+                        ds.append(self.rawDataReceived(
+                                framer.view(rawStart, rawEnd).tobytes()))
+                    rawStart = start
+                rawEnd = end
+                continue
+
+            if rawStart is not None:
+                ds.append(self.rawDataReceived(
+                        framer.view(rawStart, rawEnd).tobytes()))
+                rawStart = rawEnd = None
+            m = self.messageType()
+            m.consume(framer.view(start, end).tobytes())
+            received.append(m)
+            ds.append(self.messageReceived(m))
+
+        if rawStart is not None:
+            ds.append(self.rawDataReceived(
+                    framer.view(rawStart, rawEnd).tobytes()))
+        if count:
+            self.messagesCounted(countType, count, end - countStart)
+        if received:
+            logger.debug('recv', 'recv %s', logger.Joined(received))
+
+        # Only return deferred if necessary. If we return deferred
+        # from, for example, a Startup message, the client will disconnect
+        # as it expects us to read its entire message. 
+        ds = [d for d in ds if d]
+        if ds:
+            return DeferredList(ds)
+
+
+    def passThrough(self, msgtype):
+        """
+        Returns True if messages of the given type should be handed to
+        rawDataReceived without being parsed. 
+        """
+        return False
 
-        finally:
-            self._queue = []
+
+    def rawDataReceived(self, data):
+        """
+        Function that is called with the raw data of one or more 
+        consecutive pass-through messages. 
+        """
+        pass
 
 
     def messageReceived(self, message):
@@ -106,11 +184,87 @@ class MessageProtocol(protocol.Protocol):
 
     @property
     def parsingMessage(self):
-        return self._message is not None
+        return self._framer.pending()
 
     
     def discardMessage(self):
-        self._message = None
+        self._framer.clear()
+
+
+
+
+def pendingBytes(transport):
+    """
+    Returns the number of bytes waiting in a transport's send buffer, or 
+    None if the transport does not expose its buffer. 
+
+    This reads attributes private to twisted.internet.abstract.FileDescriptor
+    (dataBuffer, offset and _tempDataLen), checked against Twisted 20.3.
+    If another version lacks them, the low watermark is not used and
+    reading resumes only when Twisted calls resumeProducing.
+    """
+    try:
+        return (len(transport.dataBuffer) - transport.offset + 
+                transport._tempDataLen)
+    except AttributeError:
+        return None
+
+
+
+@implementer(IPushProducer)
+class WriteThrottle(object):
+    """
+    Registered as the streaming producer of a protocol's transport. 
+
+    Twisted calls pauseProducing when the transport's send buffer grows
+    past its bufferSize (the high watermark), and resumeProducing once
+    the buffer is empty. While paused, every protocol that writes to the
+    transport (see FilteringProtocol.writers) stops reading from its own
+    transport, so data is left in the kernel buffers of the sender rather
+    than in the proxy. If a low watermark is set, reading is resumed as
+    soon as the send buffer has drained below it. 
+    """
+    pollInterval = 0.05
+
+
+    def __init__(self, protocol, lowWatermark=0):
+        self.protocol = protocol
+        self.lowWatermark = lowWatermark
+        self.paused = []
+        self._poll = None
+
+
+    def pauseProducing(self):
+        for writer in self.protocol.writers():
+            if writer not in self.paused:
+                self.paused.append(writer)
+                writer.pauseReading(self)
+        if self.lowWatermark and self._poll is None:
+            self._poll = reactor.callLater(self.pollInterval, self._checkLow)
+
+
+    def resumeProducing(self):
+        if self._poll is not None:
+            if self._poll.active():
+                self._poll.cancel()
+            self._poll = None
+        paused, self.paused = self.paused, []
+        for writer in paused:
+            writer.resumeReading(self)
+
+
+    stopProducing = resumeProducing
+
+
+    def _checkLow(self):
+        self._poll = None
+        if not self.paused:
+            return
+        pending = pendingBytes(self.protocol.transport)
+        if pending is not None and pending <= self.lowWatermark:
+            self.resumeProducing()
+        else:
+            self._poll = reactor.callLater(self.pollInterval, self._checkLow)
 
 
 
@@ -124,6 +278,55 @@ class FilteringProtocol(MessageProtocol):
         self.filterMessage = self.filter.filter
         MessageProtocol.__init__(self)
 
+        # The reasons reading from the transport is currently paused. 
+        self._readPausers = []
+
+        # Writes collected while a batch of received data is handled. 
+        self._batch = None
+
+        # Messages received while an earlier message is waiting, for
+        # example for the filter's Deferred to fire, as (handler, argument)
+        # pairs. None when nothing is waiting. 
+        self._held = None
+        self._holdReason = None
+
+
+    def connectionMade(self):
+        """
+        Registers a WriteThrottle with the transport, using the write 
+        watermarks from the settings. 
+        """
+        self.transport.bufferSize = setting.write_high_watermark
+        self.transport.registerProducer(
+            WriteThrottle(self, setting.write_low_watermark), True)
+
+
+    def writers(self):
+        """
+        Returns the protocols that write to this protocol's transport. 
+        """
+        return []
+
+
+    def pauseReading(self, reason):
+        """
+        Stops reading from the transport until resumeReading has been
+        called with every reason given here. 
+        """
+        if reason in self._readPausers:
+            return
+        self._readPausers.append(reason)
+        if len(self._readPausers) == 1:
+            self.transport.pauseProducing()
+
+
+    def resumeReading(self, reason):
+        if reason not in self._readPausers:
+            return
+        self._readPausers.remove(reason)
+        if not self._readPausers:
+            self.transport.resumeProducing()
+
 
     def getPeer(self):
         """
@@ -139,11 +342,72 @@ class FilteringProtocol(MessageProtocol):
         """
         p = self.getPeer()
         if p:        
-            data = ''.join([m.serialize() for m in messages])
-            return p.transport.write(data)
-        log.msg('Dropping message(s): %s, peer disconnected.' % 
-                ' '.join([m.serialize() for m in messages]))
-    
+            for m in messages:
+                self.bufferedWrite(p.transport, m.serialize())
+            return
+        logger.info('drop', 'Dropping message(s): %s, peer disconnected.',
+                    logger.Joined(messages))
+
+
+    def writeRawPeer(self, data):
+        """
+        Writes raw message data to the peer. 
+        """
+        p = self.getPeer()
+        if p:
+            return self.bufferedWrite(p.transport, data)
+        logger.info('drop', 'Dropping %d bytes, peer disconnected.', len(data))
+
+
+    def bufferedWrite(self, transport, data):
+        """
+        Writes data to a transport. While a batch of received data is being
+        handled, the writes are collected and flushed at the end of the
+        batch with one writeSequence per transport. 
+        """
+        batch = self._batch
+        if batch is None:
+            return transport.write(data)
+        for t, chunks in batch:
+            if t is transport:
+                chunks.append(data)
+                return
+        batch.append((transport, [data]))
+
+
+    def flush(self):
+        """
+        Writes out everything collected by bufferedWrite. 
+        """
+        batch, self._batch = self._batch, None
+        if batch:
+            for transport, chunks in batch:
+                transport.writeSequence(chunks)
+
+
+    def framesReceived(self):
+        self._batch = []
+        try:
+            return MessageProtocol.framesReceived(self)
+        finally:
+            self.flush()
+
+
+    def passThrough(self, msgtype):
+        """
+        Asks the filter, except while messages are held: they are parsed
+        then, because the filter may change its mind about them once the
+        pending result is known. 
+        """
+        return self._held is None and self.filter.passThrough(msgtype)
+
+
+    def rawDataReceived(self, data):
+        if self._held is not None:
+            self._held.append((self.rawDataReceived, data))
+            return None
+        return self.writeRawPeer(data)
+
 
     def messageReceived(self, msg):
         # cases - 
@@ -152,7 +416,61 @@ class FilteringProtocol(MessageProtocol):
         #   don't write the message
         #   write a different set of messages, process those replies, 
         #      then write a response (either spoofed or geniune)
-        m, cb = self.filterMessage(msg)
+        #   return a Deferred that fires with one of the above, once
+        #      the filter has made up its mind
+        if self._held is not None:
+            # An earlier message is still being filtered. Hold this one
+            # so that the peer sees the messages in order. 
+            self._held.append((self.messageReceived, msg))
+            return None
+
+        result = self.filterMessage(msg)
+        if isinstance(result, Deferred):
+            self.holdMessages('filter')
+            result.addCallbacks(self._filtered, self._filterFailed,
+                                errbackArgs=(msg,))
+            return None
+        return self.writeFiltered(result)
+
+
+    def holdMessages(self, reason, *held):
+        """
+        Holds the given (handler, argument) pairs and every message 
+        received from now on, and stops reading, until releaseMessages is
+        called with the same reason. 
+        """
+        self._held = list(held)
+        self._holdReason = reason
+        self.pauseReading(reason)
+
+
+    def releaseMessages(self, reason):
+        """
+        Handles the held messages in order, until one of them causes the
+        rest to be held again. 
+        """
+        ownBatch = self._batch is None
+        if ownBatch:
+            self._batch = []
+        try:
+            held, self._held = self._held, None
+            for i, (handler, arg) in enumerate(held):
+                handler(arg)
+                if self._held is not None:
+                    self._held.extend(held[i + 1:])
+                    break
+        finally:
+            if ownBatch:
+                self.flush()
+        if self._held is None or self._holdReason != reason:
+            self.resumeReading(reason)
+
+
+    def writeFiltered(self, result):
+        """
+        Writes the messages returned by the filter to the peer. 
+        """
+        m, cb = result
 
         messages = [m] if hasattr(m, 'serialize') else m
         if not messages:
@@ -163,3 +481,16 @@ class FilteringProtocol(MessageProtocol):
             d.addCallback(cb)
         return d
 
+
+    def _filtered(self, result):
+        """
+        Called when a Deferred returned by the filter fires. Writes its
+        result, then handles the messages that were held behind it. 
+        """
+        self._held.insert(0, (self.writeFiltered, result))
+        self.releaseMessages('filter')
+
+
+    def _filterFailed(self, failure, msg):
+        log.err(failure, 'Filter failed, dropping message.')
+        self._filtered(self.filter.failed(msg))
@@ -1,9 +1,26 @@
 # coding:utf-8
 
+import itertools
+import re
+
 import sqlparse
 from sqlparse.sql import Where, Identifier, IdentifierList, Token, Parenthesis
 from sqlparse.tokens import Keyword, Punctuation
 
+import fastsql
+import setting
+from cache import LRUCache
+
+# (クエリ文字列, QueryFilter.identity)をキーにした判定結果のキャッシュ
+verdict_cache = LRUCache(setting.verdict_cache_entries,
+                         setting.verdict_cache_bytes)
+
+# リテラルを置き換えたクエリ(テンプレート)をキーにした解析結果のキャッシュ
+# フィルタのプール(filterpool)のスレッドからも使う
+template_cache = LRUCache(setting.template_cache_entries,
+                          setting.template_cache_bytes,
+                          threadsafe=True)
+
 class QueryFilter(object):
     #u"""
     # Usage:
@@ -13,18 +30,124 @@ class QueryFilter(object):
     # →SELECT文でないか、またはSELECT文であり、app='game13'という条件が入っており、sometableに対するクエリ以外はresultがFalseになる
     #"""
     def __init__(self, expected_conditions, tables=None):
-        if expected_conditions:
-            self.expected_conditions = set(expected_conditions)
-        else:
-            self.expected_conditions = None
+        # 条件がなければ、どのSELECTにも条件を求めない
+        self.expected_conditions = frozenset(expected_conditions or ())
+        # テーブルがなければ、どのテーブルのSELECTも許可しない
+        self.tables = frozenset(tables or ())
 
-        if tables:
-            self.tables = set(tables)
-        else:
-            self.tables = None
+        # 条件とテーブルが同じQueryFilterは判定結果のキャッシュを共有する
+        self.identity = (self.expected_conditions, self.tables)
 
     def filter_query_string(self, string):
-        return filter_query_string(string, self.expected_conditions, self.tables)
+        result = self.cached_verdicts(string)
+        if result is None:
+            result = check_query_string(string, self.expected_conditions, self.tables)
+            self.store_verdicts(string, result)
+        return result
+
+    def cached_verdicts(self, string):
+        u"""
+        キャッシュにある判定結果。なければNone
+        """
+        result = verdict_cache.get((string, self.identity))
+        if result is None:
+            return None
+        return list(result)
+
+    def store_verdicts(self, string, result):
+        verdict_cache.put((string, self.identity), tuple(result), len(string))
+
+# 末尾以外に;がなく、INTOやセッションの状態を使う関数を含まないSELECT
+_single_select_re = re.compile(
+    r"\s*select\b"
+    r"(?![^;]*\b(?:into|set_config|pg_advisory_\w+|nextval|currval|lastval|setval)\b)"
+    r"[^;]*;?\s*\Z", re.I)
+
+def is_single_select(string):
+    u"""
+    SELECT文ひとつだけで、セッションの状態を変えないとみなせるクエリならTrue。
+    他のクライアントとバックエンドを共有してよいかの判定に使う。
+    文字列リテラルの中の;やintoでもFalseになるが、それはかまわない
+    """
+    return _single_select_re.match(string) is not None
+
+def table_key(name):
+    u"""
+    結果のキャッシュのテーブル名。スキーマと""を除いて小文字にする
+    """
+    return name.split()[0].split('.')[-1].strip('"').lower()
+
+# 他のテーブルも読むかもしれないSELECT(サブクエリかJOIN)
+_other_tables_re = re.compile(r'\bselect\b.*\b(?:select|join)\b', re.I | re.S)
+
+def select_table(string):
+    u"""
+    SELECT文ひとつだけで、ひとつのテーブルだけを読むクエリなら、その
+    テーブル名(table_key)。テーブル名はget_table_nameと同じく解析結果から
+    取る。サブクエリやJOINがあれば(文字列リテラルの中でも)None
+    """
+    if _other_tables_re.search(string):
+        return None
+    analyses = analyze_query_string(string)
+    if len(analyses) != 1 or analyses[0][0] != 'select':
+        return None
+    return table_key(analyses[0][1])
+
+# 書き込まない文の先頭のキーワード
+_read_only_keywords = frozenset([
+        'select', 'show', 'begin', 'start', 'commit', 'end', 'rollback',
+        'abort', 'savepoint', 'release', 'set', 'reset', 'discard', 'fetch',
+        'close', 'declare', 'prepare', 'deallocate', 'listen',
+        'unlisten', 'notify', 'values', 'create', 'vacuum', 'analyze',
+        'checkpoint',
+        ])
+# 書き込む文と、そのテーブル名の位置
+_write_res = {
+    'insert': re.compile(r'insert\s+into\s+([\w."]+)', re.I),
+    'update': re.compile(r'update\s+(?:only\s+)?([\w."]+)', re.I),
+    'delete': re.compile(r'delete\s+from\s+(?:only\s+)?([\w."]+)', re.I),
+    'copy': re.compile(r'copy\s+([\w."]+)', re.I),
+    'alter': re.compile(r'alter\s+table\s+(?:if\s+exists\s+)?(?:only\s+)?([\w."]+)', re.I),
+    'truncate': re.compile(r'truncate\s+(?:table\s+)?(?:only\s+)?([\w.",\s]+)', re.I),
+    'drop': re.compile(r'drop\s+table\s+(?:if\s+exists\s+)?([\w.",\s]+)', re.I),
+    }
+_first_word_re = re.compile(r'\s*(\w*)')
+
+def written_tables(string):
+    u"""
+    クエリが書き込むテーブル名(table_key)のfrozenset。
+    書き込むかどうか、どこに書き込むかわからない文があればNone。
+    EXPLAIN ANALYZEは文を実行するので、EXPLAINもわからない文とする
+
+    文は;で区切るだけなので、文字列リテラルの中の;で区切り方を誤ると
+    Noneになることがあるが、それはかまわない
+    """
+    tables = set()
+    for statement in string.split(';'):
+        keyword = _first_word_re.match(statement).group(1).lower()
+        if not keyword:
+            if statement.strip():
+                return None
+            continue
+        if keyword in _read_only_keywords:
+            if keyword == 'select' and re.search(r'\binto\b', statement, re.I):
+                return None
+            continue
+        write_re = _write_res.get(keyword)
+        match = write_re and write_re.match(statement.strip())
+        if not match:
+            return None
+        for name in match.group(1).split(','):
+            if name.strip():
+                tables.add(table_key(name))
+    return frozenset(tables)
+
+def check_query_string(string, expected_conditions, tables):
+    u"""
+    filter_query_stringと同じ判定を、fastsqlとtemplate_cacheを使って行なう
+    """
+    return [check_analysis(analysis, expected_conditions, tables)
+            for analysis in analyze_query_string(string)]
 
 def filter_query_string(string, expected_conditions, tables):
     parsed_statements = sqlparse.parse(string)
@@ -39,25 +162,31 @@ def filter_statement(statement, expected_conditions, tables):
     * WHERE節を最上位のANDで区切る。条件の中に期待される条件を含むわけではない→はじく
     * 条件の中に期待される条件を含む→OK
     """
+    return check_analysis(analyze_statement(statement), expected_conditions, tables)
+
+def analyze_statement(statement):
+    u"""
+    filter_statementのうち、期待される条件と対象テーブルによらない部分。
+    結果はcheck_analysisに渡す
+
+    * ('verdict', (result, exceptionobj)) - 条件やテーブルによらず決まる
+    * ('select', テーブル名, SELECT節のエラーまたはNone, 条件文字列のfrozenset)
+    """
     statement_type = get_statement_type(statement)
     if statement_type!='SELECT':
-        return (True, ValueError('statement type: %s' % statement_type))
+        return ('verdict', (True, ValueError('statement type: %s' % statement_type)))
 
     where_clause = get_where_clause(statement)
     if where_clause is None:
-        return (False, ValueError('no where clause'))
+        return ('verdict', (False, ValueError('no where clause')))
 
     target_table = get_table_name(statement)
     if isinstance(target_table, ValueError):
-        return (False, target_table)
-    else:
-        tablename = target_table.value
-        if tablename not in tables:
-            return (False, ValueError('invalid table name: %s' % tablename))
+        return ('verdict', (False, target_table))
 
     select_expr_check = check_select_expr(statement)
-    if isinstance(select_expr_check, ValueError):
-        return (False, select_expr_check)
+    if not isinstance(select_expr_check, ValueError):
+        select_expr_check = None
 
     tokens = [token for token in where_clause.tokens if not token.is_whitespace()]
     conditions = split_tokens(tokens[1:], 'AND')
@@ -66,11 +195,110 @@ def filter_statement(statement, expected_conditions, tables):
         condition_str = "".join([token.value for token in condition])
         condition_strs.add(condition_str)
 
+    return ('select', target_table.value, select_expr_check, frozenset(condition_strs))
+
+def check_analysis(analysis, expected_conditions, tables):
+    if analysis[0] == 'verdict':
+        return analysis[1]
+
+    kind, tablename, select_expr_error, condition_strs = analysis
+    if tablename not in tables:
+        return (False, ValueError('invalid table name: %s' % tablename))
+
+    if select_expr_error is not None:
+        return (False, select_expr_error)
+
     if (expected_conditions - condition_strs)==set([]):
         return (True, None)
     else:
         return (False, ValueError('invalid conditions'))
 
+# 文字列リテラルと数値リテラル。sqlparseと同じく、文字列は改行を含まず''で区切る
+_literal_re = re.compile(r"'[^'\r\n]*'|(?<![\w.])\d+(?:\.\d+)?(?![\w.])")
+# テンプレートの中のリテラルの位置
+_placeholder_re = re.compile(r"\$[snf]")
+# 解析用のクエリに埋め込んだリテラルの印。数値も'$0$'のように番号を入れた
+# 文字列にする。条件文字列のトークンは空白なしでつながるので、数字だけの
+# 印は隣の印とつながって別の番号になってしまう
+_marker_re = re.compile(r"'\$(\d+)\$'")
+# 正規表現でリテラルを切り出せないもの(コメント、$クォート、\エスケープ、"識別子")
+_unsafe_re = re.compile(r"--|/\*|[$\\\"]")
+
+def fingerprint(string):
+    u"""
+    クエリのリテラルを$s(文字列)、$n(整数)、$f(小数)に置き換えたテンプレートと、
+    リテラルのリストを返す。うまく切り出せないクエリはNone。
+    sqlparseと同じく、文字列はutf-8としてunicodeにする
+
+    fingerprint("SELECT * FROM dau WHERE app='game13' AND id=1")
+    → (u'SELECT * FROM dau WHERE app=$s AND id=$n', [u"'game13'", u'1'])
+    """
+    if _unsafe_re.search(string):
+        return None
+    if isinstance(string, str):
+        try:
+            string = string.decode('utf-8')
+        except UnicodeDecodeError:
+            return None
+
+    literals = []
+    def replace(match):
+        literal = match.group(0)
+        literals.append(literal)
+        if literal[0] == "'":
+            return '$s'
+        return '$f' if '.' in literal else '$n'
+
+    template = _literal_re.sub(replace, string)
+    if "'" in template:
+        return None
+    return template, literals
+
+def analyze_template(template):
+    u"""
+    リテラルの代わりに印を埋め込んだクエリを解析する。
+    条件文字列には印が残るので、bind_literalsで実際のリテラルに戻す
+    """
+    counter = itertools.count()
+    def mark(match):
+        return "'$%d$'" % next(counter)
+
+    marked = _placeholder_re.sub(mark, template)
+    return tuple([analyze_statement(stmt) for stmt in sqlparse.parse(marked.encode('utf-8'))])
+
+def bind_literals(analysis, literals):
+    if analysis[0] == 'verdict':
+        return analysis
+
+    def unmark(match):
+        return literals[int(match.group(1))]
+
+    kind, tablename, select_expr_error, condition_strs = analysis
+    condition_strs = frozenset([_marker_re.sub(unmark, condition_str)
+                                for condition_str in condition_strs])
+    return (kind, tablename, select_expr_error, condition_strs)
+
+def analyze_query_string(string):
+    u"""
+    クエリ中の各文をanalyze_statementで解析する。
+    よくある形のクエリはfastsqlで解析し、それ以外でリテラルだけが違う
+    クエリの解析結果はtemplate_cacheで共有する
+    """
+    analyses = fastsql.analyze(string)
+    if analyses is not None:
+        return analyses
+
+    result = fingerprint(string)
+    if result is None:
+        return [analyze_statement(stmt) for stmt in sqlparse.parse(string)]
+
+    template, literals = result
+    analyses = template_cache.get(template)
+    if analyses is None:
+        analyses = analyze_template(template)
+        template_cache.put(template, analyses, len(template))
+    return [bind_literals(analysis, literals) for analysis in analyses]
+
 def get_statement_type(statement):
     return statement.get_type()
 
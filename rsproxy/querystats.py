@@ -0,0 +1,215 @@
+# coding:utf-8
+u"""
+クエリのテンプレートごとの統計(プロキシ内のpg_stat_statements)
+
+テンプレートはqueryfilter.fingerprintでリテラルを置き換えたクエリ。
+fingerprintできないクエリは、リテラルを?に置き換え、空白をまとめたもの
+"""
+import json
+import math
+import re
+
+from twisted.web import resource
+
+import queryfilter
+import setting
+from cache import LRUCache
+
+_literal_re = re.compile(r"'(?:[^']|'')*'|(?<![\w.$])\d+(?:\.\d+)?(?![\w.])")
+_space_re = re.compile(r'\s+')
+
+# 統計に残すクエリの長さ
+max_query_length = 1000
+
+# 待ち時間のヒストグラムのバケツ。1マイクロ秒から2**(1/4)倍ごと
+_bucket_base = 1e-6
+_buckets_per_octave = 4
+
+def normalize(string):
+    u"""
+    クエリのテンプレートを返す
+
+    normalize("SELECT * FROM dau WHERE id=1")
+    → u'SELECT * FROM dau WHERE id=$n'
+    normalize("SELECT 'a''b' -- x")
+    → u'SELECT ? -- x'
+    """
+    result = queryfilter.fingerprint(string)
+    if result is not None:
+        return result[0][:max_query_length]
+    if isinstance(string, str):
+        string = string.decode('utf-8', 'replace')
+    return _space_re.sub(' ', _literal_re.sub('?', string)).strip()[:max_query_length]
+
+def _bucket(seconds):
+    if seconds <= _bucket_base:
+        return 0
+    return int(math.log(seconds / _bucket_base, 2) * _buckets_per_octave) + 1
+
+def _bucket_limit(bucket):
+    return _bucket_base * 2 ** (bucket / float(_buckets_per_octave))
+
+class UserStat(object):
+    __slots__ = ['calls', 'rejected', 'total_time', 'rows', 'bytes']
+    def __init__(self):
+        self.calls = 0
+        self.rejected = 0
+        self.total_time = 0.0
+        self.rows = 0
+        self.bytes = 0
+    def as_dict(self):
+        return {'calls': self.calls, 'rejected': self.rejected,
+                'total_time': self.total_time, 'rows': self.rows,
+                'bytes': self.bytes}
+
+class QueryStat(UserStat):
+    u"""
+    ひとつのテンプレートの統計。usersはユーザーごとの統計で、max_users人を
+    超えたユーザーはまとめてNoneに数える
+    """
+    __slots__ = ['query', 'min_time', 'max_time', 'histogram', 'users']
+    def __init__(self, query):
+        UserStat.__init__(self)
+        self.query = query
+        self.min_time = None
+        self.max_time = 0.0
+        # バケツ -> 回数
+        self.histogram = {}
+        self.users = {}
+    def user(self, user, max_users):
+        stat = self.users.get(user)
+        if stat is None:
+            if len(self.users) >= max_users:
+                user = None
+                stat = self.users.get(None)
+            if stat is None:
+                stat = self.users[user] = UserStat()
+        return stat
+    def percentile(self, fraction):
+        u"""
+        fractionの回数がこれ以下の時間だった値(ヒストグラムのバケツの上限)
+        """
+        count = sum(self.histogram.values())
+        if not count:
+            return None
+        seen = 0
+        for bucket in sorted(self.histogram):
+            seen += self.histogram[bucket]
+            if seen >= fraction * count:
+                return min(_bucket_limit(bucket), self.max_time)
+        return self.max_time
+    def as_dict(self):
+        d = UserStat.as_dict(self)
+        d.update({
+            'query': self.query,
+            'mean_time': self.total_time / self.calls if self.calls else None,
+            'min_time': self.min_time,
+            'max_time': self.max_time,
+            'p99_time': self.percentile(0.99),
+            'users': dict([(user if user is not None else '(other)',
+                            stat.as_dict())
+                           for user, stat in self.users.items()]),
+            })
+        return d
+
+class QueryStats(object):
+    u"""
+    テンプレートごとの統計。合計時間の多いmax_entries個ほどを残す
+
+    Usage:
+    stats = QueryStats(max_entries=1000, max_users=50,
+                       max_template_bytes=8 * 1024 * 1024)
+    template = stats.template(query)
+    stats.record(template, 'game13', 0.003, rows=10, size=420)
+    stats.reject(template, 'game13')
+    stats.top(10)                        # 合計時間の多い順
+
+    エントリがmax_entriesの1.25倍を超えたら、合計時間の少ないものから
+    max_entriesまで捨てる。新しいテンプレートも、次に捨てるまでの間に
+    時間を積めば残る
+
+    クエリからテンプレートへのキャッシュ(templates)はmax_entriesの4倍の
+    エントリとmax_template_bytesのバイト数までにする。リテラルの多い長い
+    クエリでもメモリが増え続けないように
+    """
+    def __init__(self, max_entries=1000, max_users=50, max_template_bytes=None):
+        self.max_entries = max_entries
+        self.max_users = max_users
+        self.entries = {}
+        self.evictions = 0
+        # クエリ -> テンプレート
+        self.templates = LRUCache(max_entries * 4, max_template_bytes)
+    def resize(self, max_entries, max_users, max_template_bytes=None):
+        self.max_entries = max_entries
+        self.max_users = max_users
+        self.templates.resize(max_entries * 4, max_template_bytes)
+        if len(self.entries) > max_entries:
+            self.evict()
+    def template(self, query):
+        template = self.templates.get(query)
+        if template is None:
+            template = normalize(query)
+            self.templates.put(query, template, len(query) + len(template))
+        return template
+    def entry(self, template):
+        stat = self.entries.get(template)
+        if stat is None:
+            if len(self.entries) >= self.max_entries + self.max_entries // 4 + 1:
+                self.evict()
+            stat = self.entries[template] = QueryStat(template)
+        return stat
+    def evict(self):
+        ranked = sorted(self.entries.values(), key=lambda s: s.total_time)
+        for stat in ranked[:len(ranked) - self.max_entries]:
+            del self.entries[stat.query]
+            self.evictions += 1
+    def record(self, template, user, seconds, rows, size):
+        stat = self.entry(template)
+        stat.calls += 1
+        stat.total_time += seconds
+        stat.rows += rows
+        stat.bytes += size
+        if stat.min_time is None or seconds < stat.min_time:
+            stat.min_time = seconds
+        if seconds > stat.max_time:
+            stat.max_time = seconds
+        bucket = _bucket(seconds)
+        stat.histogram[bucket] = stat.histogram.get(bucket, 0) + 1
+        user_stat = stat.user(user, self.max_users)
+        user_stat.calls += 1
+        user_stat.total_time += seconds
+        user_stat.rows += rows
+        user_stat.bytes += size
+    def reject(self, template, user):
+        stat = self.entry(template)
+        stat.rejected += 1
+        stat.user(user, self.max_users).rejected += 1
+    def top(self, n=None, key='total_time'):
+        u"""
+        keyの多い順にn個の統計をdictのリストで返す
+        """
+        ranked = sorted(self.entries.values(),
+                        key=lambda s: getattr(s, key), reverse=True)
+        return [stat.as_dict() for stat in ranked[:n]]
+    def clear(self):
+        self.entries = {}
+    def __len__(self):
+        return len(self.entries)
+
+query_stats = QueryStats(setting.query_stats_entries,
+                         setting.query_stats_users,
+                         setting.query_stats_template_bytes)
+
+class QueryStatsResource(resource.Resource):
+    u"""
+    /queries?limit=20&order=calls でquery_stats.topをJSONで返す
+    """
+    isLeaf = True
+    orders = ('total_time', 'calls', 'rows', 'bytes', 'rejected')
+    def render_GET(self, request):
+        limit = int(request.args.get('limit', ['50'])[0])
+        order = request.args.get('order', ['total_time'])[0]
+        if order not in self.orders:
+            order = 'total_time'
+        request.setHeader('Content-Type', 'application/json')
+        return json.dumps(query_stats.top(limit, order), indent=1)
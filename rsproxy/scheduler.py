@@ -0,0 +1,200 @@
+"""
+Fair-share queue of the clients waiting for a backend.
+
+Each user (each app) has its own queue. Waiters are served in order of a
+virtual finish time (start-time fair queuing): every waiter of a user with
+weight w is due 1/w after that user's previous waiter, or after the
+current virtual time if the user has nothing queued. A user that queues
+many waiters at once therefore cannot delay another user's next waiter by
+more than one turn per unit of weight.
+
+A user may have at most maxDepth waiters queued, and a waiter is given up
+after maxWait seconds. Either limit fails the waiter's Deferred at once,
+with QueueFull or QueueTimeout, so that the client gets an error instead
+of waiting indefinitely.
+
+"""
+import heapq
+from itertools import count
+
+from twisted.internet import defer, reactor
+
+
+
+class QueueFull(Exception):
+    """
+    The user already has as many waiters queued as allowed.
+    """
+
+
+
+class QueueTimeout(Exception):
+    """
+    The waiter was not served within the allowed time.
+    """
+
+
+
+class WaitStats(object):
+    """
+    Wait times of one user's requests, in seconds. Requests served at once
+    count as waits of 0.
+    """
+
+    def __init__(self):
+        self.served = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.waitTotal = 0.0
+        self.waitMax = 0.0
+
+
+    def record(self, waited):
+        self.served += 1
+        self.waitTotal += waited
+        self.waitMax = max(self.waitMax, waited)
+
+
+    def asDict(self):
+        return {'served': self.served,
+                'rejected': self.rejected,
+                'timeouts': self.timeouts,
+                'wait_total': self.waitTotal,
+                'wait_max': self.waitMax}
+
+
+
+class _Waiter(object):
+    __slots__ = ['user', 'deferred', 'queued', 'timeout', 'done']
+
+    def __init__(self, user, queued):
+        self.user = user
+        self.deferred = None
+        self.queued = queued
+        self.timeout = None
+        self.done = False
+
+
+
+class FairScheduler(object):
+    """
+    Usage:
+
+        d = scheduler.enqueue(user)   # fires with the value given to serve
+        scheduler.serve(backend)      # serves the next waiter, if any
+
+    Cancelling the Deferred returned by enqueue gives up the place in the
+    queue. Weights map users to their share, 1 by default.
+    """
+
+    def __init__(self, maxDepth=0, maxWait=0, weights=None, clock=reactor):
+        self.maxDepth = maxDepth
+        self.maxWait = maxWait
+        self.weights = weights or {}
+        self.clock = clock
+
+        # (finish time, sequence number, _Waiter). Waiters that were
+        # cancelled or timed out stay in the heap, marked done, until
+        # they come up.
+        self._heap = []
+        self._sequence = count()
+        self._virtualTime = 0.0
+
+        # The finish time of each user's last waiter.
+        self._finish = {}
+
+        # The number of waiters queued of each user, and in total.
+        self.depth = {}
+        self._count = 0
+
+        self.stats = {}
+
+
+    def __len__(self):
+        return self._count
+
+
+    def statsFor(self, user):
+        stats = self.stats.get(user)
+        if stats is None:
+            stats = self.stats[user] = WaitStats()
+        return stats
+
+
+    def enqueue(self, user):
+        """
+        Returns a Deferred that fires with the value passed to serve when
+        it is the user's turn, or fails with QueueFull or QueueTimeout.
+        """
+        if self.maxDepth and self.depth.get(user, 0) >= self.maxDepth:
+            self.statsFor(user).rejected += 1
+            return defer.fail(QueueFull(
+                    'too many requests waiting for a backend: %s' % user))
+
+        waiter = _Waiter(user, self.clock.seconds())
+        waiter.deferred = defer.Deferred(lambda d: self._remove(waiter))
+        start = max(self._virtualTime, self._finish.get(user, 0.0))
+        finish = self._finish[user] = start + 1.0 / self.weights.get(user, 1)
+        heapq.heappush(self._heap, (finish, next(self._sequence), waiter))
+        self.depth[user] = self.depth.get(user, 0) + 1
+        self._count += 1
+        if self.maxWait:
+            waiter.timeout = self.clock.callLater(
+                self.maxWait, self._expire, waiter)
+        return waiter.deferred
+
+
+    def serve(self, value):
+        """
+        Fires the Deferred of the next waiter with value. Returns False if
+        nobody is waiting.
+        """
+        waiter = self._next()
+        if waiter is None:
+            return False
+        self.statsFor(waiter.user).record(self.clock.seconds() - waiter.queued)
+        waiter.deferred.callback(value)
+        return True
+
+
+    def fail(self, failure):
+        """
+        Fails the Deferred of the next waiter. Returns False if nobody is
+        waiting.
+        """
+        waiter = self._next()
+        if waiter is None:
+            return False
+        waiter.deferred.errback(failure)
+        return True
+
+
+    def _next(self):
+        while self._heap:
+            finish, _, waiter = heapq.heappop(self._heap)
+            if waiter.done:
+                continue
+            self._virtualTime = finish
+            self._remove(waiter)
+            return waiter
+        return None
+
+
+    def _remove(self, waiter):
+        if waiter.done:
+            return
+        waiter.done = True
+        if waiter.timeout is not None and waiter.timeout.active():
+            waiter.timeout.cancel()
+        self.depth[waiter.user] -= 1
+        if not self.depth[waiter.user]:
+            del self.depth[waiter.user]
+        self._count -= 1
+
+
+    def _expire(self, waiter):
+        waiter.timeout = None
+        self._remove(waiter)
+        self.statsFor(waiter.user).timeouts += 1
+        waiter.deferred.errback(QueueTimeout(
+                'timed out waiting for a backend: %s' % waiter.user))
@@ -1,67 +1,156 @@
 """
-Module containing the protocols that make up the proxy, as well 
+Module containing the protocols that make up the proxy, as well
 as the factory that creates protocols for new client connections.
 
-There is only one connection to the postgres backend at a time, 
-so no postgres protocol factory is necessary. The postgres backend 
-protocol is created as needed by the client factory. 
+Clients authenticate with the proxy itself. Backend connections are
+kept in one pool.BackendPool per database and server, and a client is
+attached to one of them while it needs the backend (see the pool module
+for when a backend is given back). Each user (tenant) is served by the
+server of its shard in setting.tenant_shards, or by server-host.
 
-The single postgres backend protocol maintains a list of its clients,
-and designates one of them as the active connection, which will 
-receive the replies. 
+Each backend connection has at most one client attached. In transaction
+mode, other clients may pipeline simple SELECT queries on a backend that
+has no client attached; the replies are routed to the owner of each query
+in the order the queries were sent.
 
 """
+import random
+import time
 from itertools import count
 from twisted.internet import reactor, defer, protocol
-from twisted.python import log
-
+from twisted.python import failure, log
+
+import filters
+import logger
+import metrics
+import queryfilter
+import setting
+import supervisor
 from protocol import FilteringProtocol
 from parser import FrontendParser, BackendParser, terminate
 from filters import FrontendFilter, BackendFilter
+from filters import createCancelMessage, createErrorMessage
+from filters import createQueryMessage, createStartupMessage
+from filters import createZMessage
+from pool import BackendPool
+from scheduler import FairScheduler, QueueFull, QueueTimeout
+
+_systemRandom = random.SystemRandom()
+
+class InFlight(object):
+    """
+    A Query or Sync sent to a backend, whose replies up to and including
+    the ReadyForQuery are for owner. The owner is a PGProxyProtocol, or
+    None for the proxy's own queries, whose replies are collected and
+    passed to deferred. 
+    """
+    __slots__ = ['owner', 'deferred', 'replies', 'then', 'capture',
+                 'captured', 'completed', 'sent', 'rows', 'bytes']
+
+    def __init__(self, owner, deferred=None):
+        self.owner = owner
+        self.deferred = deferred
+        self.replies = []
+        self.sent = time.time()
+
+        # DataRows and bytes received for this entry, but for the
+        # ReadyForQuery.
+        self.rows = 0
+        self.bytes = 0
+
+        # (client, data) pairs to write once this entry is complete.
+        self.then = []
+
+        # If a list, the data passed to the owner before the ReadyForQuery
+        # is collected in it, unless there is an ErrorResponse among it or
+        # it grows past result_cache_max_reply bytes.
+        self.capture = None
+        self.captured = 0
+
+        # Functions called with the transaction status and the captured
+        # data (or None) once this entry is complete, or with None and
+        # None if the backend is lost first.
+        self.completed = []
+
 
-class PostgresClientProtocol(FilteringProtocol):
-    pgproxyFactory = None
 
+class PostgresClientProtocol(FilteringProtocol):
     messageType = BackendParser
     filterType = BackendFilter
+    sender = 'backend'
     dead = False
     in_test = False
     transactionStatus = None
 
 
-    def __init__(self):
+    def __init__(self, pool):
         FilteringProtocol.__init__(self)
-        
-        # The list of clients is maintained as a stack because disconnections
-        # automatically designate the next one in the list as the active. 
-        # However, queries can be received from clients in any order. When a 
-        # frontend recieves a query, it will call this instance back so that 
-        # we know to send it the reply. 
-        self.clientStack = []
+        self.pool = pool
+
+        # The client the backend is attached to, if any. Other clients may
+        # still have simple queries in flight on it (see InFlight). 
+        self.client = None
 
         # The first set of authentication response messages (between the
-        # AuthenticationOk/R and the ReadyForQuery/Z) are saved here. 
+        # AuthenticationOk/R and the ReadyForQuery/Z) are saved here.
         self.authenticationResponse = []
 
+        # The (pid, key) of the BackendKeyData message.
+        self.backendKey = None
+
+        # Fires with this protocol once it has authenticated.
+        self.ready = defer.Deferred()
+
+        # The InFlight entries in the order they were sent. Replies are 
+        # routed to the owner of the first one. 
+        self.inflight = []
+
+        # Deferreds waiting for self.inflight to be empty.
+        self._drainWaiters = []
+
+        self._idleTimeout = None
+
 
     def setTransactionStatus(self, status):
         self.transactionStatus = status
 
 
     def connectionMade(self):
-        log.msg('PostgresClientProtocol connection made: %s' % id(self))
+        logger.debug('connection', 'PostgresClientProtocol connection made: %s',
+                     id(self))
+        FilteringProtocol.connectionMade(self)
+        startup = createStartupMessage(setting.dbuser, self.pool.database)
+        self.transport.write(startup.serialize())
 
 
-    def connectionLost(self, *a):
-        log.msg('PostgresClientProtocol connection lost.')
-        self.pgproxyFactory.postgresClientLost()
+    def connectionLost(self, reason=protocol.connectionDone):
+        logger.debug('connection', 'PostgresClientProtocol connection lost.')
         self.dead = True
+        self.cancelIdleTimeout()
+        if not self.ready.called:
+            self.ready.errback(reason)
+        inflight, self.inflight = self.inflight, []
+        clients = set()
+        for entry in inflight:
+            for completed in entry.completed:
+                completed(None, None)
+            if entry.deferred is not None:
+                if not entry.deferred.called:
+                    entry.deferred.errback(reason)
+            elif entry.owner is not None:
+                clients.add(entry.owner)
+        if self.client is not None:
+            clients.add(self.client)
+        self._drained(reason)
+        self.pool.backendLost(self)
+        for client in clients:
+            client.backendLost()
 
 
     def signalTest(self, value):
         """
-        Called to start or end a test. Inside tests, BEGIN/(ROLLBACK|COMMIT) 
-        pairs are rewritten to use savepoints.        
+        Called to start or end a test. Inside tests, BEGIN/(ROLLBACK|COMMIT)
+        pairs are rewritten to use savepoints.
         """
         self.in_test = value
 
@@ -72,86 +161,240 @@ class PostgresClientProtocol(FilteringProtocol):
 
     def attachClient(self, client):
         """
-        Adds a new client to the list. 
+        Makes client the receiver of the replies.
         """
-        if self.parsingMessage:
-            raise AssertionError(
-                'Still parsing a message, but attaching client.')
-        log.msg('Attaching new client.')
-        self.clientStack.append(client)
+        if self.client is not None:
+            raise AssertionError('Attaching a client to a backend in use.')
+        self.client = client
+
 
+    def currentClient(self):
+        """
+        Returns the current client (the one that will receive reply messages).
+        """
+        if self.inflight:
+            return self.inflight[0].owner
+        return self.client
+
+
+    getPeer = currentClient
 
-    def detachClient(self, client):
+
+    def writers(self):
+        if self.client is not None:
+            return [self.client]
+        return []
+
+
+    def authenticated(self):
         """
-        Called when a client has disconnected. 
+        Called by the filter when the authentication handshake is over.
         """
-        log.msg('Detaching client.')
-        if self.parsingMessage:
-            self.discardMessage()
-        self.clientStack.remove(client)
+        logger.info('pool', 'Backend of %s authenticated.', self.pool.database)
+        self.ready.callback(self)
 
 
-    def activateClient(self, client):
+    def authenticationFailed(self, msg):
         """
-        Activates a client that is already attached. 
+        Called by the filter with the ErrorResponse received instead of
+        authentication.
+        """
+        if not self.ready.called:
+            self.ready.errback(
+                ValueError('Backend authentication failed: %s' % msg))
+        self.transport.loseConnection()
+
+
+    def expectReady(self, owner):
         """
-        if client == self.currentClient():
+        Called when owner sends a Query or Sync, each of which is answered
+        by one ReadyForQuery. Returns the InFlight entry.
+        """
+        entry = InFlight(owner)
+        self.inflight.append(entry)
+        return entry
+
+
+    def inflightOf(self, owner):
+        """
+        Returns the number of owner's queries in flight. 
+        """
+        n = 0
+        for entry in self.inflight:
+            if entry.owner is owner:
+                n += 1
+        return n
+
+
+    def replyAfter(self, client, data):
+        """
+        Writes data to the client once the replies to everything in flight
+        have been passed on, so that the client sees them in order. 
+        """
+        if not self.inflight:
+            client.bufferedWrite(client.transport, data)
             return
-        self.clientStack.remove(client)
-        self.clientStack.append(client)
+        self.inflight[-1].then.append((client, data))
 
 
-    def currentClient(self):
+    def messagesCounted(self, msgtype, count, size):
+        FilteringProtocol.messagesCounted(self, msgtype, count, size)
+        # A run ending with a ReadyForQuery is counted after the entry it
+        # completes has been taken off inflight.
+        if msgtype != 'Z' and self.inflight:
+            entry = self.inflight[0]
+            entry.bytes += size
+            if msgtype == 'D':
+                entry.rows += count
+
+
+    def readyForQuery(self):
         """
-        Returns the current client (the one that will receive reply messages). 
+        Called after the ReadyForQuery of the first entry in flight has
+        been passed to its owner. 
         """
-        if not self.clientStack:
-            return None
-        return self.clientStack[-1]
+        entry = self.inflight.pop(0)
+        metrics.queryDuration.observe((self.pool.database,),
+                                      time.time() - entry.sent)
+        for client, data in entry.then:
+            self.bufferedWrite(client.transport, data)
+        for completed in entry.completed:
+            completed(self.transactionStatus, entry.capture)
+        if entry.owner is not None:
+            self.releaseIfIdle(entry.owner)
+        if not self.inflight:
+            if self.client is None:
+                self.pool.touch(self)
+            self._drained(self)
+
+
+    def releaseIfIdle(self, client):
+        """
+        Called when the client may be done with the backend. A client that
+        only had simple queries in flight here is detached once they are
+        answered. In transaction mode, the backend is given back to the
+        pool if it is outside a transaction and none of its client's
+        replies are outstanding. Neither happens while one of the client's
+        queries is being checked, or while it has sent extended query
+        messages without their Sync, whose replies would otherwise go to
+        the backend's next client.
+        """
+        filter = client.filter
+        if self.inflightOf(client) or filter.checking or filter.unsynced:
+            return
+        if client is not self.client:
+            if client.postgresProtocol is self:
+                client.detachBackend()
+        elif (self.pool.mode == 'transaction' and 
+              self.transactionStatus == 'idle' and not client.pinned()):
+            self.pool.release(self)
 
 
-    getPeer = currentClient
+    def whenDrained(self):
+        """
+        Returns a Deferred that fires when nothing is in flight. 
+        """
+        if not self.inflight:
+            return defer.succeed(self)
+        d = defer.Deferred()
+        self._drainWaiters.append(d)
+        return d
+
+
+    def _drained(self, result):
+        waiters, self._drainWaiters = self._drainWaiters, []
+        for d in waiters:
+            if isinstance(result, failure.Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+
+    def writePeer(self, messages):
+        if self.inflight and self.inflight[0].capture is not None:
+            for m in messages:
+                if m.type == 'E':
+                    self.inflight[0].capture = None
+                    break
+                if m.type != 'Z':
+                    self._capture(m.serialize())
+        return FilteringProtocol.writePeer(self, messages)
+
+
+    def writeRawPeer(self, data):
+        if self.inflight and self.inflight[0].capture is not None:
+            self._capture(data)
+        return FilteringProtocol.writeRawPeer(self, data)
+
+
+    def _capture(self, data):
+        entry = self.inflight[0]
+        entry.capture.append(data)
+        entry.captured += len(data)
+        if entry.captured > setting.result_cache_max_reply:
+            entry.capture = None
+
+
+    def runQuery(self, query):
+        """
+        Sends a query on behalf of the proxy. Returns a Deferred that fires
+        with the list of reply messages, up to and including ReadyForQuery,
+        or fails if the backend replied with an ErrorResponse.
+        """
+        d = defer.Deferred()
+        self.inflight.append(InFlight(None, d))
+        self.transport.write(createQueryMessage(query).serialize())
+        return d
+
+
+    def passThrough(self, msgtype):
+        if self.inflight and self.inflight[0].owner is None:
+            return False
+        return FilteringProtocol.passThrough(self, msgtype)
+
+
+    def messageReceived(self, msg):
+        if self.inflight and self.inflight[0].owner is None:
+            entry = self.inflight[0]
+            entry.replies.append(msg)
+            if msg.type == 'Z':
+                self.setTransactionStatus(msg.transaction_status)
+                self.readyForQuery()
+                if entry.deferred.called:
+                    # Cancelled, as by a health check that timed out.
+                    return None
+                errors = [m for m in entry.replies if m.type == 'E']
+                if errors:
+                    entry.deferred.errback(
+                        ValueError('Query failed: %s' % errors[0]))
+                else:
+                    entry.deferred.callback(entry.replies)
+            return None
+
+        authenticating = not self.authenticationComplete
+        result = FilteringProtocol.messageReceived(self, msg)
+        if msg.type == 'Z' and not authenticating and self.inflight:
+            self.readyForQuery()
+        return result
 
-    def clearAuthMessage(self):
-        self.authenticationResponse = []
 
     def saveAuthMessage(self, msg):
         """
-        Stores an authentication response method. Also keeps track of
-        server settings. The original authentication response as well as
-        an updated set of server settings is sent to new clients as 
-        they connect. 
+        Stores an authentication response message. The ParameterStatus
+        messages among them are sent to new clients as they authenticate.
         """
         if self.authenticationComplete:
-            if msg.type == 'S':
-                # If a parameter has been SET, add to the authentication 
-                # message, overwriting the previous value if it's there. 
-                self.overwriteSetting(msg)
-                return
-
-            # otherwise this is not expected. 
             raise AssertionError(
                 'Adding auth message, but authentication complete')
-        log.msg('Saving authentication message: %s' % msg)
+        logger.debug('auth', 'Saving authentication message: %s', msg)
         self.authenticationResponse.append(msg)
 
-        
-    def overwriteSetting(self, msg):
-        """
-        Given a parameter status backend message, replaces the same named 
-        parameter in the authentication response that will be sent to later
-        clients.
-        """
-        for i, x in zip(count(0), self.authenticationResponse):
-            if getattr(x, 'name', '') == msg.name:
-                self.authenticationResponse[i] = msg
-
 
     def ignoreMessages(self, messageTypes):
         """
         Given a string in which the characters are the sequence of
         message types to ignore, causes the protocol to drop the messages
-        as they are received in that order. 
+        as they are received in that order.
         """
         self.filter.ignoreMessages(messageTypes)
 
@@ -159,39 +402,67 @@ class PostgresClientProtocol(FilteringProtocol):
     @property
     def authenticationComplete(self):
         """
-        Returns true if the authentication handshake has been fully received. 
+        Returns true if the authentication handshake has been fully received.
         """
         if not self.authenticationResponse:
             return False
 
-        # This is true if the last message in the auth response is 
-        # ReadyForQuery. 
+        # This is true if the last message in the auth response is
+        # ReadyForQuery.
         last = self.authenticationResponse[-1]
         return last.type == 'Z'
 
 
+    def setIdleTimeout(self, seconds, expire):
+        self.cancelIdleTimeout()
+        self._idleTimeout = reactor.callLater(seconds, expire, self)
+
+
+    def cancelIdleTimeout(self):
+        if self._idleTimeout is not None:
+            if self._idleTimeout.active():
+                self._idleTimeout.cancel()
+            self._idleTimeout = None
+
+
     def terminate(self):
         """
-        Shuts down the PG connection. This only happens when PGProxy
-        is shutting down.
+        Shuts down the PG connection.
         """
-        self.transport.write('X\x00\x00\x00\x04')
+        self.transport.write(terminate().serialize())
+        self.transport.loseConnection()
 
 
 class PGProxyProtocol(FilteringProtocol):
     """
     Protocol that represents one client frontend connection. There are many
-    of these and one PostgresProtocol. 
+    of these, each attached to a PostgresClientProtocol from the pool while
+    it needs the backend.
     """
 
     messageType = FrontendParser
     filterType = FrontendFilter
+    sender = 'client'
 
 
     def __init__(self):
         FilteringProtocol.__init__(self)
         self.postgresProtocol = None
 
+        # The (pid, key) pair given to the client for cancel requests.
+        self.cancelKey = None
+
+        # The Deferred of a pending BackendPool.acquire.
+        self._acquiring = None
+
+        # True while messages are held until the simple queries this client
+        # has in flight on a shared backend are answered. 
+        self._waitingForDetach = False
+
+        # Until this time, the client's SELECTs do not go to the replicas,
+        # so that it reads its own writes. 
+        self.primaryUntil = 0
+
 
     def signalTest(self, value):
         """
@@ -200,7 +471,7 @@ class PGProxyProtocol(FilteringProtocol):
         """
         self.postgresProtocol.signalTest(value)
 
-    
+
     def inTest(self):
         """
         Returns true if the proxy is currently in a test.
@@ -209,120 +480,485 @@ class PGProxyProtocol(FilteringProtocol):
 
 
     def connectionMade(self):
-        log.msg('PGProxyProtocol connection made.')
-        return self.factory.attachPostgresProtocol(self)
+        logger.debug('connection', 'PGProxyProtocol connection made.')
+        FilteringProtocol.connectionMade(self)
+        self.factory.registerClient(self)
 
 
     def connectionLost(self, reason=protocol.connectionDone):
-        log.msg('PGProxyProtocol connection lost')
-        if self.postgresProtocol:
-            #  HACK: Rollback savepoints on disconnect
-            #self.postgresProtocol.terminate()
-            self.postgresProtocol.detachClient(self)
+        logger.debug('connection', 'PGProxyProtocol connection lost')
+        self.connected = 0
+        self.factory.unregisterClient(self)
+        self.factory.pausedClients.discard(self)
+        if self._acquiring is not None:
+            self._acquiring.cancel()
+        backend = self.postgresProtocol
+        if backend is not None and backend.client is self:
+            backend.pool.release(backend, reset=True)
+        self.postgresProtocol = None
+
+
+    def shard(self):
+        """
+        Returns the name of the shard that serves the client's user, or
+        None for the server in the proxy's config.
+        """
+        return setting.tenant_shards.get(self.filter.userAuth.user)
+
+
+    def pool(self):
+        """
+        Returns the pool of the database the client asked for, on the
+        server of its shard.
+        """
+        return self.factory.getPool(self.filter.database, self.shard())
 
 
     def getPeer(self):
         return self.postgresProtocol
 
 
+    def writers(self):
+        if self.postgresProtocol:
+            return [self.postgresProtocol]
+        return []
+
+
+    def pinned(self):
+        """
+        Returns True if the client must keep its backend even between
+        transactions, because it has named prepared statements there.
+        The unnamed statement does not pin the backend; the client
+        forgets it when the backend is detached (see detachBackend).
+        """
+        for name in self.filter.statements:
+            if name:
+                return True
+        return False
+
+
+    def detachBackend(self):
+        """
+        Called when the backend is taken away from this client. The
+        unnamed statement stays behind on the backend, so the client
+        must Parse it again before it can Bind it on its next backend,
+        rather than Bind whatever another client left there. After
+        a backend of its own, the client reads from the primary for
+        setting.replica_after_write seconds.
+        """
+        backend = self.postgresProtocol
+        if backend is not None and backend.client is self:
+            self.primaryUntil = time.time() + setting.replica_after_write
+        self.postgresProtocol = None
+        self.filter.forgetStatement('')
+        if self._waitingForDetach:
+            self._waitingForDetach = False
+            self._acquire()
+
+
+    def backendLost(self):
+        """
+        Called when the connection to the attached backend is lost.
+        """
+        logger.info('connection', 'Backend lost, disconnecting client.')
+        self.postgresProtocol = None
+        self.transport.loseConnection()
+
+
+    def hasBackendFor(self, msg):
+        """
+        Returns True if the message can be sent to the backend now. A
+        simple SELECT query may be pipelined on a backend shared with other
+        clients: on a read replica, or in transaction mode on the primary. 
+        """
+        backend = self.postgresProtocol
+        if backend is not None and backend.client is self:
+            return True
+        select = (msg is not None and msg.type == 'Q' and
+                  queryfilter.is_single_select(msg.data[:-1]))
+        if backend is not None:
+            # Queries after the ones in flight on a shared backend must
+            # go there too, to be answered in order. 
+            depth = backend.pool.pipelineDepth()
+            return select and len(backend.inflight) < depth
+        if not select:
+            return False
+        backend = None
+        if self.shard() is None and time.time() >= self.primaryUntil:
+            backend = self.factory.replicaFor(self.filter.database)
+        if backend is None:
+            backend = self.pool().acquireShared()
+        self.postgresProtocol = backend
+        return backend is not None
+
+
+    def acquireBackend(self, handler, arg):
+        """
+        Holds the message and the ones received after it until a backend
+        has been acquired from the pool for this client alone.
+        """
+        self.holdMessages('backend', (handler, arg))
+        if self.postgresProtocol is not None:
+            # The backend is shared; wait for this client's queries there
+            # to be answered first. 
+            self._waitingForDetach = True
+            return
+        self._acquire()
+
+
+    def _acquire(self):
+        d = self._acquiring = self.pool().acquire(self.filter.userAuth.user)
+        d.addCallbacks(self._gotBackend, self._noBackend)
+
+
+    def _gotBackend(self, backend):
+        self._acquiring = None
+        backend.attachClient(self)
+        self.postgresProtocol = backend
+        self.releaseMessages('backend')
+
+
+    def _noBackend(self, failure):
+        self._acquiring = None
+        if failure.check(defer.CancelledError):
+            return
+        if failure.check(QueueFull, QueueTimeout):
+            handler, msg = self._held[0]
+            if handler == self.messageReceived and msg.type == 'Q':
+                # Only this query fails; the client may try again.
+                logger.info('pool', 'Rejecting query: %s',
+                            failure.getErrorMessage())
+                del self._held[0]
+                error = createErrorMessage(failure.getErrorMessage(),
+                                           __file__, 0, 'acquireBackend')
+                for m in (error, createZMessage('I')):
+                    self.bufferedWrite(self.transport, m.serialize())
+                self.releaseMessages('backend')
+                return
+        log.err(failure, 'No backend for %s' % self.filter.database)
+        error = createErrorMessage('could not connect to the server',
+                                   __file__, 0, 'acquireBackend')
+        self.transport.write(error.serialize())
+        self.transport.loseConnection()
+
+
+    def holdWhilePaused(self, handler, arg):
+        """
+        Holds the message until the factory resumes, and returns True, if
+        the factory is paused and the client has no backend of its own.
+        Clients with a backend of their own go on, so that the transactions
+        under way can finish.
+        """
+        backend = self.postgresProtocol
+        if (not self.factory.paused or
+            backend is not None and backend.client is self):
+            return False
+        self.holdMessages('paused', (handler, arg))
+        self.factory.pausedClients.add(self)
+        return True
+
+
     def messageReceived(self, msg):
-        # tell the postgres protocol to mark this one as the active, 
-        # because it will need to see the reply for this message. 
-        self.postgresProtocol.activateClient(self)
+        if (self._held is None and msg.type == 'Q' and
+            (self.filter.answerFromCache(msg) or
+             self.filter.joinSharedQuery(msg))):
+            return None
+        if self._held is None and self.filter.needsBackend(msg.type):
+            if self.holdWhilePaused(self.messageReceived, msg):
+                return None
+            if not self.hasBackendFor(msg):
+                return self.acquireBackend(self.messageReceived, msg)
         return FilteringProtocol.messageReceived(self, msg)
 
 
+    def rawDataReceived(self, data):
+        if self._held is None:
+            if self.holdWhilePaused(self.rawDataReceived, data):
+                return None
+            if not self.hasBackendFor(None):
+                return self.acquireBackend(self.rawDataReceived, data)
+        return FilteringProtocol.rawDataReceived(self, data)
+
+
 
 class PGProxyServerFactory(protocol.ServerFactory):
     """
-    Class responsible for creating new PGProxyProtocol instances as 
-    client connections are received. 
+    Class responsible for creating new PGProxyProtocol instances as
+    client connections are received.
 
-    This also maintains at most one PostgresProtocol instance at a time, 
-    that is shared among the client protocols. 
+    This also maintains the backend pools of each database, on the
+    primary, on each read replica and on each shard, and the keys that
+    clients use to cancel their queries.
     """
 
     protocol = PGProxyProtocol
 
-    # This may hold a deferred if the postgres protocol is already being 
-    # created. 
-    creatingPostgresProtocol = None
 
-    
     def __init__(self, pgproxy):
         self.pgproxy = pgproxy
-        self.postgresProtocol = None
+        self.pools = {}
+        self.replicaPools = {}
+        self.cancelKeys = {}
+        self._pids = count(1)
+
+        # The number of this worker process (see supervisor.py), put in
+        # the pids of the cancel keys, or None if there are no workers.
+        self.workerId = None
 
-        # Give postgres clients access to this factory
-        PostgresClientProtocol.pgproxyFactory = self
+        # While paused, the clients whose messages are held.
+        self.paused = False
+        self.pausedClients = set()
+
+
+    def startFactory(self):
+        metrics.clients.callback = lambda: {(): len(self.cancelKeys)}
+        metrics.backends.callback = self.backendStates
+        metrics.waiting.callback = self.waitingClients
+        for database in setting.pool_prewarm:
+            logger.info('pool', 'Opening backends of %s.', database)
+            self.getPool(database)
+            self.getReplicaPools(database)
+            for shard in setting.shards:
+                self.getPool(database, shard)
 
 
     def stopFactory(self):
-        if self.postgresProtocol:
-            log.msg('Sending terminate to postgres.')
-            self.postgresProtocol.terminate()
+        for pool in self.pools.values():
+            logger.info('pool', 'Sending terminate to postgres.')
+            pool.close()
+        for pools in self.replicaPools.values():
+            for pool in pools:
+                pool.close()
 
 
-    def attachPostgresProtocol(self, pgproxyProtocol):
+    def getPool(self, database, shard=None):
         """
-        Connects a new pgproxy protocol instance to the single
-        PostgresClientProtocol.
+        Returns the backend pool of the database on the server of the
+        shard, creating it if needed.
         """
-        def attach(s):
-            s.attachClient(pgproxyProtocol)
-            pgproxyProtocol.postgresProtocol = s
-            return s
+        pool = self.pools.get((database, shard))
+        if pool is None:
+            if shard is None:
+                host = self.pgproxy.config['server-host']
+                port = self.pgproxy.config['server-port']
+            else:
+                host, port = setting.shards[shard]
+            pool = BackendPool(host, port, database,
+                               setting.pool_min_size,
+                               setting.pool_max_size,
+                               setting.pool_mode,
+                               FairScheduler(setting.scheduler_max_depth,
+                                             setting.scheduler_max_wait,
+                                             setting.scheduler_weights),
+                               setting.pool_health_check_interval)
+            self.pools[(database, shard)] = pool
+        return pool
+
+
+    def getReplicaPools(self, database):
+        """
+        Returns the backend pools of the database on each read replica.
+        """
+        pools = self.replicaPools.get(database)
+        if pools is None:
+            pools = self.replicaPools[database] = [
+                BackendPool(host, port, database,
+                            setting.replica_pool_size,
+                            setting.replica_pool_size,
+                            'transaction',
+                            None,
+                            setting.pool_health_check_interval,
+                            replica=True,
+                            pipeline=setting.replica_pipeline_depth)
+                for host, port in setting.replicas]
+        return pools
+
+
+    def replicaFor(self, database):
+        """
+        Returns the replica backend with the fewest queries outstanding
+        that can take another simple query, skipping replicas that lag
+        more than replica_max_lag, or None.
+        """
+        best = None
+        maxLag = setting.replica_max_lag
+        for pool in self.getReplicaPools(database):
+            if maxLag is not None and (pool.lag is None or pool.lag > maxLag):
+                continue
+            backend = pool.sharedCandidate()
+            if backend is not None and (
+                best is None or len(backend.inflight) < len(best.inflight)):
+                best = backend
+        if best is not None:
+            best.pool.acquireShared(best)
+        return best
+
+
+    def registerClient(self, client):
+        """
+        Gives the client a key for cancel requests. The key is drawn from
+        the OS's random source, since a client that could predict other
+        clients' keys could cancel their queries.
+        """
+        pid = self._pids.next()
+        if self.workerId is not None:
+            pid = (self.workerId << supervisor.PID_BITS |
+                   pid & (1 << supervisor.PID_BITS) - 1)
+        client.cancelKey = (pid, _systemRandom.getrandbits(31))
+        self.cancelKeys[client.cancelKey] = client
 
-        if self.postgresProtocol:
-            # Not the first client. Attach immediately. 
-            return defer.succeed(attach(self.postgresProtocol))
 
-        # If this is the first client, we need to stop reading from 
-        # it until the connection is made. 
-        pgproxyProtocol.transport.pauseProducing()
-        def resume(s):
-            pgproxyProtocol.transport.resumeProducing()
-            return s
+    def unregisterClient(self, client):
+        self.cancelKeys.pop(client.cancelKey, None)
 
-        d = self.makePostgresProtocol().addCallback(attach)
-        return d.addCallback(resume)
 
+    def pause(self):
+        """
+        Holds the messages of clients without a backend of their own until
+        resume is called.
+        """
+        logger.info('pool', 'Pausing clients.')
+        self.paused = True
 
-    def postgresClientLost(self):
-        log.msg('Factory reset - postgres client lost')
-        self.postgresProtocol = None
+
+    def resume(self):
+        """
+        Handles the messages held since pause.
+        """
+        logger.info('pool', 'Resuming %d paused clients.',
+                    len(self.pausedClients))
+        self.paused = False
+        clients, self.pausedClients = self.pausedClients, set()
+        for client in clients:
+            client.releaseMessages('paused')
 
 
-    def makePostgresProtocol(self):
+    def waitStats(self):
         """
-        Creates the postgres server connection. This is called only if 
-        self.postgresProtocol is not set. 
+        Returns the backend wait times of each user, per database, and
+        per database@shard for the shards.
         """
-        if self.creatingPostgresProtocol:
-            log.msg('Already creating postgres protocol')
-            return self.creatingPostgresProtocol
+        stats = {}
+        for (database, shard), pool in self.pools.items():
+            if shard is not None:
+                database = '%s@%s' % (database, shard)
+            stats[database] = dict([(user, s.asDict()) for user, s
+                                    in pool.scheduler.stats.items()])
+        return stats
 
-        log.msg('Creating Postgres connection.')
-        def gotProto(p):
-            if p.dead:
-                log.msg('PostgresClientProtocol died immediately.')
-                return
 
-            if self.postgresProtocol:
-                if self.postgresProtocol.dead:
-                    log.msg('Already had postgres protocol, but it was dead.')
-                else:
-                    log.msg('Already had postgres protocol')
-                    return self.postgresProtocol
+    def stats(self):
+        """
+        Returns the statistics of this process: the number of clients,
+        the backends of each pool, the backend wait times and the caches.
+        """
+        pools = {}
+        for (database, shard), pool in self.pools.items():
+            if shard is not None:
+                database = '%s@%s' % (database, shard)
+            pools[database] = {'backends': len(pool), 'idle': len(pool.idle)}
+        return {'clients': len(self.cancelKeys),
+                'pools': pools,
+                'wait': self.waitStats(),
+                'result_cache': filters.result_cache.stats(),
+                'verdict_cache': queryfilter.verdict_cache.stats()}
+
+
+    def allPools(self):
+        """
+        Returns (name, pool) for every pool, with the primary's pools
+        named after their database, the shards' database@shard and the
+        replicas' database@host:port.
+        """
+        pools = []
+        for (database, shard), pool in self.pools.items():
+            if shard is not None:
+                database = '%s@%s' % (database, shard)
+            pools.append((database, pool))
+        for database, replicas in self.replicaPools.items():
+            for pool in replicas:
+                pools.append(('%s@%s:%s' % (database, pool.host, pool.port),
+                              pool))
+        return pools
+
+
+    def backendStates(self):
+        """
+        Returns the number of backends of each pool that are connecting
+        (or authenticating), idle (not attached to a client) and attached,
+        for metrics.backends.
+        """
+        states = {}
+        for name, pool in self.allPools():
+            ready = len([b for b in pool.backends if b.authenticationComplete])
+            idle = len(pool.idle)
+            states[(name, 'connecting')] = pool.connecting
+            states[(name, 'idle')] = idle
+            states[(name, 'attached')] = ready - idle
+        return states
+
 
-            log.msg('Got PostgresClientProtocol instance.')
-            self.postgresProtocol = p
-            self.creatingPostgresProtocol = None
-            return p
+    def waitingClients(self):
+        return dict([((name, ), len(pool.scheduler))
+                     for name, pool in self.allPools()])
 
-        cc = protocol.ClientCreator(reactor, PostgresClientProtocol)
-        self.creatingPostgresProtocol = cc.connectTCP(
-            self.pgproxy.config['server-host'],
-            self.pgproxy.config['server-port']).addCallback(gotProto)
-        return self.creatingPostgresProtocol
 
+    def cancelTarget(self, client):
+        """
+        Returns the backend a cancel request of the client should go to:
+        its own backend, or a shared backend running its query. 
+        """
+        backend = client.postgresProtocol
+        if backend is None:
+            return None
+        if backend.client is client:
+            return backend
+        if backend.inflight and backend.inflight[0].owner is client:
+            return backend
+        return None
+
+
+    def cancel(self, pid, key):
+        """
+        Forwards a cancel request to the backend the client with the given
+        key is attached to. On a shared backend, the request is only
+        forwarded while the client's query is the one running there, as
+        it would cancel another client's query otherwise. A request for a
+        client of another worker is passed on to that worker.
+        """
+        if (self.workerId is not None and
+            pid >> supervisor.PID_BITS != self.workerId):
+            return self.forwardCancel(pid, key)
+        client = self.cancelKeys.get((pid, key))
+        if client is None:
+            return
+        backend = self.cancelTarget(client)
+        if backend is None or backend.backendKey is None:
+            return
+        def send(p):
+            # The client's query may have finished while connecting.
+            if self.cancelTarget(client) is backend:
+                p.transport.write(
+                    createCancelMessage(*backend.backendKey).serialize())
+            p.transport.loseConnection()
+        cc = protocol.ClientCreator(reactor, protocol.Protocol)
+        d = cc.connectTCP(backend.pool.host, backend.pool.port)
+        d.addCallbacks(send, lambda f: log.err(f, 'Cancel request failed'))
+
+
+    def forwardCancel(self, pid, key):
+        """
+        Sends a cancel request to the worker whose number is in the pid.
+        """
+        path = supervisor.cancelSocket(self.pgproxy.config['listen-port'],
+                                       pid >> supervisor.PID_BITS)
+        def send(p):
+            p.transport.write(createCancelMessage(pid, key).serialize())
+            p.transport.loseConnection()
+        def failed(f):
+            # The worker may have exited, with its clients.
+            logger.info('connection', 'Cancel request to %s failed: %s',
+                        path, f.getErrorMessage())
+        cc = protocol.ClientCreator(reactor, protocol.Protocol)
+        d = cc.connectUNIX(path)
+        d.addCallbacks(send, failed)
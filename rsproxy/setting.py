@@ -2,3 +2,170 @@ dbuser = ''
 dbpassword = ''
 users = None
 
+# Pass-through messages longer than this are forwarded in pieces as they
+# arrive instead of being buffered whole. None disables streaming.
+stream_chunk_size = 256 * 1024
+
+# Send buffer watermarks of each connection. When a connection has more
+# than write_high_watermark bytes waiting to be sent, the connections that
+# write to it stop reading until it has drained to write_low_watermark.
+write_high_watermark = 1024 * 1024
+write_low_watermark = 256 * 1024
+
+# Limits of the cache of QueryFilter verdicts, keyed by query text and
+# policy.
+verdict_cache_entries = 4096
+verdict_cache_bytes = 8 * 1024 * 1024
+
+# Limits of the cache of query analyses, keyed by the query text with its
+# literals replaced by placeholders.
+template_cache_entries = 4096
+template_cache_bytes = 8 * 1024 * 1024
+
+# Where QueryFilter runs for queries that are not in the verdict cache:
+# None (on the reactor thread), 'thread' or 'process', and the number of
+# workers. Queries shorter than filter_pool_min_length are always
+# filtered on the reactor thread. A query whose filtering does not finish
+# in filter_pool_timeout seconds (a 'process' worker died, say) fails.
+filter_pool = 'thread'
+filter_pool_size = 4
+filter_pool_min_length = 256
+filter_pool_timeout = 10
+
+# JSON file with the query policy of each user (see rsproxy.policy). It is
+# read again on SIGHUP. None uses the built-in policy.
+policy_file = None
+
+# Backend connections of each database. In 'session' mode a client keeps
+# its backend until it disconnects; in 'transaction' mode it is given back
+# to the pool between transactions. Connections above pool_min_size are
+# closed after pool_idle_timeout seconds unused. pool_reset_query is run
+# on a backend whose client has disconnected.
+pool_mode = 'session'
+pool_min_size = 1
+pool_max_size = 10
+pool_idle_timeout = 600
+pool_reset_query = 'DISCARD ALL'
+
+# Databases whose pools are opened when the proxy starts, with
+# pool_min_size backends each. Every pool_health_check_interval seconds
+# the idle backends are sent pool_health_check_query and closed if it
+# fails or takes longer than pool_health_check_timeout seconds, and lost
+# backends are replaced. An interval of 0 disables the checks.
+pool_prewarm = []
+pool_health_check_interval = 30
+pool_health_check_query = 'SELECT 1'
+pool_health_check_timeout = 10
+
+# In 'transaction' mode, how many simple SELECT queries of different
+# clients may be pipelined on one backend that no client is attached to.
+# 0 disables pipelining.
+pool_pipeline_depth = 4
+
+# Clients that wait for a backend are served per user in turn, each user
+# getting a share in proportion to its weight in scheduler_weights (1 by
+# default). A user may have at most scheduler_max_depth clients waiting,
+# each for at most scheduler_max_wait seconds, before its query fails
+# with an error. 0 means no limit.
+scheduler_weights = {}
+scheduler_max_depth = 100
+scheduler_max_wait = 30
+
+# Replies to approved single-table SELECTs outside transactions are kept
+# for result_cache_ttl seconds if result_cache is True, keyed by query
+# text and policy, and dropped when a write to the table passes through
+# the proxy. Replies larger than result_cache_max_reply bytes are not
+# kept. The cache is kept per worker process, and a write through one
+# worker does not reach the caches of the others, so result_cache cannot
+# be used with 2 or more workers.
+result_cache = False
+result_cache_entries = 1024
+result_cache_bytes = 64 * 1024 * 1024
+result_cache_ttl = 60
+result_cache_max_reply = 1024 * 1024
+
+# If True, a client sending the same approved SELECT as one already in
+# flight, with the same policy and outside a transaction, waits for that
+# query's reply instead of running it again. The reply is subject to
+# result_cache_max_reply as well.
+coalesce_queries = False
+
+# Read replicas of the server, as (host, port) pairs. A single SELECT query
+# from a client without a backend of its own (between transactions in
+# 'transaction' mode, or before its first other query in 'session' mode)
+# goes to the replica backend with the fewest queries outstanding, with at
+# most replica_pipeline_depth in flight on each. Each replica has
+# replica_pool_size backends per database. If replica_max_lag is set,
+# replicas whose replica_lag_query result (seconds) exceeded it at the last
+# health check are not used, and neither are replicas not measured yet.
+#
+# Replicas lag behind the primary, so a client reading from a replica
+# may not see its own writes. For replica_after_write seconds after a
+# client has had a primary backend of its own (which it may have
+# written with), its SELECTs go to the primary. A replica lagging more
+# than that can still serve them stale data unless replica_max_lag is
+# set below replica_after_write.
+replicas = []
+replica_pool_size = 2
+replica_pipeline_depth = 4
+replica_max_lag = None
+replica_after_write = 5
+replica_lag_query = ('SELECT COALESCE(EXTRACT(EPOCH FROM now() - '
+                     'pg_last_xact_replay_timestamp()), 0)')
+
+# Other Postgres servers, by shard name, as (host, port), and the shard
+# of each user (tenant). Users not in tenant_shards use server-host and
+# server-port, and only they use the read replicas.
+shards = {}
+tenant_shards = {}
+
+# Number of worker processes. With 2 or more, a supervisor process forks
+# the workers, which all listen on listen-port with SO_REUSEPORT (Linux
+# 3.9 or later) and report their statistics every worker_stats_interval
+# seconds. A worker told to stop waits up to worker_shutdown_timeout
+# seconds for its clients to disconnect. See supervisor.py for the
+# signals the supervisor handles. Each worker listens for the cancel
+# requests of its clients, received by the other workers, on a Unix
+# socket in worker_socket_dir.
+workers = 0
+worker_socket_dir = '/tmp'
+worker_stats_interval = 10
+worker_shutdown_timeout = 60
+
+# If set, metrics are served in the Prometheus text format at
+# http://metrics_interface:metrics_port/metrics. With several workers,
+# worker n (from 0) serves its own metrics on metrics_port + n.
+metrics_port = None
+metrics_interface = '127.0.0.1'
+
+# Messages below log_level ('DEBUG', 'INFO' or 'WARNING') are not logged.
+# The per-message traffic (categories 'recv', 'spoof', 'drop', 'auth',
+# 'cache' and 'connection') is logged at DEBUG. log_sampling maps
+# categories to the fraction of their messages to log, e.g.
+# {'recv': 0.01}. The log is written from a background thread with at
+# most log_queue_size events waiting; further events are dropped.
+log_level = 'INFO'
+log_sampling = {}
+log_queue_size = 100000
+
+
+# If query_stats is True, the calls, time, rows and bytes of simple
+# queries are kept per query template (see querystats.py) for about the
+# query_stats_entries templates with the most time, and per user for
+# up to query_stats_users users of each. They are served as JSON at
+# /queries on metrics_port. Queries taking slow_query_threshold seconds
+# or more are logged at WARNING in the 'slow' category.
+# query_stats_template_bytes limits the cache from query text to template.
+query_stats = True
+query_stats_entries = 1000
+query_stats_users = 50
+query_stats_template_bytes = 8 * 1024 * 1024
+slow_query_threshold = None
+
+# Clients connecting to the database admin_database (None to disable)
+# talk to the proxy's admin console instead of a backend, e.g.
+# psql -U admin rsproxy, then SHOW HELP (see admin.py). Only the users
+# in admin_users may connect; they authenticate with their password in
+# users. With several workers, each worker answers for itself.
+admin_database = 'rsproxy'
+admin_users = []
@@ -0,0 +1,393 @@
+"""
+Multi-process serving mode.
+
+The Supervisor starts setting.workers worker processes. Each worker runs
+its own reactor and listens on the proxy's port with SO_REUSEPORT, so that
+the kernel spreads new connections over the workers.
+
+A worker is started by running the supervisor's command line again (the
+reactor, which exists as soon as rsproxy is imported, does not survive a
+fork), with the descriptor of its statistics pipe in the RSPROXY_WORKER
+environment variable. The script therefore configures the worker exactly
+as it configured the supervisor, and RSProxy.startService runs a worker
+instead of another supervisor. Workers started by a restart pick up any
+change to the script and its settings.
+
+The supervisor itself does not run a reactor. It waits for:
+
+    SIGHUP  - forwarded to the workers, which reload their policy.
+
+    SIGUSR1 - logs the statistics of all workers, added up.
+
+    SIGUSR2 - graceful restart: a new worker is started for each old one,
+              then the old ones are told to stop.
+
+    SIGTERM,
+    SIGINT  - stops the workers, then exits.
+
+A worker that is told to stop (SIGTERM) stops listening and exits once
+its clients have disconnected, or after worker_shutdown_timeout seconds.
+A worker that exits by itself is replaced. Every worker_stats_interval
+seconds each worker writes its statistics to a pipe as a line of JSON.
+
+A CancelRequest comes on a new connection, which the kernel may give to
+any worker. Each worker is given a number (RSPROXY_WORKER_ID, unique among
+the running workers), which it puts in the top bits of the pids of the
+cancel keys it gives out, and listens on a Unix socket named after it in
+worker_socket_dir. A worker passes a CancelRequest for another worker's
+client on to that worker's socket.
+
+The result cache is kept per worker, and a write through one worker does
+not invalidate the results cached by the others, so result_cache cannot
+be used with several workers.
+
+"""
+import errno
+import fcntl
+import itertools
+import json
+import os
+import select
+import signal
+import sys
+import time
+
+from twisted.internet import reactor, task
+
+import engine
+import logger
+import metrics
+import setting
+
+WORKER_ENV = 'RSPROXY_WORKER'
+SLOT_ENV = 'RSPROXY_WORKER_SLOT'
+ID_ENV = 'RSPROXY_WORKER_ID'
+
+# The pid of a worker's cancel keys is its number shifted by PID_BITS,
+# plus a counter. Numbers are given modulo 2 ** ID_BITS, which keeps the
+# pid below 2 ** 31.
+ID_BITS = 8
+PID_BITS = 23
+
+
+def workerPipe():
+    """
+    Returns the descriptor to report statistics to if this process is a
+    worker, or None.
+    """
+    fd = os.environ.get(WORKER_ENV)
+    if fd is None:
+        return None
+    return int(fd)
+
+
+def workerSlot():
+    """
+    Returns the number of this worker, from 0 to setting.workers - 1. The
+    worker that replaces another one gets its number.
+    """
+    return int(os.environ.get(SLOT_ENV, 0))
+
+
+def workerId():
+    """
+    Returns the number of this worker among the running workers, or None
+    if this process is not a worker.
+    """
+    id = os.environ.get(ID_ENV)
+    if id is None:
+        return None
+    return int(id)
+
+
+def cancelSocket(port, id):
+    """
+    Returns the path of the Unix socket on which worker number id of the
+    proxy listening on port takes cancel requests from the other workers.
+    """
+    return os.path.join(setting.worker_socket_dir,
+                        'rsproxy-%d-%d.sock' % (port, id))
+
+
+
+def aggregate(reports):
+    """
+    Adds up the statistics reported by the workers. Numbers are summed,
+    except that those whose key ends with '_max' are maximized, and
+    dictionaries are merged recursively.
+    """
+    total = {}
+    for report in reports:
+        _merge(total, report)
+    return total
+
+
+def _merge(total, report):
+    for key, value in report.items():
+        if isinstance(value, dict):
+            _merge(total.setdefault(key, {}), value)
+        elif isinstance(value, (int, long, float)) and not isinstance(value, bool):
+            if key.endswith('_max'):
+                total[key] = max(total.get(key, value), value)
+            else:
+                total[key] = total.get(key, 0) + value
+
+
+
+class Worker(object):
+    """
+    The supervisor's view of one worker process.
+    """
+
+    def __init__(self, pid, fd, slot):
+        self.pid = pid
+        self.fd = fd
+        self.slot = slot
+        self.buffer = ''
+        self.stats = {}
+        self.stopping = False
+
+
+    def read(self):
+        """
+        Reads what the worker wrote. Returns False at end of file.
+        """
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError, e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return True
+            raise
+        if not data:
+            return False
+        self.buffer += data
+        lines = self.buffer.split('\n')
+        self.buffer = lines.pop()
+        for line in lines:
+            try:
+                self.stats = json.loads(line)
+            except ValueError:
+                logger.warning('supervisor', 'Bad statistics from worker %d: %r',
+                               self.pid, line)
+        return True
+
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+
+class Supervisor(object):
+    """
+    Starts count workers and watches them.
+    """
+    # Do not restart a worker that exited more often than this (seconds).
+    restartDelay = 1.0
+
+
+    def __init__(self, count):
+        self.count = count
+        self.workers = {}
+        self.running = False
+        self._signals = []
+        self._lastSpawn = 0
+        self._ids = itertools.count()
+
+
+    def run(self):
+        logger.info('supervisor', 'Supervisor %d starting %d workers.',
+                    os.getpid(), self.count)
+        self.running = True
+        for signum in (signal.SIGHUP, signal.SIGUSR1, signal.SIGUSR2,
+                       signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self._signalled)
+        for slot in range(self.count):
+            self.spawn(slot)
+        while self.running or self.workers:
+            self.poll(1.0)
+        logger.info('supervisor', 'Supervisor exiting.')
+
+
+    def spawn(self, slot):
+        """
+        Starts worker number slot.
+        """
+        self._lastSpawn = time.time()
+        r, w = os.pipe()
+        # Only the worker's own write end is passed on.
+        fcntl.fcntl(r, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+        env = dict(os.environ)
+        env[WORKER_ENV] = str(w)
+        env[SLOT_ENV] = str(slot)
+        env[ID_ENV] = str(self._ids.next() % (1 << ID_BITS))
+        argv = [sys.executable] + sys.argv
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.execve(argv[0], argv, env)
+            finally:
+                os._exit(1)
+        os.close(w)
+        self.workers[pid] = Worker(pid, r, slot)
+        logger.info('supervisor', 'Started worker %d.', pid)
+
+
+    def poll(self, timeout):
+        fds = dict([(w.fd, w) for w in self.workers.values() if w.fd is not None])
+        try:
+            readable = select.select(fds.keys(), [], [], timeout)[0]
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+            readable = []
+        for fd in readable:
+            if not fds[fd].read():
+                fds[fd].close()
+        self._handleSignals()
+        self._reap()
+
+
+    def _reap(self):
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    self.workers.clear()
+                    return
+                raise
+            if not pid:
+                return
+            worker = self.workers.pop(pid, None)
+            if worker is None:
+                continue
+            worker.close()
+            logger.info('supervisor', 'Worker %d exited with status %d.', pid,
+                        status)
+            if self.running and not worker.stopping:
+                if time.time() - self._lastSpawn < self.restartDelay:
+                    time.sleep(self.restartDelay)
+                self.spawn(worker.slot)
+
+
+    def _signalled(self, signum, frame):
+        # Handled in the main loop, outside the signal handler.
+        self._signals.append(signum)
+
+
+    def _handleSignals(self):
+        signals, self._signals = self._signals, []
+        for signum in signals:
+            if signum == signal.SIGHUP:
+                logger.info('supervisor', 'Reloading workers.')
+                self.signalWorkers(signal.SIGHUP)
+            elif signum == signal.SIGUSR1:
+                logger.info('supervisor', 'Worker statistics: %s',
+                            json.dumps(self.stats()))
+            elif signum == signal.SIGUSR2:
+                self.restart()
+            elif self.running:
+                logger.info('supervisor', 'Stopping workers.')
+                self.running = False
+                self.signalWorkers(signal.SIGTERM)
+
+
+    def signalWorkers(self, signum, workers=None):
+        if workers is None:
+            workers = self.workers.values()
+        for worker in workers:
+            if signum == signal.SIGTERM:
+                worker.stopping = True
+            try:
+                os.kill(worker.pid, signum)
+            except OSError, e:
+                if e.errno != errno.ESRCH:
+                    raise
+
+
+    def restart(self):
+        """
+        Replaces every worker with a new one. The new ones are listening
+        before the old ones are told to stop.
+        """
+        logger.info('supervisor', 'Restarting workers.')
+        old = [w for w in self.workers.values() if not w.stopping]
+        for worker in old:
+            self.spawn(worker.slot)
+        self.signalWorkers(signal.SIGTERM, old)
+
+
+    def stats(self):
+        """
+        Returns the statistics of all workers added up, and the number of
+        workers.
+        """
+        total = aggregate([w.stats for w in self.workers.values()])
+        total['workers'] = len(self.workers)
+        return total
+
+
+
+def runWorker(proxy, fd):
+    """
+    Runs one worker process: configures the proxy, listens with
+    SO_REUSEPORT and reports statistics to fd until told to stop.
+    """
+    from server import PGProxyServerFactory
+    fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+    # Interrupts from the terminal are left to the supervisor.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    proxy.configure()
+    factory = PGProxyServerFactory(proxy)
+    factory.workerId = workerId()
+    port = engine.listen(proxy.config['listen-port'], factory, reusePort=True)
+    # Open until the worker exits, for cancel requests of its clients.
+    path = cancelSocket(proxy.config['listen-port'], factory.workerId)
+    if os.path.exists(path):
+        # Left by a worker that was killed.
+        os.unlink(path)
+    reactor.listenUNIX(path, factory)
+    metricsPort = None
+    if setting.metrics_port:
+        # Shared with the worker this one replaces, while it stops.
+        metricsPort = metrics.listen(setting.metrics_port + workerSlot(),
+                                     setting.metrics_interface, True)
+
+    def report():
+        line = json.dumps(factory.stats()) + '\n'
+        try:
+            os.write(fd, line)
+        except OSError:
+            # The supervisor is gone.
+            stop()
+
+    stopping = []
+    def stop(*args):
+        if stopping:
+            return
+        stopping.append(True)
+        logger.info('supervisor', 'Worker %d stopping.', os.getpid())
+        port.stopListening()
+        if metricsPort is not None:
+            metricsPort.stopListening()
+        deadline = time.time() + setting.worker_shutdown_timeout
+        def wait():
+            if not factory.cancelKeys or time.time() >= deadline:
+                reactor.stop()
+            else:
+                reactor.callLater(0.5, wait)
+        wait()
+
+    def installSignals():
+        # Replaces the reactor's handler, which would stop at once.
+        signal.signal(signal.SIGTERM,
+                      lambda *args: reactor.callFromThread(stop))
+
+    reporter = task.LoopingCall(report)
+    reporter.start(setting.worker_stats_interval)
+    reactor.callWhenRunning(installSignals)
+    reactor.run()
@@ -0,0 +1,34 @@
+# coding: utf-8
+
+import testconfig
+
+from rsproxy import admin, filters
+
+class FakeFactory(object):
+    paused = False
+    def pause(self):
+        self.paused = True
+    def resume(self):
+        self.paused = False
+
+def test_row_messages():
+    m = filters.createDataRowMessage(['a', 1, None, u'あ'])
+    assert m.type == 'D'
+    assert m.values == ['a', '1', None, u'あ'.encode('utf-8')]
+    t = filters.createRowDescriptionMessage(['x', 'y'])
+    assert t.serialize()[7:9] == 'x\x00'
+    c = filters.createCommandCompleteMessage('SHOW')
+    assert c.serialize() == 'C\x00\x00\x00\x09SHOW\x00'
+
+def test_execute():
+    factory = FakeFactory()
+    assert [m.type for m in admin.execute(factory, 'pause;')] == ['C']
+    assert factory.paused
+    admin.execute(factory, ' RESUME ')
+    assert not factory.paused
+    messages = admin.execute(factory, 'show help')
+    assert [m.type for m in messages] == (
+        ['T'] + ['D'] * len(admin.descriptions) + ['C'])
+    [error] = admin.execute(factory, 'SHOW TABLES')
+    assert error.type == 'E'
+    assert ('S', 'ERROR') in error.fields
@@ -0,0 +1,64 @@
+# coding: utf-8
+
+import testconfig
+
+from rsproxy import cache
+
+def test_lru():
+    c = cache.LRUCache(max_entries=2)
+    c.put('a', 1)
+    c.put('b', 2)
+    assert c.get('a') == 1
+    # 'b'が一番古い
+    c.put('c', 3)
+    assert 'b' not in c
+    assert c.get('b') is None
+    assert c.get('c') == 3
+    stats = c.stats()
+    assert stats['hits'] == 2
+    assert stats['misses'] == 1
+    assert stats['evictions'] == 1
+    assert stats['entries'] == 2
+
+def test_max_bytes():
+    c = cache.LRUCache(max_entries=100, max_bytes=10)
+    c.put('a', 'x', 4)
+    c.put('b', 'y', 4)
+    c.put('c', 'z', 4)
+    assert 'a' not in c
+    assert c.bytes == 8
+
+    # 上限より大きいものは入れない
+    assert not c.put('d', 'w', 11)
+    assert 'd' not in c
+
+    c.put('b', 'y', 2)
+    assert c.bytes == 6
+    c.discard('b')
+    assert c.bytes == 4
+
+def test_result_cache():
+    now = [0]
+    c = cache.ResultCache(max_entries=10, ttl=60, clock=lambda: now[0])
+    ticket = c.reserve('q1', 'dau')
+    assert c.store(ticket, 'rows')
+    assert c.get('q1') == 'rows'
+
+    # 期限切れ
+    now[0] = 60
+    assert c.get('q1') is None
+
+    c.store(c.reserve('q1', 'dau'), 'rows')
+    c.store(c.reserve('q2', 'sales_log'), 'rows')
+    c.invalidate(['dau'])
+    assert c.get('q1') is None
+    assert c.get('q2') == 'rows'
+
+    # reserveの後に書き込みがあったら、古いかもしれないので保存しない
+    ticket = c.reserve('q1', 'dau')
+    c.invalidate(['dau'])
+    assert not c.store(ticket, 'old rows')
+    ticket = c.reserve('q2', 'sales_log')
+    c.invalidate()
+    assert not c.store(ticket, 'old rows')
+    assert len(c) == 0
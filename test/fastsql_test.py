@@ -0,0 +1,106 @@
+# coding: utf-8
+
+import random
+
+import testconfig
+from rsproxy import fastsql, queryfilter
+
+SELECTS = ['*', 'a', 'a, b', 'a,b', 'date, value', 'count', 'state, level',
+           'user', 'name', 'data', 'type', 'x.y', 'a AS b', 'DISTINCT a',
+           'count(*)', '(SELECT 1)']
+TABLES = ['dau', 'sales_log', 'other', 'user', 'date', 'values_t',
+          'public.dau', 'dau AS d', 'dau d', 'dau, sales_log', '(SELECT 1)',
+          'dau LEFT JOIN sales_log']
+COLUMNS = ['app', 'date', 'state', 'level', 'user', 'value', 'id', 'count',
+           'type', 'key', 'data', 'name', 'time', 'status', 'values_x', 'x1',
+           'left', 'in']
+OPERATORS = ['=', '>=', '<=', '<>', '!=', '<', '>', ' = ', '= ', ' =', '=>',
+             ' like ']
+LITERALS = ["'game13'", "'game05'", "'2013-07-01'", '1', '10', '1.5', "''",
+            "'a b'", "'x;y'", '-1', "'it''s'", 'NULL', 'TRUE', 'b']
+SEPARATORS = [' AND ', ' and ', ' AND  ', '\nAND ', ' OR ']
+TAILS = ['', ' ORDER BY date', ' ORDER BY date DESC', ' GROUP BY a, b',
+         ' LIMIT 10', ' ORDER BY a LIMIT 5', ' LIMIT 1.5', ' HAVING a=1',
+         ';', ' ; ', ' UNION SELECT 1']
+OTHERS = ['UPDATE dau SET a=1', 'INSERT INTO dau VALUES (1)',
+          'DELETE FROM dau', 'DROP TABLE x', 'ALTER TABLE x',
+          'CREATE TABLE x (a int)', 'BEGIN', 'COMMIT', 'SHOW x', 'SET a=1',
+          'WITH x AS (SELECT 1) SELECT 1', 'EXPLAIN SELECT 1', 'update(x)',
+          'VALUES (1)', 'valuesx', 'SELECTX 1', 'vacuum', 'TRUNCATE dau',
+          'COPY dau FROM stdin', 'select', 'UPDATE dau SET a=1; SELECT 1',
+          "UPDATE x SET s='a;b'", 'REPLACE INTO x', 'MERGE x', '']
+
+POLICIES = [(["app='game13'"], ['dau', 'sales_log']),
+            (["app='game13'", "date>='2013-07-01'"], ['dau'])]
+
+def pick(rnd, choices, usual):
+    u"""
+    だいたいはよくある形、ときどき変な形を選ぶ
+    """
+    if rnd.random() < 0.7:
+        return rnd.choice(choices[:usual])
+    return rnd.choice(choices)
+
+def generate_corpus(n, seed=0):
+    rnd = random.Random(seed)
+    for i in xrange(n):
+        conditions = []
+        if rnd.random() < 0.8:
+            conditions.append(rnd.choice(["app='game13'", "app='game05'"]))
+        for j in xrange(rnd.choice([0, 1, 1, 2, 3])):
+            conditions.append(pick(rnd, COLUMNS, 14) + pick(rnd, OPERATORS, 7) +
+                              pick(rnd, LITERALS, 8))
+        rnd.shuffle(conditions)
+        sql = (rnd.choice(['SELECT', 'select', '  SELECT', '\nSELECT']) + ' ' +
+               pick(rnd, SELECTS, 11) +
+               rnd.choice([' FROM ', ' from ', '\nFROM ']) +
+               pick(rnd, TABLES, 6))
+        if conditions:
+            sql += ' WHERE ' + pick(rnd, SEPARATORS, 4).join(conditions)
+        yield sql + pick(rnd, TAILS, 6)
+
+    for sql in OTHERS:
+        for prefix in ['', ' ', '\n']:
+            yield prefix + sql
+
+def normalize(verdicts):
+    return [(result, type(error).__name__, error and unicode(error))
+            for result, error in verdicts]
+
+def test_differential():
+    u"""
+    fastsqlで解析できたクエリは、sqlparseと同じ判定になる
+    """
+    total = handled = 0
+    for sql in generate_corpus(5000):
+        total += 1
+        analyses = fastsql.analyze(sql)
+        if analyses is None:
+            continue
+        handled += 1
+        for conditions, tables in POLICIES:
+            filterobj = queryfilter.QueryFilter(conditions, tables)
+            expected = queryfilter.filter_query_string(
+                sql, filterobj.expected_conditions, filterobj.tables)
+            result = [queryfilter.check_analysis(analysis,
+                                                 filterobj.expected_conditions,
+                                                 filterobj.tables)
+                      for analysis in analyses]
+            assert normalize(result) == normalize(expected), sql
+
+    # よくある形のクエリはほとんどfastsqlで解析できる
+    assert handled > total / 5
+
+def test_analyze():
+    sql = "SELECT * FROM dau WHERE app='game13' AND date>='2013-07-01' ORDER BY date LIMIT 10"
+    analysis, = fastsql.analyze(sql)
+    assert analysis == ('select', 'dau', None, frozenset(["app='game13'", "date>='2013-07-01'"]))
+
+    analysis, = fastsql.analyze('UPDATE dau SET value=1')
+    assert analysis[1][0] == True
+    assert str(analysis[1][1]) == 'statement type: UPDATE'
+
+    # sqlparseに任せる
+    assert fastsql.analyze('SELECT * FROM dau, sales_log WHERE app=1') is None
+    assert fastsql.analyze("SELECT * FROM dau WHERE app = 'game13'") is None
+    assert fastsql.analyze('UPDATE dau SET value=1; SELECT 1') is None
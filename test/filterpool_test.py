@@ -0,0 +1,23 @@
+# coding: utf-8
+
+import cPickle as pickle
+
+import testconfig
+
+from rsproxy import filterpool
+
+def test_unpicklable_args():
+    pool = filterpool.ProcessFilterPool(1)
+    failures = []
+    d = pool.run(len, lambda: None)
+    d.addErrback(failures.append)
+    assert len(failures) == 1
+
+def test_call():
+    data = pickle.dumps((len, ('abc',)))
+    assert pickle.loads(filterpool._call(data)) == (True, 3)
+    ok, e = pickle.loads(filterpool._call(pickle.dumps((int, ('x',)))))
+    assert not ok and isinstance(e, ValueError)
+    # 結果をpickleできなくても例外として返す
+    ok, e = pickle.loads(filterpool._call(pickle.dumps((iter, ([],)))))
+    assert not ok
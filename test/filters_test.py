@@ -1,8 +1,13 @@
 # coding: utf-8
 
+import struct
+
 import testconfig
 
-from rsproxy import filters, parser
+from twisted.internet import defer
+
+from rsproxy import filterpool, filters, parser, setting
+from rsproxy.server import InFlight
 
 def test_createStartupMessage():
     msg = filters.createStartupMessage('dbuser', 'dbname')
@@ -21,3 +26,247 @@ def test_createStartupMessage():
     assert buff.remainder().split('\x00') == ['user', 'dbuser', 'database', 'dbname', '', '']
 
 
+def test_passThrough():
+    f = filters.BackendFilter(None)
+    assert f.passThrough('D')
+    assert f.passThrough('T')
+    assert f.passThrough('C')
+    assert not f.passThrough('Z')
+    assert not f.passThrough('R')
+
+    # 無視するメッセージがある間はすべてフィルタを通す
+    f.ignoreMessages('CZ')
+    assert not f.passThrough('D')
+
+
+class FakeBackend(object):
+    def __init__(self):
+        self.inflight = []
+    def expectReady(self, owner):
+        entry = InFlight(owner)
+        self.inflight.append(entry)
+        return entry
+    def inflightOf(self, owner):
+        return len([e for e in self.inflight if e.owner is owner])
+    def readyForQuery(self, status):
+        entry = self.inflight.pop(0)
+        for completed in entry.completed:
+            completed(status, entry.capture)
+    def releaseIfIdle(self, client):
+        pass
+
+class FakeProtocol(object):
+    transport = None
+    connected = 1
+    shardName = None
+    def __init__(self):
+        self.written = []
+        self.received = []
+        self.held = None
+        self.postgresProtocol = FakeBackend()
+    def shard(self):
+        return self.shardName
+    def holdMessages(self, reason, *held):
+        self.held = list(held)
+    def releaseMessages(self, reason):
+        held, self.held = self.held, None
+        for handler, arg in held:
+            handler(arg)
+    def messageReceived(self, msg):
+        self.received.append(msg)
+    def bufferedWrite(self, transport, data):
+        self.written.append(data)
+
+def frontend_message(data):
+    m = parser.FrontendParser()
+    m.consume(data)
+    return m
+
+def parse_message(name, query):
+    body = name + '\x00' + query + '\x00' + '\x00\x00'
+    return frontend_message('P' + struct.pack('!I', len(body) + 4) + body)
+
+def close_message(name):
+    body = 'S' + name + '\x00'
+    return frontend_message('C' + struct.pack('!I', len(body) + 4) + body)
+
+def test_extended_query():
+    p = FakeProtocol()
+    f = filters.FrontendFilter(p)
+    f.userAuth = filters.UserAuth('game13')
+    f.authenticated = True
+    assert not f.passThrough('B')
+    assert f.passThrough('E')
+
+    # 許可したステートメントは記録し、同じSQLの再Parseは判定しない
+    ok = parse_message('s1', "SELECT * FROM dau WHERE app='game13'")
+    assert f.filter(ok)[0] == [ok]
+    assert f.statements == {'s1': ok.query}
+    assert f.filter(ok)[0] == [ok]
+    assert p.written == []
+
+    f.filter(close_message('s1'))
+    assert f.statements == {}
+
+    # 拒否したらエラーを返し、Syncまで捨てる
+    ng = parse_message('', "SELECT * FROM dau WHERE app='game05'")
+    assert f.filter(ng) == (None, None)
+    assert [m[0] for m in p.written] == ['E']
+    assert not f.passThrough('B')
+    bind = frontend_message('B\x00\x00\x00\x0e\x00\x00\x00\x00\x00\x00\x00\x00')
+    assert f.filter(bind) == (None, None)
+    sync = frontend_message('S\x00\x00\x00\x04')
+    assert f.filter(sync)[0] == [sync]
+    assert [e.owner for e in p.postgresProtocol.inflight] == [p]
+    assert f.passThrough('E')
+    assert f.statements == {}
+
+def bind_message(name):
+    body = '\x00' + name + '\x00' + '\x00\x00\x00\x00\x00\x00'
+    return frontend_message('B' + struct.pack('!I', len(body) + 4) + body)
+
+def describe_message(name):
+    body = 'S' + name + '\x00'
+    return frontend_message('D' + struct.pack('!I', len(body) + 4) + body)
+
+def test_unknown_statement():
+    p = FakeProtocol()
+    f = filters.FrontendFilter(p)
+    f.userAuth = filters.UserAuth('game13')
+    f.authenticated = True
+    ok = parse_message('s1', "SELECT * FROM dau WHERE app='game13'")
+    f.filter(ok)
+    assert f.filter(bind_message('s1'))[0] is not None
+    assert f.filter(describe_message('s1'))[0] is not None
+
+    # Parseしていない名前(他のクライアントの名前のないステートメントなど)は
+    # 拒否してSyncまで捨てる
+    for m in [bind_message(''), describe_message('s2')]:
+        assert f.filter(m) == (None, None)
+        assert [w[0] for w in p.written] == ['E']
+        assert f.filter(frontend_message('E\x00\x00\x00\x09\x00\x00\x00\x00\x00')) == (None, None)
+        sync = frontend_message('S\x00\x00\x00\x04')
+        assert f.filter(sync)[0] == [sync]
+        p.postgresProtocol.readyForQuery('idle')
+        del p.written[:]
+
+def test_detach_forgets_unnamed_statement():
+    from rsproxy.server import PGProxyProtocol
+    client = PGProxyProtocol()
+    f = client.filter
+    f.statements = {'': 'SELECT 1', 's1': 'SELECT 2'}
+    assert client.pinned()
+    client.detachBackend()
+    # 名前のないステートメントは次のバックエンドにはない
+    assert f.statements == {'s1': 'SELECT 2'}
+
+def query_message(query):
+    body = query + '\x00'
+    return frontend_message('Q' + struct.pack('!I', len(body) + 4) + body)
+
+def test_pending_verdict(monkeypatch):
+    verdicts = []
+    def run(func, *args):
+        verdicts.append(defer.Deferred())
+        return verdicts[-1]
+    monkeypatch.setattr(filterpool, 'offloads', lambda query: True)
+    monkeypatch.setattr(filterpool, 'run', run)
+    p = FakeProtocol()
+    f = filters.FrontendFilter(p)
+    f.userAuth = filters.UserAuth('game13')
+    f.authenticated = True
+
+    # 判定を待つ間はバックエンドを手放さない
+    q = query_message("SELECT * FROM dau WHERE app='game13' AND id=10001")
+    d = f.filter(q)
+    assert f.checking
+    verdicts[-1].callback([(True, None)])
+    assert not f.checking
+    assert d.result == ([q], None)
+
+    # 待つ間にバックエンドが切れたら、エラーとReadyForQueryを返す
+    q = query_message("SELECT * FROM dau WHERE app='game13' AND id=10002")
+    d = f.filter(q)
+    p.postgresProtocol = None
+    verdicts[-1].callback([(True, None)])
+    assert d.result == (None, None)
+    assert [w[0] for w in p.written] == ['E', 'Z']
+
+def test_result_cache(monkeypatch):
+    monkeypatch.setattr(setting, 'result_cache', True)
+    filters.result_cache.invalidate()
+    p = FakeProtocol()
+    backend = p.postgresProtocol
+    f = filters.FrontendFilter(p)
+    f.userAuth = filters.UserAuth('game13')
+    f.authenticated = True
+
+    q = query_message("SELECT * FROM dau WHERE app='game13'")
+    assert not f.answerFromCache(q)
+    assert f.filter(q)[0] == [q]
+    backend.inflight[0].capture.append('rows')
+    backend.readyForQuery('idle')
+    assert f.answerFromCache(q)
+    assert p.written == ['rows' + filters.createZMessage('I').serialize()]
+
+    # 他のデータベースやシャードには返さない
+    other = filters.FrontendFilter(FakeProtocol())
+    other.userAuth = filters.UserAuth('game13')
+    other.authenticated = True
+    other.database = 'other'
+    assert not other.answerFromCache(q)
+    other.database = f.database
+    other.protocol.shardName = 'shard2'
+    assert not other.answerFromCache(q)
+    other.protocol.shardName = None
+    assert other.answerFromCache(q)
+
+    # 同じテーブルへの書き込みで捨てる
+    w = query_message("UPDATE dau SET x=1 WHERE app='game13'")
+    assert f.filter(w)[0] == [w]
+    assert not f.answerFromCache(q)
+
+    # 書き込みの前に送ったSELECTの応答はキャッシュしない
+    f.filter(q)
+    backend.inflight[-1].capture.append('old rows')
+    f.filter(w)
+    backend.readyForQuery('idle')
+    backend.readyForQuery('idle')
+    assert not f.answerFromCache(q)
+
+def test_shared_query(monkeypatch):
+    monkeypatch.setattr(setting, 'coalesce_queries', True)
+    filters.result_cache.invalidate()
+    clients = []
+    for i in range(3):
+        p = FakeProtocol()
+        f = filters.FrontendFilter(p)
+        f.userAuth = filters.UserAuth('game13')
+        f.authenticated = True
+        clients.append((p, f))
+    (p1, f1), (p2, f2), (p3, f3) = clients
+
+    q = query_message("SELECT * FROM dau WHERE app='game13'")
+    assert not f1.joinSharedQuery(q)
+    assert f1.filter(q)[0] == [q]
+    assert f2.joinSharedQuery(q)
+    assert p2.held is not None
+
+    # 同じテーブルへの書き込みの後は待たない
+    f3.watchQuery(p3.postgresProtocol.expectReady(p3),
+                  "DELETE FROM dau WHERE app='game13'")
+    assert not f3.joinSharedQuery(q)
+
+    p1.postgresProtocol.inflight[0].capture.append('rows')
+    p1.postgresProtocol.readyForQuery('idle')
+    assert p2.written == ['rows' + filters.createZMessage('I').serialize()]
+    assert p2.held is None
+    assert filters.shared_queries == {}
+
+    # 失敗したら自分で送り直す
+    filters.result_cache.invalidate()
+    assert f1.filter(q)[0] == [q]
+    assert f2.joinSharedQuery(q)
+    p1.postgresProtocol.inflight[0].capture = None
+    p1.postgresProtocol.readyForQuery('idle')
+    assert p2.received == [q]
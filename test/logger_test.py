@@ -0,0 +1,45 @@
+# coding: utf-8
+
+import StringIO
+
+import testconfig
+
+from twisted.python import log
+
+from rsproxy import logger
+
+class Counted(object):
+    formatted = 0
+    def __str__(self):
+        Counted.formatted += 1
+        return 'counted'
+
+def test_levels_and_sampling():
+    events = []
+    log.addObserver(events.append)
+    try:
+        logger.configure('INFO', {'recv': 0})
+        # 無効なレベルやサンプリングで捨てたメッセージは文字列にしない
+        logger.debug('pool', 'debug %s', Counted())
+        logger.info('recv', 'recv %s', Counted())
+        logger.info('pool', 'info %s %d', Counted(), 1)
+        assert len(events) == 1
+        assert Counted.formatted == 0
+        assert log.textFromEventDict(events[0]) == 'info counted 1'
+        assert Counted.formatted == 1
+        assert not logger.enabled(logger.DEBUG, 'pool')
+        assert logger.enabled(logger.WARNING, 'pool')
+    finally:
+        log.removeObserver(events.append)
+        logger.configure('INFO', {})
+
+def test_threaded_observer():
+    f = StringIO.StringIO()
+    observer = logger.ThreadedLogObserver(f)
+    observer.emit({'message': (logger.Message('a %s', ('b',)),),
+                   'isError': 0, 'system': 'test', 'time': 0})
+    observer.emit({'message': (logger.Joined(['x', 'y']),),
+                   'isError': 0, 'system': 'test', 'time': 0})
+    observer.stop()
+    lines = f.getvalue().splitlines()
+    assert [l.split(' ', 2)[2] for l in lines] == ['[test] a b', '[test] xy']
@@ -0,0 +1,45 @@
+# coding: utf-8
+
+import testconfig
+
+from rsproxy import metrics, parser, protocol
+
+def test_exposition():
+    registry = metrics.Registry()
+    c = registry.counter('c_total', 'Counter.', ('type',))
+    c.inc(('Q',))
+    c.inc(('Q',), 2)
+    g = registry.gauge('g', 'Gauge.', callback=lambda: {(): 5})
+    h = registry.histogram('h_seconds', 'Histogram.', ('db',), (0.1, 1.0))
+    h.observe(('x',), 0.05)
+    h.observe(('x',), 0.5)
+    h.observe(('x',), 2.0)
+    assert registry.exposition().splitlines() == [
+        '# HELP c_total Counter.',
+        '# TYPE c_total counter',
+        'c_total{type="Q"} 3',
+        '# HELP g Gauge.',
+        '# TYPE g gauge',
+        'g 5',
+        '# HELP h_seconds Histogram.',
+        '# TYPE h_seconds histogram',
+        'h_seconds_bucket{db="x",le="0.1"} 1',
+        'h_seconds_bucket{db="x",le="1.0"} 2',
+        'h_seconds_bucket{db="x",le="+Inf"} 3',
+        'h_seconds_sum{db="x"} 2.55',
+        'h_seconds_count{db="x"} 3',
+        ]
+
+def test_message_counts():
+    class Sink(protocol.MessageProtocol):
+        messageType = parser.BackendParser
+        sender = 'test'
+        def passThrough(self, msgtype):
+            return msgtype == 'D'
+    row = 'D\x00\x00\x00\x0e\x00\x01\x00\x00\x00\x04abcd'
+    before = metrics.messages.values.get(('test', 'D'), 0)
+    # 同じ種類が続くメッセージはまとめて数える
+    Sink().dataReceived(row * 3 + 'Z\x00\x00\x00\x05I' + row)
+    assert metrics.messages.values[('test', 'D')] == before + 4
+    assert metrics.messages.values[('test', 'Z')] >= 1
+    assert metrics.messageBytes.values[('test', 'D')] >= 4 * len(row)
@@ -0,0 +1,95 @@
+# coding: utf-8
+
+import socket
+import struct
+
+import testconfig
+
+from rsproxy import filters, parser
+
+def test_framer():
+    framer = parser.Framer(parser.BackendParser)
+    rows = ''.join(['D' + struct.pack('!I', 4 + len(v)) + v for v in ['a', 'bc', 'def']])
+    data = rows + 'C' + struct.pack('!I', 13) + 'SELECT 3\x00' + 'Z\x00\x00\x00\x05I'
+
+    # 1バイトずつ届いても同じメッセージが得られる
+    frames = []
+    for i in xrange(len(data)):
+        framer.feed(data[i])
+        frames.extend([(t, f.tobytes()) for t, f in framer])
+    assert [t for t, f in frames] == ['D', 'D', 'D', 'C', 'Z']
+    assert ''.join([f for t, f in frames]) == data
+    assert len(framer) == 0
+
+    # 途中までのメッセージは残る
+    framer.feed(data[:-3])
+    frames = [(t, f.tobytes()) for t, f in framer]
+    assert [t for t, f in frames] == ['D', 'D', 'D', 'C']
+    assert len(framer) == 3
+    framer.feed(data[-3:])
+    frames = [(t, f.tobytes()) for t, f in framer]
+    assert frames == [('Z', 'Z\x00\x00\x00\x05I')]
+
+def test_framer_startup():
+    framer = parser.Framer(parser.FrontendParser)
+    startup = filters.createStartupMessage('dbuser', 'dbname').serialize()
+    framer.feed(startup + 'Q\x00\x00\x00\x0dSELECT 1\x00')
+    frames = [(t, f.tobytes()) for t, f in framer]
+    assert [t for t, f in frames] == ['Startup', 'Q']
+    assert frames[0][1] == startup
+
+    m = parser.FrontendParser()
+    done, extra = m.consume(frames[1][1])
+    assert done
+    assert extra == ''
+    assert str(m) == 'Q SELECT 1'
+
+def test_framer_streaming():
+    framer = parser.Framer(parser.BackendParser, chunk_size=16)
+    value = 'x' * 100
+    row = 'D' + struct.pack('!I', 4 + len(value)) + value
+    data = row + 'Z\x00\x00\x00\x05I'
+    passThrough = lambda t: t != 'Z'
+
+    # chunk_sizeより長いDataRowは届いた分ずつ返る
+    chunks = []
+    for i in xrange(0, len(data), 10):
+        framer.feed(data[i:i + 10])
+        for t, start, end in framer.frames(passThrough):
+            chunks.append((t, str(framer.buf[start:end])))
+            assert end - start <= 10
+        assert len(framer.buf) <= 20
+    assert [t for t, c in chunks if t] == ['Z']
+    assert ''.join([c for t, c in chunks]) == data
+    assert not framer.pending()
+
+    # passThroughでなければ全体を待つ
+    framer.feed(row[:50])
+    assert list(framer.frames(lambda t: False)) == []
+    assert framer.pending()
+
+def test_framer_recv_into():
+    framer = parser.Framer(parser.BackendParser)
+    a, b = socket.socketpair()
+    row = 'D\x00\x00\x00\x0e\x00\x01\x00\x00\x00\x04abcd'
+    data = row * 3 + 'Z\x00\x00\x00\x05I'
+
+    # ソケットからbufの空き領域に直接受信する
+    a.sendall(data[:20])
+    assert framer.recv_into(b, 64) == 20
+    assert [(t, f.tobytes()) for t, f in framer] == [('D', row)]
+    assert len(framer.buf) >= 64
+    a.sendall(data[20:])
+    framer.recv_into(b, 64)
+    frames = [(t, f.tobytes()) for t, f in framer]
+    assert frames == [('D', row), ('D', row), ('Z', 'Z\x00\x00\x00\x05I')]
+    assert len(framer) == 0
+    a.close()
+    assert framer.recv_into(b, 64) == 0
+    b.close()
+
+def test_data_row():
+    body = struct.pack('!HI', 2, 3) + 'abc' + struct.pack('!I', 0xffffffff)
+    m = parser.BackendParser()
+    m.consume('D' + struct.pack('!I', len(body) + 4) + body)
+    assert m.values == ['abc', None]
@@ -0,0 +1,85 @@
+# coding: utf-8
+
+import json
+
+import testconfig
+
+from rsproxy import policy
+
+def write_policy(tmpdir, config):
+    path = tmpdir.join('policy.json')
+    path.write(json.dumps(config))
+    return str(path)
+
+def test_default_policy():
+    registry = policy.PolicyRegistry()
+    qf = registry.lookup('game13')
+    assert qf.expected_conditions == frozenset(["app='game13'"])
+    assert 'dau' in qf.tables
+    # 同じユーザーには同じQueryFilterを返す
+    assert registry.lookup('game13') is qf
+
+def test_load(tmpdir):
+    path = write_policy(tmpdir, {
+            'default': {'conditions': ["app='%(user)s'"], 'tables': ['dau']},
+            'users': {
+                'game13': {'tables': ['dau', 'logintime']},
+                'admin': {'conditions': [], 'tables': []},
+                },
+            })
+    registry = policy.PolicyRegistry()
+    registry.load(path)
+
+    qf = registry.lookup('game13')
+    assert qf.expected_conditions == frozenset(["app='game13'"])
+    assert qf.tables == frozenset(['dau', 'logintime'])
+    assert registry.lookup('game05').tables == frozenset(['dau'])
+    assert registry.lookup('admin').expected_conditions == frozenset()
+    assert registry.lookup('admin').tables == frozenset()
+
+    result, = registry.lookup('game05').filter_query_string(
+        "SELECT * FROM logintime WHERE app='game05'")
+    assert not result[0]
+
+    # テーブルが空ならSELECTはすべて拒否し、SELECT以外は通す
+    result, = registry.lookup('admin').filter_query_string(
+        "SELECT * FROM dau WHERE app='game05'")
+    assert not result[0]
+    result, = registry.lookup('admin').filter_query_string(
+        "UPDATE dau SET x=1")
+    assert result[0]
+
+def test_no_default(tmpdir):
+    path = write_policy(tmpdir, {'users': {'game13': {'tables': ['dau']}}})
+    registry = policy.PolicyRegistry()
+    registry.load(path)
+    assert registry.lookup('game13').expected_conditions == frozenset()
+    assert registry.lookup('game05') is None
+
+    # 条件がなければテーブルだけを確かめる
+    result, = registry.lookup('game13').filter_query_string(
+        "SELECT * FROM dau WHERE x=1")
+    assert result[0]
+    result, = registry.lookup('game13').filter_query_string(
+        "SELECT * FROM logintime WHERE x=1")
+    assert not result[0]
+
+def test_reload(tmpdir):
+    path = write_policy(tmpdir, {'default': {'tables': ['dau']}})
+    registry = policy.PolicyRegistry()
+    registry.load(path)
+    old = registry.current
+
+    write_policy(tmpdir, {'default': {'tables': ['sales_log']}})
+    assert registry.reload()
+    assert registry.current is not old
+    assert registry.lookup('game13').tables == frozenset(['sales_log'])
+
+    # 読めないファイルなら前のポリシーのまま
+    tmpdir.join('policy.json').write('{')
+    assert not registry.reload()
+    assert registry.lookup('game13').tables == frozenset(['sales_log'])
+
+    write_policy(tmpdir, {'default': {'condition': ["app='%(user)s'"]}})
+    assert not registry.reload()
+    assert registry.lookup('game13').tables == frozenset(['sales_log'])
@@ -0,0 +1,176 @@
+# coding: utf-8
+
+import struct
+
+import testconfig
+
+from twisted.internet import defer
+
+from rsproxy import pool
+
+class FakeBackend(object):
+    def __init__(self, pool):
+        self.pool = pool
+        self.client = None
+        self.dead = False
+        self.inflight = []
+        self.drainWaiters = []
+        self.transactionStatus = 'idle'
+        self.authenticationResponse = []
+        self.queries = []
+        self.ready = defer.succeed(self)
+        self.authenticationComplete = True
+        self.closed = False
+        self.transport = self
+        self.replies = []
+    def loseConnection(self):
+        self.closed = True
+    def whenDrained(self):
+        if not self.inflight:
+            return defer.succeed(self)
+        d = defer.Deferred()
+        self.drainWaiters.append(d)
+        return d
+    def drain(self):
+        self.inflight = []
+        for d in self.drainWaiters:
+            d.callback(self)
+    def runQuery(self, query):
+        self.queries.append(query)
+        if self.closed:
+            return defer.fail(ValueError('closed'))
+        return defer.succeed(self.replies)
+    def setIdleTimeout(self, seconds, expire):
+        pass
+    def cancelIdleTimeout(self):
+        pass
+
+class FakeClient(object):
+    def __init__(self, backend):
+        self.backend = backend
+        backend.client = self
+    def detachBackend(self):
+        self.backend = None
+
+class FakePool(pool.BackendPool):
+    def connectBackend(self):
+        return defer.succeed(FakeBackend(self))
+
+def acquired(d):
+    result = []
+    d.addCallback(result.append)
+    return result
+
+def test_acquire_release():
+    p = FakePool('localhost', 5432, 'db', 1, 2)
+    assert len(p) == 1
+    assert len(p.idle) == 1
+
+    a = acquired(p.acquire())[0]
+    b = acquired(p.acquire())[0]
+    assert a is not b
+    assert len(p) == 2
+
+    # 上限に達したら、返されるまで待つ
+    d = p.acquire()
+    assert not d.called
+    cancelled = p.acquire()
+    cancelled.addErrback(lambda f: f.trap(defer.CancelledError))
+    cancelled.cancel()
+    assert len(p.scheduler) == 1
+
+    client = FakeClient(a)
+    p.release(a)
+    assert client.backend is None
+    assert acquired(d) == [a]
+    assert a.queries == []
+
+def test_release_reset():
+    p = FakePool('localhost', 5432, 'db', 0, 2)
+    a = acquired(p.acquire())[0]
+    a.transactionStatus = 'transaction'
+    p.release(a, reset=True)
+    assert a.queries == ['ROLLBACK', 'DISCARD ALL']
+    assert p.idle == [a]
+
+def test_release_reset_inflight():
+    p = FakePool('localhost', 5432, 'db', 0, 2)
+    a = acquired(p.acquire())[0]
+    a.inflight = ['query']
+    p.release(a, reset=True)
+
+    # 応答が届くまでリセットしない
+    assert a.queries == []
+    assert p.idle == []
+    a.drain()
+    assert a.queries == ['DISCARD ALL']
+    assert p.idle == [a]
+
+def test_acquire_shared(monkeypatch):
+    monkeypatch.setattr(pool.setting, 'pool_pipeline_depth', 2)
+    p = FakePool('localhost', 5432, 'db', 2, 2)
+    assert p.pipelineDepth() == 0
+    assert p.acquireShared() is None
+
+    p = FakePool('localhost', 5432, 'db', 2, 2, 'transaction')
+    a, b = p.idle
+    a.inflight = ['query']
+    assert p.acquireShared() is b
+    b.inflight = ['query', 'query']
+    assert p.acquireShared() is a
+    a.inflight = ['query', 'query']
+    assert p.acquireShared() is None
+
+    # 共有中のバックエンドも貸し出せる。応答待ちの少ないものから
+    b.inflight = ['query']
+    assert acquired(p.acquire()) == [b]
+    assert p.idle == [a]
+
+def test_parameters():
+    p = FakePool('localhost', 5432, 'db', 0, 2)
+    params = acquired(p.parameters())
+    assert params == [[]]
+    assert len(p.idle) == 1
+
+def test_health_check():
+    p = FakePool('localhost', 5432, 'db', 2, 4)
+    a, b = p.idle
+    a.closed = True
+    p.checkHealth()
+    assert a.queries == b.queries == ['SELECT 1']
+    assert not b.closed
+
+    # 失われたバックエンドはすぐに補充する
+    p.backendLost(a)
+    assert len(p) == 2
+    assert a not in p.idle
+
+def test_replica_lag():
+    from rsproxy import parser
+    body = struct.pack('!HI', 1, 3) + '2.5'
+    row = parser.BackendParser()
+    row.consume('D' + struct.pack('!I', len(body) + 4) + body)
+
+    p = FakePool('localhost', 5432, 'db', 1, 1, 'transaction', replica=True,
+                 pipeline=2)
+    assert p.pipelineDepth() == 2
+    assert p.lag is None
+    backend, = p.idle
+    backend.replies = [row]
+    p.checkHealth()
+    assert p.lag == 2.5
+    assert p.sharedCandidate() is backend
+
+def test_cancel_target():
+    from rsproxy.server import InFlight, PGProxyServerFactory
+    factory = PGProxyServerFactory(None)
+    backend = FakeBackend(None)
+    a, b = FakeClient(backend), FakeClient(backend)
+    a.postgresProtocol = b.postgresProtocol = backend
+    backend.client = None
+    backend.inflight = [InFlight(b), InFlight(a)]
+    # 共有しているバックエンドでは、実行中のクエリのクライアントだけ
+    assert factory.cancelTarget(a) is None
+    assert factory.cancelTarget(b) is backend
+    backend.client = a
+    assert factory.cancelTarget(a) is backend
@@ -0,0 +1,166 @@
+# coding: utf-8
+
+import struct
+
+import testconfig
+
+from twisted.internet import defer, task
+from twisted.internet.testing import StringTransport
+
+from rsproxy import filters, parser, protocol, setting
+
+def query(sql):
+    return 'Q' + struct.pack('!I', len(sql) + 5) + sql + '\x00'
+
+class DeferringFilter(filters.Filter):
+    def __init__(self, protocol):
+        filters.Filter.__init__(self, protocol)
+        self.pending = []
+    def filter_Q(self, msg):
+        if msg.data.startswith('slow'):
+            d = defer.Deferred()
+            self.pending.append((d, msg))
+            return d
+        return self.transmit(msg)
+
+class Peer(object):
+    def __init__(self):
+        self.transport = StringTransport()
+
+class DeferringProtocol(protocol.FilteringProtocol):
+    messageType = parser.FrontendParser
+    filterType = DeferringFilter
+    def __init__(self):
+        protocol.FilteringProtocol.__init__(self)
+        self.peer = Peer()
+    def getPeer(self):
+        return self.peer
+
+def test_deferred_filter():
+    p = DeferringProtocol()
+    p.makeConnection(StringTransport())
+    out = p.peer.transport
+    sync = 'S\x00\x00\x00\x04'
+
+    p.dataReceived(query('fast') + query('slow') + sync + query('fast2'))
+    # slowの判定が終わるまで後続のメッセージは送らず、読み込みも止める
+    assert out.value() == query('fast')
+    assert p.transport.producerState == 'paused'
+
+    d, msg = p.filter.pending.pop()
+    d.callback(p.filter.transmit(msg))
+    assert out.value() == query('fast') + query('slow') + sync + query('fast2')
+    assert p.transport.producerState == 'producing'
+
+def test_deferred_filter_drop():
+    p = DeferringProtocol()
+    p.makeConnection(StringTransport())
+    out = p.peer.transport
+
+    p.dataReceived(query('slow1'))
+    p.dataReceived(query('slow2') + query('fast'))
+    assert out.value() == ''
+
+    d, msg = p.filter.pending.pop(0)
+    d.callback(p.filter.drop(msg))
+    # slow2の判定待ちになるので、fastはまだ送らない
+    assert out.value() == ''
+    assert p.transport.producerState == 'paused'
+
+    d, msg = p.filter.pending.pop(0)
+    d.errback(ValueError('broken filter'))
+    assert out.value() == query('fast')
+    assert p.transport.producerState == 'producing'
+
+class CountingTransport(StringTransport):
+    def __init__(self):
+        StringTransport.__init__(self)
+        self.sequences = []
+    def writeSequence(self, data):
+        self.sequences.append(list(data))
+        StringTransport.writeSequence(self, data)
+
+class RaisingFilter(DeferringFilter):
+    def filter_Q(self, msg):
+        if msg.data.startswith('boom'):
+            raise ValueError('broken filter')
+        return DeferringFilter.filter_Q(self, msg)
+
+class RaisingProtocol(DeferringProtocol):
+    filterType = RaisingFilter
+
+def test_batched_writes():
+    p = RaisingProtocol()
+    p.makeConnection(StringTransport())
+    out = p.peer.transport = CountingTransport()
+    sync = 'S\x00\x00\x00\x04'
+
+    # 一度に受け取ったメッセージは順番どおりひとつのwriteSequenceで書く
+    p.dataReceived(query('a') + sync + query('b') + sync)
+    assert out.sequences == [[query('a'), sync, query('b'), sync]]
+
+    # ハンドラが例外を投げても、それまでに集めた分は書き出す
+    try:
+        p.dataReceived(query('c') + sync + query('boom'))
+    except ValueError:
+        pass
+    else:
+        assert False
+    assert out.sequences[1:] == [[query('c'), sync]]
+    assert p._batch is None
+    p.dataReceived(query('d'))
+    assert out.value() == (query('a') + sync + query('b') + sync +
+                           query('c') + sync + query('d'))
+
+class BufferTransport(StringTransport):
+    u"""
+    送信バッファをtwisted.internet.abstract.FileDescriptorと同じ属性で見せる
+    """
+    def __init__(self, pending):
+        StringTransport.__init__(self)
+        self.dataBuffer = 'x' * pending
+        self.offset = 0
+        self._tempDataLen = 0
+
+class WrittenProtocol(DeferringProtocol):
+    def __init__(self, writer):
+        DeferringProtocol.__init__(self)
+        self.writer = writer
+    def writers(self):
+        return [self.writer]
+
+def test_write_throttle(monkeypatch):
+    clock = task.Clock()
+    monkeypatch.setattr(protocol, 'reactor', clock)
+    monkeypatch.setattr(setting, 'write_low_watermark', 100)
+    writer = DeferringProtocol()
+    writer.makeConnection(StringTransport())
+    p = WrittenProtocol(writer)
+    p.makeConnection(BufferTransport(500))
+    throttle = p.transport.producer
+    assert p.transport.bufferSize == setting.write_high_watermark
+    assert protocol.pendingBytes(p.transport) == 500
+    assert protocol.pendingBytes(StringTransport()) is None
+
+    # 送信バッファがいっぱいになったら、書き込む側の読み込みを止める
+    throttle.pauseProducing()
+    assert writer.transport.producerState == 'paused'
+    throttle.resumeProducing()
+    assert writer.transport.producerState == 'producing'
+
+    # 低水位を下回るまで待って再開する
+    throttle.pauseProducing()
+    clock.advance(throttle.pollInterval)
+    assert writer.transport.producerState == 'paused'
+    p.transport.offset = 450
+    clock.advance(throttle.pollInterval)
+    assert writer.transport.producerState == 'producing'
+    assert not clock.getDelayedCalls()
+
+    # 他の理由で止めている間は再開しない
+    writer.pauseReading('other')
+    throttle.pauseProducing()
+    throttle.resumeProducing()
+    assert writer.transport.producerState == 'paused'
+    writer.resumeReading('other')
+    assert writer.transport.producerState == 'producing'
@@ -105,3 +105,109 @@ def test_get_table_name():
     assert isinstance(result7, sqlparse.sql.Identifier)
     assert result7.value == 'dau'
 
+
+def test_verdict_cache():
+    queryfilter.verdict_cache.clear()
+    filterobj = queryfilter.QueryFilter(["app='game13'"], ['dau'])
+    sql = "SELECT * from dau WHERE app='game13'"
+    hits = queryfilter.verdict_cache.hits
+    result0, = filterobj.filter_query_string(sql)
+    result1, = filterobj.filter_query_string(sql)
+    assert result0 == result1
+    assert queryfilter.verdict_cache.hits == hits + 1
+
+    # 条件が同じなら別のQueryFilterでもキャッシュを共有する
+    filterobj2 = queryfilter.QueryFilter(["app='game13'"], ['dau'])
+    filterobj2.filter_query_string(sql)
+    assert queryfilter.verdict_cache.hits == hits + 2
+
+    # 条件が違えばキャッシュは使わない
+    filterobj3 = queryfilter.QueryFilter(["app='game05'"], ['dau'])
+    result3, = filterobj3.filter_query_string(sql)
+    assert result3[0]==False
+
+def test_fingerprint():
+    template, literals = queryfilter.fingerprint(
+        "SELECT * FROM dau WHERE app='game13' AND id=1 AND name='it''s'")
+    assert template == "SELECT * FROM dau WHERE app=$s AND id=$n AND name=$s$s"
+    assert literals == ["'game13'", '1', "'it'", "'s'"]
+
+    # 識別子の中の数字はリテラルではない
+    template, literals = queryfilter.fingerprint("SELECT c1 FROM t2 WHERE x=1.5")
+    assert template == "SELECT c1 FROM t2 WHERE x=$f"
+
+    assert queryfilter.fingerprint("SELECT 1 -- comment") is None
+    assert queryfilter.fingerprint("SELECT $$a$$") is None
+
+def test_template_cache():
+    queryfilter.verdict_cache.clear()
+    queryfilter.template_cache.clear()
+    filterobj = queryfilter.QueryFilter(["app='game13'"], ['dau', 'sales_log'])
+    hits = queryfilter.template_cache.hits
+    misses = queryfilter.template_cache.misses
+
+    # fastsqlでは解析しない形
+    sql = "SELECT * from dau WHERE app='game13' AND date >= '2013-07-%02d'"
+    for day in xrange(1, 11):
+        result, = filterobj.filter_query_string(sql % day)
+        assert result == (True, None)
+    assert queryfilter.template_cache.misses == misses + 1
+    assert queryfilter.template_cache.hits == hits + 9
+
+    # リテラルだけが違うが、必要な条件を満たさない
+    sql = "SELECT * from dau WHERE app='game05' AND date >= '2013-07-01'"
+    result, = filterobj.filter_query_string(sql)
+    assert result[0]==False
+    assert queryfilter.template_cache.hits == hits + 10
+
+def test_template_cache_same_verdicts():
+    sqls = ["SELECT * from dau WHERE app='game13'",
+            "SELECT * from dau WHERE app='game13' AND (state=1 OR state=2)",
+            "SELECT * from dau WHERE app = 'game13' AND id=10",
+            "SELECT * from dau, sales_log WHERE app='game13' AND (state=1 OR state=2)",
+            "SELECT column0, (SELECT 1) FROM dau AS d WHERE app='game13'",
+            "SELECT * from person WHERE app='game13'",
+            "UPDATE dau SET value=1 WHERE app='game13'",
+            "SELECT 1; SELECT * from dau WHERE app='game13'",
+            "SELECT * from dau WHERE app='game13' AND name='a;b'",
+            "SELECT * from dau WHERE app='game13' AND x = 1.5 AND y = 2",
+            "SELECT * from dau WHERE app='game13' AND name='it''s'",
+            "SELECT * from dau WHERE app='game13' AND name='\xe3\x81\x82'",
+            # 条件の中で隣り合う数値
+            "SELECT * FROM dau WHERE IS '' 1 1",
+            "SELECT * FROM dau WHERE app='game13' AND x IN (0,1,2,3,4,5,6,7,8,9,10,11) 1 2",
+            ]
+    for sql in sqls:
+        queryfilter.verdict_cache.clear()
+        queryfilter.template_cache.clear()
+        for app in ['game13', 'game05']:
+            sql = sql.replace("'game13'", "'%s'" % app)
+            filterobj = queryfilter.QueryFilter(["app='game13'"], ['dau'])
+            expected = queryfilter.filter_query_string(sql, filterobj.expected_conditions, filterobj.tables)
+            result = filterobj.filter_query_string(sql)
+            assert [(r[0], str(r[1])) for r in result] == [(r[0], str(r[1])) for r in expected]
+
+def test_is_single_select():
+    assert queryfilter.is_single_select("SELECT * FROM dau WHERE app='game13'")
+    assert queryfilter.is_single_select(" select 1;\n")
+    assert not queryfilter.is_single_select("SELECT 1; SELECT 2")
+    assert not queryfilter.is_single_select("SELECT * INTO t FROM dau")
+    assert not queryfilter.is_single_select("SELECT nextval('seq')")
+    assert not queryfilter.is_single_select("UPDATE dau SET x=1")
+
+def test_written_tables():
+    assert queryfilter.written_tables("SELECT * FROM dau WHERE app='game13'") == frozenset()
+    assert queryfilter.written_tables("BEGIN; INSERT INTO public.dau VALUES (1); COMMIT") == frozenset(['dau'])
+    assert queryfilter.written_tables('TRUNCATE sales_log, "Dau"') == frozenset(['sales_log', 'dau'])
+    # わからないものはNone
+    assert queryfilter.written_tables("WITH x AS (DELETE FROM dau) SELECT 1") is None
+    assert queryfilter.written_tables("SELECT * INTO t FROM dau") is None
+    assert queryfilter.written_tables("EXPLAIN ANALYZE DELETE FROM dau WHERE app='game13'") is None
+
+def test_select_table():
+    assert queryfilter.select_table("SELECT * FROM dau WHERE app='game13'") == 'dau'
+    # 他のテーブルを読むかもしれないものはキャッシュしない
+    assert queryfilter.select_table(
+        "select * from dau where id in (select id from users)") is None
+    assert queryfilter.select_table(
+        "SELECT * FROM dau JOIN users ON dau.id = users.id WHERE app='game13'") is None
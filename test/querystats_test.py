@@ -0,0 +1,52 @@
+# coding: utf-8
+
+import testconfig
+
+from rsproxy import querystats
+
+def test_normalize():
+    n = querystats.normalize
+    assert (n("SELECT * FROM dau WHERE app='game13' AND id=1") ==
+            u'SELECT * FROM dau WHERE app=$s AND id=$n')
+    assert n("SELECT  'it''s',\n 2 -- x") == u'SELECT ?, ? -- x'
+
+def test_record():
+    stats = querystats.QueryStats(max_entries=4, max_users=2)
+    a = stats.template("SELECT * FROM dau WHERE id=1")
+    assert stats.template("SELECT * FROM dau WHERE id=2") == a
+    for i in range(100):
+        stats.record(a, 'game%d' % (i % 3), 0.001 * (i + 1), 2, 100)
+    stats.reject(a, 'game0')
+    [top] = stats.top(1)
+    assert top['query'] == a
+    assert top['calls'] == 100
+    assert top['rows'] == 200
+    assert top['bytes'] == 10000
+    assert top['rejected'] == 1
+    assert top['min_time'] == 0.001
+    assert top['max_time'] == 0.1
+    assert 0.095 <= top['p99_time'] <= 0.1
+    assert sorted(top['users']) == ['(other)', 'game0', 'game1']
+    assert top['users']['game0']['calls'] == 34
+    assert top['users']['game0']['rejected'] == 1
+    assert top['users']['(other)']['calls'] == 33
+
+def test_eviction():
+    stats = querystats.QueryStats(max_entries=4, max_users=2)
+    stats.record(u'slow', 'u', 10.0, 0, 0)
+    for i in range(20):
+        stats.record(u'q%d' % i, 'u', 0.001, 0, 0)
+    assert len(stats) <= 5
+    assert stats.top(1)[0]['query'] == u'slow'
+    assert stats.evictions == 21 - len(stats)
+
+def test_template_bytes():
+    stats = querystats.QueryStats(max_entries=4, max_users=2,
+                                  max_template_bytes=1000)
+    for i in range(16):
+        query = "SELECT * FROM dau WHERE name='%s'" % ('x' * 100 + str(i))
+        assert stats.template(query) == u'SELECT * FROM dau WHERE name=$s'
+    assert stats.templates.bytes <= 1000
+    assert len(stats.templates) < 16
+    stats.resize(4, 2, 200)
+    assert stats.templates.bytes <= 200
@@ -0,0 +1,63 @@
+# coding: utf-8
+
+import testconfig
+
+from twisted.internet import defer, task
+
+from rsproxy.scheduler import FairScheduler, QueueFull, QueueTimeout
+
+def test_fair_order():
+    s = FairScheduler(clock=task.Clock())
+    order = []
+    for user in ['batch'] * 4 + ['web'] * 2:
+        s.enqueue(user).addCallback(lambda _, user=user: order.append(user))
+    while s.serve(None):
+        pass
+    # 先に大量に並んだユーザーがいても交互に処理する
+    assert order == ['batch', 'web', 'batch', 'web', 'batch', 'batch']
+
+def test_weights():
+    s = FairScheduler(weights={'web': 2}, clock=task.Clock())
+    order = []
+    for user in ['batch'] * 3 + ['web'] * 4:
+        s.enqueue(user).addCallback(lambda _, user=user: order.append(user))
+    while s.serve(None):
+        pass
+    assert order == ['web', 'batch', 'web', 'web', 'batch', 'web', 'batch']
+
+def test_limits():
+    clock = task.Clock()
+    s = FairScheduler(maxDepth=2, maxWait=5, clock=clock)
+    failures = []
+    a = s.enqueue('game13')
+    a.addErrback(failures.append)
+    clock.advance(3)
+    b = s.enqueue('game13')
+    b.addErrback(failures.append)
+
+    # 上限を超えたらすぐにエラー
+    s.enqueue('game13').addErrback(failures.append)
+    assert failures[0].check(QueueFull)
+    assert len(s) == 2
+
+    clock.advance(2)
+    assert failures[1].check(QueueTimeout)
+    assert len(s) == 1
+
+    result = []
+    clock.advance(1)
+    b.addCallback(result.append)
+    assert s.serve('backend')
+    assert result == ['backend']
+    stats = s.stats['game13']
+    assert (stats.served, stats.rejected, stats.timeouts) == (1, 1, 1)
+    assert stats.waitMax == 3
+    assert not s.serve('backend')
+
+def test_cancel():
+    s = FairScheduler(clock=task.Clock())
+    d = s.enqueue('game13')
+    d.addErrback(lambda f: f.trap(defer.CancelledError))
+    d.cancel()
+    assert len(s) == 0
+    assert not s.serve('backend')
@@ -0,0 +1,114 @@
+# coding: utf-8
+
+import random
+import struct
+
+import testconfig
+
+from twisted.internet import defer
+from twisted.internet.testing import StringTransport
+
+from rsproxy import filters, server, supervisor
+
+def message(msgtype, body):
+    return msgtype + struct.pack('!I', len(body) + 4) + body
+
+def query(sql):
+    return message('Q', sql + '\x00')
+
+ready = message('Z', 'I')
+
+class OnePool(object):
+    u"""
+    バックエンドがひとつだけのtransactionモードのプール
+    """
+    mode = 'transaction'
+    database = 'game'
+    def __init__(self):
+        self.idle = []
+        self.waiting = []
+    def acquire(self, user=None):
+        if self.idle:
+            return defer.succeed(self.idle.pop())
+        d = defer.Deferred()
+        self.waiting.append(d)
+        return d
+    def acquireShared(self):
+        return None
+    def pipelineDepth(self):
+        return 0
+    def release(self, backend, reset=False):
+        backend.client.detachBackend()
+        backend.client = None
+        if self.waiting:
+            self.waiting.pop(0).callback(backend)
+        else:
+            self.idle.append(backend)
+    def touch(self, backend):
+        pass
+
+def connect_client(factory, user):
+    p = factory.buildProtocol(None)
+    p.makeConnection(StringTransport())
+    p.filter.userAuth = filters.UserAuth(user)
+    p.filter.database = 'game'
+    p.filter.authenticated = True
+    return p
+
+def test_unsynced_extended_query():
+    pool = OnePool()
+    factory = server.PGProxyServerFactory(None)
+    factory.getPool = lambda database, shard=None: pool
+    backend = server.PostgresClientProtocol(pool)
+    backend.makeConnection(StringTransport())
+    backend.authenticationResponse = [filters.createZMessage('I')]
+    pool.idle.append(backend)
+    a = connect_client(factory, 'game13')
+    b = connect_client(factory, 'game05')
+
+    extended = (message('P', "\x00SELECT * FROM dau WHERE app='game13'\x00"
+                        "\x00\x00") +
+                message('B', '\x00\x00' + '\x00' * 6) +
+                message('E', '\x00\x00\x00\x00\x00'))
+    a.dataReceived(query("UPDATE dau SET n=1 WHERE app='game13'") + extended)
+    assert a.postgresProtocol is backend
+    backend.dataReceived(message('C', 'UPDATE 1\x00') + ready)
+    # Syncを送るまでaはバックエンドを手放さない
+    assert a.postgresProtocol is backend
+    b.dataReceived(query("UPDATE dau SET n=1 WHERE app='game05'"))
+    assert b.postgresProtocol is None
+
+    a.dataReceived(message('S', ''))
+    backend.dataReceived(message('1', '') + message('2', '') +
+                         message('D', '\x00\x01\x00\x00\x00\x06SECRET') +
+                         message('C', 'SELECT 1\x00') + ready)
+    assert 'SECRET' in a.transport.value()
+    assert 'SECRET' not in b.transport.value()
+    assert b.postgresProtocol is backend
+    assert a.postgresProtocol is None
+
+def test_worker_cancel_keys(monkeypatch):
+    factory = server.PGProxyServerFactory(None)
+    factory.workerId = 3
+    client = connect_client(factory, 'game13')
+    pid, key = client.cancelKey
+    assert pid >> supervisor.PID_BITS == 3
+    assert pid < 2 ** 31
+
+    # 他のワーカーのクライアントのキャンセルはそのワーカーに送る
+    forwarded = []
+    monkeypatch.setattr(factory, 'forwardCancel',
+                        lambda pid, key: forwarded.append((pid, key)))
+    other = (5 << supervisor.PID_BITS) + 1
+    factory.cancel(other, key)
+    factory.cancel(pid, key)
+    assert forwarded == [(other, key)]
+
+def test_cancel_key_random():
+    factory = server.PGProxyServerFactory(None)
+    keys = []
+    for i in range(2):
+        # randomモジュールの状態からは予測できない
+        random.seed(0)
+        keys.append(connect_client(factory, 'game13').cancelKey[1])
+    assert keys[0] != keys[1]
@@ -0,0 +1,35 @@
+# coding: utf-8
+
+import json
+import os
+
+import testconfig
+
+from rsproxy import supervisor
+
+def test_aggregate():
+    reports = [
+        {'clients': 3, 'wait': {'db': {'web': {'served': 2, 'wait_max': 0.5}}}},
+        {'clients': 4, 'wait': {'db': {'web': {'served': 1, 'wait_max': 1.5},
+                                       'batch': {'served': 5, 'wait_max': 0}}}},
+        {},
+        ]
+    total = supervisor.aggregate(reports)
+    assert total == {'clients': 7,
+                     'wait': {'db': {'web': {'served': 3, 'wait_max': 1.5},
+                                     'batch': {'served': 5, 'wait_max': 0}}}}
+
+def test_worker_reports():
+    r, w = os.pipe()
+    worker = supervisor.Worker(0, r, 0)
+    line = json.dumps({'clients': 2}) + '\n'
+    # 途中で切れた行は次の読み込みまで持ち越す
+    os.write(w, line[:5])
+    assert worker.read()
+    assert worker.stats == {}
+    os.write(w, line[5:] + line.replace('2', '5'))
+    assert worker.read()
+    assert worker.stats == {'clients': 5}
+    os.close(w)
+    assert not worker.read()
+    worker.close()